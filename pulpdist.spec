@@ -88,7 +88,6 @@ Summary:        Pulp plugins to support PulpDist mirroring network
 Requires: %{name} = %{version}
 Requires: pulp = 0.0.267
 Requires: rsync
-Requires: hardlink
 
 # Requires: python-parse
 # Not yet packaged, use "pip install parse" instead
@@ -21,7 +21,7 @@ import os.path
 import contextlib
 import datetime
 
-from ..core import pulpapi
+from ..core import pulpapi, stats_history
 from ..core.repo_config import RepoConfig
 from ..core.site_config import SiteConfig, PulpRepo
 from .display import (print_msg, print_header, print_data,
@@ -50,10 +50,11 @@ def default_host():
     return socket.gethostname()
 
 
-def make_args(pulp_host=None, verbose=0, ignoremeta=False,
+def make_args(pulp_host=None, verbose=0, ignoremeta=False, cache_dir=None,
               config_fname=None, num_entries=None, current_hour=None,
               showlog=False, dryrun=False, success=False, force=False,
-              num_threads=4,
+              num_threads=4, trend=False, stats_db=None, period="day",
+              scope="repo", window=7,
               repo_list=(), mirror_list=(), site_list=(),
               tree_list=(), source_list=(), server_list=()):
     """Creates a valid "args" attribute suitable for passing to any
@@ -128,7 +129,8 @@ class PulpCommand(object):
                 print_msg("Loading configuration from file {0!r}", config_fname)
             with open(config_fname) as config_file:
                 config_data = json.load(config_file)
-        self._site_config = site_config = SiteConfig(config_data)
+        self._site_config = site_config = SiteConfig(config_data,
+                                                     cache_dir=args.cache_dir)
         if verbose > 2:
             print_data(site_config.config, 2)
         if upload_meta:
@@ -352,13 +354,85 @@ class ShowSyncLog(LatestSyncCommand):
         # See BZ#799203 for more info on why this works this way
         host = self.args.pulp_host
         print_header("Most recent sync log for {0}", repo.display_id)
-        log_url = "https://{0}/sync_logs/{1}.log".format(host, repo.id)
+        log_name = (sync_job.get("summary") or {}).get("log_file")
+        if log_name is None:
+            log_name = repo.id + ".log"
+        log_url = "https://{0}/sync_logs/{1}".format(host, log_name)
         print_msg("Opening '{0}' in browser".format(log_url))
         webbrowser.open_new_tab(log_url)
 
 
+def _format_change(change):
+    if change is None:
+        return "n/a"
+    return "{0:+.1%}".format(change)
+
+def _format_average(average, scale=1):
+    if average is None:
+        return "n/a"
+    return "{0:.1f}".format(average / scale)
+
 class ShowSyncStats(LatestSyncCommand):
-    """Command that displays the most recent sync stats for each repository"""
+    """Command that displays the most recent sync stats for each repository
+
+       With --trend, reports changes in sync duration and tree size based on
+       the local sync statistics history instead.
+    """
+    def _get_repos(self):
+        if self.args.trend:
+            # Trends don't need the sync history from the server
+            return super(SyncHistoryCommand, self)._get_repos()
+        return super(ShowSyncStats, self)._get_repos()
+
+    def process_repos(self, repos):
+        if self.args.trend:
+            self.show_trends(repos)
+        else:
+            super(ShowSyncStats, self).process_repos(repos)
+
+    def _get_trend_keys(self, repos):
+        scope = self.args.scope
+        if scope == "repo":
+            return [repo.id for repo in repos]
+        keys = set()
+        for repo in repos:
+            notes = repo.config.get("notes") or {}
+            key = notes.get("pulpdist", {}).get(scope + "_id")
+            if key is not None:
+                keys.add(key)
+        return keys
+
+    def show_trends(self, repos):
+        args = self.args
+        db_path = args.stats_db
+        if db_path is None:
+            db_path = stats_history.DEFAULT_STATS_DB
+        if not repos:
+            self.print_no_repos()
+            return
+        if not os.path.exists(db_path):
+            print_msg("No sync statistics recorded in {0!r}", db_path)
+            return
+        history = stats_history.SyncStatsHistory(db_path)
+        with history.opened():
+            trends = history.get_trends(args.period, args.scope, args.window,
+                                        self._get_trend_keys(repos))
+        print_header("Sync trends by {0} (last {1} {2}s vs previous {1})",
+                     args.scope, args.window, args.period)
+        if not trends:
+            print_msg("No sync statistics recorded for selected repositories")
+            return
+        id_width = max(len(trend.key) for trend in trends) + 3
+        row_format = "{1:{0}.{0}}{2:>6} {3:>6} {4:>12} {5:>9} {6:>14} {7:>9}"
+        print_msg(row_format, id_width, "ID", "Runs", "Fails", "Duration (s)",
+                  "Change", "Size (MiB)", "Change")
+        for trend in trends:
+            print_msg(row_format, id_width, trend.key, trend.runs,
+                      trend.failures, _format_average(trend.avg_duration),
+                      _format_change(trend.duration_change),
+                      _format_average(trend.avg_tree_bytes, 2**20),
+                      _format_change(trend.tree_bytes_change))
+
     def process_repo(self, repo):
         display_id = repo.display_id
         sync_job = self.get_latest_sync(repo)
@@ -14,7 +14,7 @@
 import argparse
 
 from . import commands
-from ..core import util
+from ..core import util, stats_history, site_config
 
 def make_parser():
     prog = "python -m {0}.manage_repos".format(__package__)
@@ -35,6 +35,12 @@ def make_parser():
                         help="Increase level of debugging information displayed")
     parser.add_argument("--ignoremeta", action='store_true',
                             help="Ignore any PulpDist metadata stored on the server")
+    parser.add_argument("--cache-dir", metavar="DIR",
+                        dest="cache_dir", default=site_config.default_cache_dir(),
+                        help="Directory for cached site databases (Default: %(default)s)")
+    parser.add_argument("--no-cache", action='store_const',
+                        dest="cache_dir", const=None,
+                        help="Always rebuild the site database from the site config")
     parser.add_argument("-V", "--version", action='version',
                         version='PulpDist {0}'.format(util.__version__))
     add_parser_subcommands(parser)
@@ -88,6 +94,25 @@ def _add_success(cmd_parser):
     cmd_parser.add_argument("--success", action='store_true',
                             help="Report on most recent successful sync")
 
+def _add_trend(cmd_parser):
+    cmd_parser.add_argument("--trend", action='store_true',
+                            help="Report changes in sync duration and tree size "
+                                 "from the local sync statistics history")
+    cmd_parser.add_argument("--stats-db", metavar="PATH",
+                            dest="stats_db", default=None,
+                            help="Sync statistics history to read "
+                                 "(Default: {0})".format(stats_history.DEFAULT_STATS_DB))
+    cmd_parser.add_argument("--period", default="day",
+                            choices=sorted(stats_history.ROLLUP_PERIODS),
+                            help="Rollup period for trends (Default: %(default)s)")
+    cmd_parser.add_argument("--by", dest="scope", default="repo",
+                            choices=stats_history.ROLLUP_SCOPES,
+                            help="Report trends per repo, remote server or site "
+                                 "(Default: %(default)s)")
+    cmd_parser.add_argument("--window", metavar="NUM", type=int, default=7,
+                            help="Number of periods compared with the preceding "
+                                 "periods (Default: %(default)s)")
+
 def _add_force(cmd_parser):
     cmd_parser.add_argument("--force", action='store_true',
                             help="Automatically answer yes to all prompts")
@@ -115,7 +140,7 @@ _INFO_COMMANDS = (
     ("status", "ShowRepoStatus", "Display repository sync status", ()),
     ("history", "ShowSyncHistory", "Display repository sync history", [_add_entries, _add_showlog]),
     ("log", "ShowSyncLog", "Display most recent sync log (opens web browser)", [_add_success]),
-    ("stats", "ShowSyncStats", "Display most recent sync statistics", [_add_success]),
+    ("stats", "ShowSyncStats", "Display most recent sync statistics", [_add_success, _add_trend]),
 )
 
 _SYNC_COMMANDS = (
@@ -0,0 +1,144 @@
+#
+# Copyright (C) 2012 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+"""Site-wide bandwidth budget shared by concurrent transfers
+
+Each active transfer holds a lease, recorded as a file in a registry
+directory shared by all sync processes on the host. The budget is divided
+evenly between the live leases, so each transfer's share changes as other
+transfers start and finish. Leases left behind by processes that no longer
+exist are ignored and cleaned up.
+
+The registry is kept in a directory owned by the sync service (rather than
+a shared temporary directory) so other users can't add leases to starve the
+transfers, and so processes with private temporary directories (such as
+those started by systemd with PrivateTmp) still share the same budget.
+
+A transfer only picks up a new share by restarting rsync, which repeats the
+full file list build, so the budget is best suited to trees that take much
+longer to transfer than to list.
+"""
+
+import contextlib
+import errno
+import os
+import stat
+import tempfile
+
+DEFAULT_REGISTRY_DIR = "/var/lib/pulpdist/bandwidth"
+
+# Shares are never reduced below this (in KiB/s, as used by --bwlimit)
+MIN_SHARE = 1
+
+def _pid_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as ex:
+        if ex.errno == errno.ESRCH:
+            return False
+        if ex.errno != errno.EPERM:
+            raise
+    return True
+
+
+class BandwidthLease(object):
+    """A single transfer's claim on the shared bandwidth budget"""
+
+    def __init__(self, governor, lease_path):
+        self.governor = governor
+        self.lease_path = lease_path
+
+    def share(self):
+        """Returns the current bandwidth share for this transfer (in KiB/s)"""
+        active = max(self.governor.count_active_leases(), 1)
+        return max(self.governor.budget // active, MIN_SHARE)
+
+    def release(self):
+        try:
+            os.unlink(self.lease_path)
+        except OSError as ex:
+            if ex.errno != errno.ENOENT:
+                raise
+
+
+class BandwidthGovernor(object):
+    """Divides a bandwidth budget between all active transfers
+
+       budget: total bandwidth (in KiB/s) shared by all transfers
+       registry_dir: directory used to record the active transfers
+                     (defaults to DEFAULT_REGISTRY_DIR)
+    """
+
+    def __init__(self, budget, registry_dir=None):
+        if budget < 1:
+            raise ValueError("Bandwidth budget must be at least 1 KiB/s")
+        self.budget = budget
+        if registry_dir is None:
+            registry_dir = DEFAULT_REGISTRY_DIR
+        self.registry_dir = registry_dir
+
+    def acquire(self):
+        """Registers a new transfer, returning its lease
+
+           Raises OSError if the registry can't be used. The lease must be
+           released once the transfer is complete.
+        """
+        registry_dir = self.registry_dir
+        if not os.path.isdir(registry_dir):
+            try:
+                os.makedirs(registry_dir, 0755)
+            except OSError as ex:
+                if ex.errno != errno.EEXIST:
+                    raise
+            else:
+                # Only the service can add leases, regardless of the umask
+                os.chmod(registry_dir, 0755)
+        mode = os.stat(registry_dir).st_mode
+        if mode & (stat.S_IWGRP | stat.S_IWOTH):
+            msg = "Bandwidth registry {0!r} is writable by other users".format(registry_dir)
+            raise OSError(errno.EPERM, msg)
+        fd, lease_path = tempfile.mkstemp(dir=registry_dir,
+                                          prefix="{0}.".format(os.getpid()))
+        os.close(fd)
+        return BandwidthLease(self, lease_path)
+
+    @contextlib.contextmanager
+    def lease(self):
+        """Context manager that holds a lease for the duration of a transfer"""
+        lease = self.acquire()
+        try:
+            yield lease
+        finally:
+            lease.release()
+
+    def count_active_leases(self):
+        """Returns the number of transfers currently sharing the budget"""
+        try:
+            names = os.listdir(self.registry_dir)
+        except OSError as ex:
+            if ex.errno != errno.ENOENT:
+                raise
+            return 0
+        active = 0
+        for name in names:
+            try:
+                pid = int(name.partition(".")[0])
+            except ValueError:
+                continue
+            if _pid_exists(pid):
+                active += 1
+                continue
+            # Left behind by a process that exited without releasing it
+            try:
+                os.unlink(os.path.join(self.registry_dir, name))
+            except OSError:
+                pass
+        return active
@@ -0,0 +1,278 @@
+#
+# Copyright (C) 2012 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+"""Incremental hard link consolidation for local mirrors and sites
+
+A persistent index records the metadata of each file in the mirror.
+Files that were just transferred are looked up in the index, and replaced
+with a hard link to an existing file if an identical one is found. This
+keeps the cost of consolidation proportional to the amount of data
+transferred rather than to the size of the mirror.
+
+Files are only linked if their size, modification time, permissions,
+ownership, device and digest all match, so consolidation never changes
+the metadata rsync relies on to detect changes. Like hardlink(1), files
+are only hashed when another file with the same metadata exists, and the
+digests are recorded in the index as they are calculated. Indexing a
+mirror for the first time only needs to stat most files.
+
+By default, each mirror has its own index. An index may instead be shared
+by several mirrors, allowing files to be linked to identical files in any
+other mirror on the same filesystem. Paths are recorded as absolute paths,
+and each mirror is fully scanned the first time it uses an index.
+"""
+
+import collections
+import contextlib
+import errno
+import hashlib
+import os
+import sqlite3
+import stat
+import sys
+import time
+
+INDEX_NAME = ".pulpdist-hardlinks.sqlite"
+
+# Top level entries with this prefix hold local metadata, not mirrored data
+_METADATA_PREFIX = ".pulpdist-"
+
+_HASH_CHUNK_SIZE = 1024 * 1024
+
+# The index may be shared between several mirrors (see dedupe_index_path),
+# so the write lock is never held for long: pending updates are committed
+# at least this often, and before hashing any file larger than the limit
+_COMMIT_INTERVAL_SECONDS = 1.0
+_MAX_LOCKED_HASH_BYTES = 1024 * 1024
+_LOCK_TIMEOUT_SECONDS = 300
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER,
+    digest TEXT,
+    mtime REAL,
+    mode INTEGER,
+    uid INTEGER,
+    gid INTEGER,
+    dev INTEGER,
+    ino INTEGER
+);
+DROP INDEX IF EXISTS files_by_content;
+CREATE INDEX IF NOT EXISTS files_by_metadata ON files (size, mtime, mode, uid, gid, dev);
+CREATE TABLE IF NOT EXISTS scanned_roots (
+    root TEXT PRIMARY KEY
+);
+"""
+
+ConsolidationStats = collections.namedtuple("ConsolidationStats",
+                                            "checked_files linked_files linked_bytes")
+
+def fs_path(path):
+    # Paths are stored and compared as byte strings, since mirrored
+    # file names aren't guaranteed to be valid in any given encoding
+    if isinstance(path, unicode):
+        return path.encode(sys.getfilesystemencoding() or "utf-8")
+    return path
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(_HASH_CHUNK_SIZE), ''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class HardlinkIndex(object):
+    """Content index used to hard link duplicate files
+
+       root: the local path of the mirror
+       index_path: the SQLite database used to store the index
+                   (defaults to INDEX_NAME in the root directory)
+    """
+
+    def __init__(self, root, index_path=None):
+        self.root = fs_path(os.path.abspath(root))
+        if index_path is None:
+            index_path = os.path.join(self.root, INDEX_NAME)
+        self.index_path = index_path
+        self._db = None
+        self._write_started = None
+
+    def open(self):
+        index_dir = os.path.dirname(self.index_path)
+        if index_dir and not os.path.isdir(index_dir):
+            os.makedirs(index_dir)
+        db = sqlite3.connect(self.index_path, timeout=_LOCK_TIMEOUT_SECONDS)
+        db.text_factory = str
+        db.executescript(_SCHEMA)
+        self._db = db
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+            self._write_started = None
+
+    @contextlib.contextmanager
+    def opened(self):
+        self.open()
+        try:
+            yield self
+        finally:
+            self.close()
+
+    def needs_full_scan(self):
+        """Returns True if the mirror has never been fully indexed"""
+        row = self._db.execute("SELECT 1 FROM scanned_roots WHERE root=?",
+                               (self.root,)).fetchone()
+        return row is None
+
+    def iter_all_files(self):
+        """Yields the paths of all regular files in the mirror"""
+        for path, subdirs, files in os.walk(self.root):
+            if path == self.root:
+                subdirs[:] = [d for d in subdirs
+                                if not d.startswith(_METADATA_PREFIX)]
+                files = [f for f in files
+                           if not f.startswith(_METADATA_PREFIX)]
+            for fname in files:
+                yield os.path.join(path, fname)
+
+    def consolidate_all(self, log=None):
+        """Index every file in the mirror, linking any duplicates"""
+        stats = self.consolidate(self.iter_all_files(), log)
+        with self._db:
+            self._db.execute("INSERT OR REPLACE INTO scanned_roots VALUES (?)",
+                             (self.root,))
+        return stats
+
+    def consolidate(self, paths, log=None):
+        """Index the given files, replacing duplicates with hard links"""
+        checked = linked = linked_bytes = 0
+        for path in paths:
+            path = fs_path(path)
+            try:
+                was_linked = self._consolidate_file(path, log)
+            except (IOError, OSError) as ex:
+                # Files may disappear or be unreadable, just skip them
+                if log is not None:
+                    log("Unable to consolidate {0!r} ({1})", path, ex)
+                continue
+            if was_linked is None:
+                continue
+            checked += 1
+            if was_linked:
+                linked += 1
+                linked_bytes += os.lstat(path).st_size
+            if (self._write_started is not None and
+                time.time() - self._write_started >= _COMMIT_INTERVAL_SECONDS):
+                self._commit()
+        self._commit()
+        return ConsolidationStats(checked, linked, linked_bytes)
+
+    def _execute_write(self, query, params):
+        # Writes are batched into a transaction, which holds the write lock
+        # on the index until it is committed
+        if self._write_started is None:
+            self._write_started = time.time()
+        self._db.execute(query, params)
+
+    def _commit(self):
+        self._db.commit()
+        self._write_started = None
+
+    def forget(self, dir_path):
+        """Removes the entries for all files under the given directory"""
+        prefix = os.path.join(fs_path(os.path.abspath(dir_path)), '')
+        # GLOB rather than LIKE, since LIKE is case insensitive
+        pattern = prefix.replace('[', '[[]').replace('*', '[*]').replace('?', '[?]')
+        with self._db:
+            self._db.execute("DELETE FROM files WHERE path GLOB ?",
+                             (pattern + '*',))
+
+    def _hash_file(self, path, size):
+        if size > _MAX_LOCKED_HASH_BYTES:
+            # Don't block other users of the index while hashing large files
+            self._commit()
+        return file_digest(path)
+
+    def _consolidate_file(self, path, log):
+        # Returns None if the file was ignored, otherwise whether or
+        # not it was replaced with a hard link
+        path_stat = os.lstat(path)
+        if not stat.S_ISREG(path_stat.st_mode) or path_stat.st_size == 0:
+            return None
+        key = (path_stat.st_size, path_stat.st_mtime,
+               stat.S_IMODE(path_stat.st_mode),
+               path_stat.st_uid, path_stat.st_gid, path_stat.st_dev)
+        candidates = self._db.execute(
+            "SELECT path, digest, ino FROM files WHERE size=? AND mtime=?"
+            " AND mode=? AND uid=? AND gid=? AND dev=? AND path!=?",
+            key + (path,)).fetchall()
+        # Files are only hashed if another file could be identical
+        digest = None
+        target_stat = path_stat
+        checked_inodes = set()
+        for candidate, candidate_digest, candidate_ino in candidates:
+            if candidate_ino == path_stat.st_ino:
+                # Already linked
+                if digest is None:
+                    digest = candidate_digest
+                break
+            if candidate_ino in checked_inodes:
+                # Another link to a file that has already been compared
+                continue
+            if not self._is_unchanged(candidate, candidate_ino, key):
+                continue
+            checked_inodes.add(candidate_ino)
+            if digest is None:
+                digest = self._hash_file(path, path_stat.st_size)
+            if candidate_digest is None:
+                candidate_digest = self._hash_file(candidate, path_stat.st_size)
+                self._execute_write("UPDATE files SET digest=? WHERE path=?",
+                                    (candidate_digest, candidate))
+            if candidate_digest == digest:
+                self._replace_with_link(candidate, path)
+                if log is not None:
+                    log("Linked {0!r} => {1!r}", path, candidate)
+                target_stat = os.lstat(path)
+                break
+        size, mtime, mode, uid, gid, dev = key
+        self._execute_write("INSERT OR REPLACE INTO files VALUES (?,?,?,?,?,?,?,?,?)",
+                            (path, size, digest, mtime, mode, uid, gid, dev,
+                             target_stat.st_ino))
+        return target_stat is not path_stat
+
+    def _is_unchanged(self, candidate, candidate_ino, key):
+        try:
+            candidate_stat = os.lstat(candidate)
+        except OSError as ex:
+            if ex.errno not in (errno.ENOENT, errno.ENOTDIR):
+                raise
+            candidate_stat = None
+        if (candidate_stat is not None and
+            candidate_stat.st_ino == candidate_ino and
+            candidate_stat.st_size == key[0] and
+            candidate_stat.st_mtime == key[1]):
+            return True
+        # Stale entry, so drop it from the index
+        self._execute_write("DELETE FROM files WHERE path=?", (candidate,))
+        return False
+
+    def _replace_with_link(self, target, path):
+        temp_path = "{0}.pulpdist-link.{1}".format(path, os.getpid())
+        os.link(target, temp_path)
+        try:
+            os.rename(temp_path, path)
+        except:
+            os.unlink(temp_path)
+            raise
@@ -0,0 +1,352 @@
+#
+# Copyright (C) 2012 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+"""Tree manifests listing the size, modification time and digest of files
+
+A manifest published alongside an upstream tree lets downstream sites work
+out exactly which files have changed by comparing it with the manifest for
+their local copy, without rsync building and transferring a listing of the
+entire tree.
+
+Manifests are built by walking the tree, and only files whose size or
+modification time differ from the previous manifest are hashed again.
+Hashing is spread across several threads (hashlib releases the GIL while
+hashing large buffers). The command line interface uses separate processes
+instead, as it doesn't run inside a multi-threaded server process that
+would be unsafe to fork. Files whose names aren't valid UTF-8 are omitted.
+
+Manifests are gzip compressed text files. The first line identifies the
+format, and each subsequent line describes one file as tab separated fields:
+path (relative to the tree root, with tabs, newlines and other special
+characters backslash escaped), size, modification time (in whole seconds)
+and digest.
+"""
+
+import argparse
+import collections
+import errno
+import fnmatch
+import gzip
+import hashlib
+import multiprocessing
+import os
+import Queue
+import stat
+import sys
+import tempfile
+import threading
+
+from . import shellutil
+from .hardlink_index import file_digest, fs_path
+
+MANIFEST_HEADER = "# pulpdist-manifest 1"
+
+DEFAULT_MANIFEST_NAME = "MANIFEST.gz"
+
+# Top level local metadata (see sync_trees) is never listed
+_LOCAL_METADATA_PATTERN = "/.pulpdist-*"
+
+# Hashing fewer files than this isn't worth starting extra threads or processes
+_MIN_PARALLEL_FILES = 64
+_HASH_CHUNK_FILES = 16
+
+ManifestEntry = collections.namedtuple("ManifestEntry", "path size mtime digest")
+
+class ManifestError(Exception):
+    """Raised when a manifest is malformed"""
+
+
+def _escape_path(path):
+    if isinstance(path, unicode):
+        path = path.encode("utf-8")
+    return path.encode("string_escape")
+
+def _unescape_path(escaped):
+    return escaped.decode("string_escape").decode("utf-8")
+
+def _check_path(path):
+    parts = path.split("/")
+    if not path or path.startswith("/") or ".." in parts or "" in parts:
+        raise ManifestError("Invalid manifest path {0!r}".format(path))
+
+def read_manifest(manifest_path):
+    """Returns a dict mapping relative paths (as unicode) to manifest entries"""
+    entries = {}
+    f = gzip.open(manifest_path, 'rb')
+    try:
+        lines = iter(f)
+        try:
+            header = next(lines).rstrip("\n")
+        except (StopIteration, IOError):
+            header = None
+        if header != MANIFEST_HEADER:
+            raise ManifestError("{0!r} is not a manifest".format(manifest_path))
+        for line_number, line in enumerate(lines, 2):
+            fields = line.rstrip("\n").split("\t")
+            try:
+                escaped_path, size, mtime, digest = fields
+                path = _unescape_path(escaped_path)
+                entry = ManifestEntry(path, int(size), int(mtime), digest)
+            except ValueError:
+                msg = "Malformed entry on line {0} of {1!r}"
+                raise ManifestError(msg.format(line_number, manifest_path))
+            _check_path(path)
+            entries[path] = entry
+    finally:
+        f.close()
+    return entries
+
+def write_manifest(manifest_path, entries):
+    """Atomically write the given manifest entries (in path order)"""
+    manifest_dir = os.path.dirname(os.path.abspath(manifest_path))
+    fd, temp_path = tempfile.mkstemp(dir=manifest_dir, prefix=".manifest-")
+    try:
+        with os.fdopen(fd, 'wb') as raw:
+            f = gzip.GzipFile(fileobj=raw, mode='wb')
+            try:
+                f.write(MANIFEST_HEADER + "\n")
+                for entry in sorted(entries, key=lambda entry: entry.path):
+                    f.write("{0}\t{1:d}\t{2:d}\t{3}\n".format(
+                                _escape_path(entry.path), entry.size,
+                                int(entry.mtime), entry.digest))
+            finally:
+                f.close()
+        os.chmod(temp_path, 0644)
+        os.rename(temp_path, manifest_path)
+    except:
+        try:
+            os.unlink(temp_path)
+        except OSError as ex:
+            if ex.errno != errno.ENOENT:
+                raise
+        raise
+
+def diff_manifests(new_entries, old_entries):
+    """Compare two manifests (as returned by read_manifest)
+
+       Returns a (changed, deleted) tuple of sorted path lists, where
+       changed lists the new or modified files and deleted lists the
+       files that are no longer present.
+    """
+    changed = [path for path, entry in new_entries.iteritems()
+                    if old_entries.get(path) != entry]
+    deleted = [path for path in old_entries if path not in new_entries]
+    return sorted(changed), sorted(deleted)
+
+def _file_digest_if_present(path):
+    try:
+        return file_digest(path)
+    except IOError as ex:
+        if ex.errno != errno.ENOENT:
+            raise
+        return None
+
+def _hash_files_in_threads(paths, jobs):
+    digests = [None] * len(paths)
+    pending = Queue.Queue()
+    for item in enumerate(paths):
+        pending.put(item)
+    errors = []
+    def _hash_pending_files():
+        while not errors:
+            try:
+                index, path = pending.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                digests[index] = _file_digest_if_present(path)
+            except:
+                errors.append(sys.exc_info())
+    workers = [threading.Thread(target=_hash_pending_files) for __ in range(jobs)]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+    for worker in workers:
+        worker.join()
+    if errors:
+        exc_info = errors[0]
+        raise exc_info[0], exc_info[1], exc_info[2]
+    return digests
+
+def _hash_files(paths, jobs=None, processes=False):
+    """Returns the digests of the given files (None for missing files)
+
+       Files are hashed in separate threads unless processes is true
+    """
+    if jobs is None:
+        jobs = multiprocessing.cpu_count()
+    if jobs <= 1 or len(paths) < _MIN_PARALLEL_FILES:
+        return [_file_digest_if_present(path) for path in paths]
+    jobs = min(jobs, len(paths))
+    if not processes:
+        return _hash_files_in_threads(paths, jobs)
+    pool = multiprocessing.Pool(jobs)
+    try:
+        return pool.map(_file_digest_if_present, paths, _HASH_CHUNK_FILES)
+    finally:
+        pool.close()
+        pool.join()
+
+class _Exclusions(object):
+    """Approximates rsync's handling of --exclude patterns"""
+
+    def __init__(self, patterns):
+        self.file_patterns = []
+        self.dir_patterns = []
+        self.path_patterns = []
+        for pattern in patterns:
+            pattern = fs_path(pattern)
+            dir_only = pattern.endswith("/")
+            pattern = pattern.rstrip("/")
+            if "/" in pattern:
+                # Matched against the path relative to the tree root
+                if pattern.startswith("/"):
+                    path_patterns = [pattern.lstrip("/")]
+                else:
+                    path_patterns = [pattern, "*/" + pattern]
+                for path_pattern in path_patterns:
+                    self.path_patterns.append((path_pattern, dir_only))
+            else:
+                # Matched against the last component of the path
+                self.dir_patterns.append(pattern)
+                if not dir_only:
+                    self.file_patterns.append(pattern)
+
+    def excludes_path(self, rel_path, is_dir):
+        for pattern, dir_only in self.path_patterns:
+            if (is_dir or not dir_only) and fnmatch.fnmatch(rel_path, pattern):
+                return True
+        return False
+
+    def excludes_file(self, rel_path):
+        """Returns True if the file or any of its parent directories is excluded"""
+        parts = fs_path(rel_path).split("/")
+        for index, name in enumerate(parts):
+            is_dir = index < len(parts) - 1
+            patterns = self.dir_patterns if is_dir else self.file_patterns
+            if any(fnmatch.fnmatch(name, pattern) for pattern in patterns):
+                return True
+            if self.excludes_path("/".join(parts[:index+1]), is_dir):
+                return True
+        return False
+
+def build_manifest(root_path, previous=None, excluded=(), jobs=None,
+                   processes=False):
+    """Returns manifest entries for the files in the tree at root_path
+
+       previous: an earlier manifest for the tree (as returned by
+                 read_manifest). Digests are reused for files with the
+                 same size and modification time.
+       excluded: rsync style exclusion patterns (as for exclude_from_sync)
+       jobs: number of threads used to hash files (defaults to the
+             number of CPUs)
+       processes: if true, files are hashed in child processes rather
+                  than threads. Only safe in single threaded programs.
+    """
+    if previous is None:
+        previous = {}
+    root_path = fs_path(root_path)
+    exclusions = _Exclusions(list(excluded) + [_LOCAL_METADATA_PATTERN])
+    entries = []
+    to_hash = []
+    walk = shellutil.filtered_walk(root_path,
+                                   excluded_files=exclusions.file_patterns,
+                                   excluded_dirs=exclusions.dir_patterns)
+    for dir_info in walk:
+        rel_dir = os.path.relpath(dir_info.path, root_path)
+        if rel_dir == os.curdir:
+            rel_dir = ""
+        names = list(dir_info.files)
+        for name in list(dir_info.subdirs):
+            rel_path = os.path.join(rel_dir, name)
+            if exclusions.excludes_path(rel_path, True):
+                dir_info.subdirs.remove(name)
+            elif os.path.islink(os.path.join(dir_info.path, name)):
+                # Symlinks to directories are listed like files
+                names.append(name)
+        for name in names:
+            rel_path = os.path.join(rel_dir, name)
+            if exclusions.excludes_path(rel_path, False):
+                continue
+            try:
+                path = rel_path.decode("utf-8")
+            except UnicodeDecodeError:
+                continue
+            full_path = os.path.join(dir_info.path, name)
+            try:
+                info = os.lstat(full_path)
+            except OSError as ex:
+                if ex.errno != errno.ENOENT:
+                    raise
+                continue
+            mtime = int(info.st_mtime)
+            if stat.S_ISLNK(info.st_mode):
+                target = os.readlink(full_path)
+                digest = "link:" + hashlib.sha256(target).hexdigest()
+                entries.append(ManifestEntry(path, len(target), mtime, digest))
+                continue
+            if not stat.S_ISREG(info.st_mode):
+                continue
+            entry = ManifestEntry(path, info.st_size, mtime, None)
+            old_entry = previous.get(path)
+            if (old_entry is not None and old_entry.size == entry.size and
+                    old_entry.mtime == entry.mtime):
+                entries.append(entry._replace(digest=old_entry.digest))
+            else:
+                to_hash.append((entry, full_path))
+    digests = _hash_files([full_path for entry, full_path in to_hash], jobs,
+                          processes)
+    for (entry, full_path), digest in zip(to_hash, digests):
+        if digest is not None:
+            entries.append(entry._replace(digest=digest))
+    entries.sort(key=lambda entry: entry.path)
+    return entries
+
+def update_manifest(root_path, manifest_name=DEFAULT_MANIFEST_NAME,
+                    excluded=(), jobs=None, processes=False):
+    """Write the manifest for a tree, reusing digests from the existing one
+
+       jobs and processes are passed to build_manifest.
+       Returns the entries written to the manifest
+    """
+    manifest_path = os.path.join(root_path, manifest_name)
+    previous = None
+    if os.path.exists(manifest_path):
+        try:
+            previous = read_manifest(manifest_path)
+        except (IOError, ManifestError):
+            pass
+    # The manifest never lists itself
+    excluded = list(excluded) + ["/" + manifest_name]
+    entries = build_manifest(root_path, previous, excluded, jobs, processes)
+    write_manifest(manifest_path, entries)
+    return entries
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Write a PulpDist tree manifest")
+    parser.add_argument("root_path", metavar="TREE",
+                        help="tree to describe")
+    parser.add_argument("--name", default=DEFAULT_MANIFEST_NAME,
+                        help="manifest file name (relative to the tree)")
+    parser.add_argument("--exclude", action="append", default=[],
+                        metavar="PATTERN",
+                        help="rsync style pattern for files to omit")
+    parser.add_argument("--jobs", type=int, default=None,
+                        help="number of processes used to hash files")
+    args = parser.parse_args(argv)
+    # Nothing else runs in this process, so it's safe to fork workers
+    entries = update_manifest(args.root_path, args.name, args.exclude,
+                              args.jobs, processes=True)
+    print("Wrote {0} entries to {1}".format(len(entries),
+                        os.path.join(args.root_path, args.name)))
+
+if __name__ == "__main__":
+    main()
@@ -97,6 +97,16 @@ class MirrorConverter(object):
         rsync_port = server.rsync_port
         if rsync_port is not None:
             config[u"rsync_port"] = rsync_port
+        dedupe_index = site.dedupe_index
+        if dedupe_index is None:
+            dedupe_index = default_site.dedupe_index
+        if dedupe_index is not None:
+            config[u"dedupe_index_path"] = dedupe_index
+        bandwidth_budget = site.bandwidth_budget
+        if bandwidth_budget is None:
+            bandwidth_budget = default_site.bandwidth_budget
+        if bandwidth_budget is not None:
+            config[u"bandwidth_budget"] = bandwidth_budget
         return config
 
     def _build_versioned_config(self):
@@ -0,0 +1,166 @@
+#
+# Copyright (C) 2012 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+"""Persistent index of directories containing PROTECTED marker files
+
+Finding PROTECTED markers with a full walk of the local tree means a stat
+call for every file in the mirror. The index instead remembers the
+subdirectories of each directory and whether or not it contains a marker,
+keyed by the directory's mtime and inode. Directories are still checked
+with a single stat call each, but are only listed again when their mtime
+indicates an entry has been added, removed or renamed.
+"""
+
+import errno
+import json
+import os
+import stat
+import tempfile
+import threading
+import time
+
+INDEX_NAME = ".pulpdist-protected.json"
+MARKER_NAME = "PROTECTED"
+
+_INDEX_VERSION = 1
+
+# Directories modified within this many seconds of being listed may
+# change again without their mtime changing, so they aren't cached
+_RACY_MTIME_SECONDS = 2
+
+
+class ProtectedIndex(object):
+    """Index of PROTECTED markers for a local mirror
+
+       root: the local path of the mirror
+       index_path: the sidecar file used to store the index between runs
+                   (defaults to INDEX_NAME in the root directory)
+    """
+
+    def __init__(self, root, index_path=None):
+        self.root = os.path.abspath(root)
+        if index_path is None:
+            index_path = os.path.join(self.root, INDEX_NAME)
+        self.index_path = index_path
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._visited = set()
+        self._modified = False
+        self.load()
+
+    def load(self):
+        """Load the saved index (if any). An unusable index is ignored."""
+        try:
+            with open(self.index_path) as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            data = None
+        entries = {}
+        if isinstance(data, dict) and data.get("version") == _INDEX_VERSION:
+            entries = data.get("dirs", {})
+        with self._lock:
+            self._entries = entries
+            self._visited = set()
+            self._modified = False
+
+    def save(self):
+        """Atomically write the index to the sidecar file if it has changed
+
+           Entries that weren't visited since the index was loaded are
+           dropped if the top level directory containing them is gone.
+        """
+        with self._lock:
+            entries = self._entries
+            for rel_path in list(entries):
+                if rel_path in self._visited:
+                    continue
+                top_dir = rel_path.split(os.sep, 1)[0]
+                if not os.path.isdir(os.path.join(self.root, top_dir)):
+                    del entries[rel_path]
+                    self._modified = True
+            if not self._modified:
+                return
+            data = {"version": _INDEX_VERSION, "dirs": entries}
+            index_dir = os.path.dirname(self.index_path)
+            fd, temp_path = tempfile.mkstemp(dir=index_dir,
+                                             prefix=INDEX_NAME + ".")
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(data, f)
+                os.rename(temp_path, self.index_path)
+            except:
+                os.unlink(temp_path)
+                raise
+            self._modified = False
+
+    def find_protected(self, top):
+        """Returns the paths (relative to top) of protected directories
+
+           Symbolic links to directories are not followed, and "." is
+           returned if top itself is protected.
+        """
+        top = os.path.abspath(top)
+        rel_top = os.path.relpath(top, self.root)
+        if rel_top == os.pardir or rel_top.startswith(os.pardir + os.sep):
+            raise ValueError("{0!r} is not inside {1!r}".format(top, self.root))
+        protected = []
+        with self._lock:
+            self._scan(top, rel_top, os.curdir, protected)
+        return protected
+
+    def _scan(self, dir_path, rel_key, rel_result, protected):
+        try:
+            dir_stat = os.stat(dir_path)
+        except OSError as ex:
+            if ex.errno in (errno.ENOENT, errno.ENOTDIR):
+                return
+            raise
+        if not stat.S_ISDIR(dir_stat.st_mode):
+            return
+        self._visited.add(rel_key)
+        signature = [dir_stat.st_mtime, dir_stat.st_ino]
+        entry = self._entries.get(rel_key)
+        if entry is None or entry["signature"] != signature:
+            entry = self._list_dir(dir_path, dir_stat, signature)
+            self._entries[rel_key] = entry
+            self._modified = True
+        if entry["protected"]:
+            protected.append(rel_result)
+        for subdir in entry["subdirs"]:
+            self._scan(os.path.join(dir_path, subdir),
+                       os.path.normpath(os.path.join(rel_key, subdir)),
+                       os.path.normpath(os.path.join(rel_result, subdir)),
+                       protected)
+
+    def _list_dir(self, dir_path, dir_stat, signature):
+        list_time = time.time()
+        subdirs = []
+        is_protected = False
+        try:
+            names = os.listdir(dir_path)
+        except OSError:
+            # Match os.walk: unreadable directories are skipped
+            names = ()
+            signature = None
+        for name in names:
+            entry_path = os.path.join(dir_path, name)
+            # Match os.walk: symlinks to directories are neither
+            # files nor descended into
+            if os.path.isdir(entry_path):
+                if not os.path.islink(entry_path):
+                    subdirs.append(name)
+            elif name == MARKER_NAME:
+                is_protected = True
+        if dir_stat.st_mtime >= list_time - _RACY_MTIME_SECONDS:
+            signature = None
+        return {"signature": signature,
+                "subdirs": sorted(subdirs),
+                "protected": is_protected}
@@ -35,6 +35,8 @@ class RepoConfig(validation.ValidatedConfig):
         u"simple_tree": sync_config.TreeSyncConfig,
         u"versioned_tree": sync_config.VersionedSyncConfig,
         u"snapshot_tree": sync_config.SnapshotSyncConfig,
+        u"snapshot_delta": sync_config.SnapshotDeltaSyncConfig,
+        u"delta_tree": sync_config.DeltaSyncConfig,
     }
 
     def __init__(self, config):
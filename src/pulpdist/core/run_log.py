@@ -0,0 +1,135 @@
+#
+# Copyright (C) 2012 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+"""Buffered sync logs for large trees
+
+A RunLog can be passed to a sync command in place of a log file. Writes are
+buffered rather than flushed line by line, and the log may be compressed
+with gzip. The output of each shell command may be capped, keeping only the
+first and last lines, and rsync progress updates are reduced to the final
+update for each file. A separate JSON lines event log records the main
+steps of the sync operation in a form that is easy for tools to consume.
+"""
+
+import collections
+import gzip
+import json
+from datetime import datetime
+
+DEFAULT_BUFFER_SIZE = 64 * 1024
+
+OMITTED_OUTPUT_MESSAGE = "... {0} lines of output omitted ..."
+
+
+class RunLog(object):
+    """Buffered, optionally compressed, log for a sync operation
+
+       log_path: path of the log file
+       compress: if true, the log is written with gzip compression
+       max_output_lines: if not zero, only the first and last
+                         max_output_lines/2 lines of output from each
+                         shell command are logged
+       event_path: if given, path of the JSON lines event log
+       buffer_size: number of bytes buffered before writing to disk
+    """
+
+    def __init__(self, log_path, compress=False, max_output_lines=0,
+                 event_path=None, buffer_size=DEFAULT_BUFFER_SIZE):
+        self.log_path = log_path
+        self.compress = compress
+        self.max_output_lines = max_output_lines
+        self.event_path = event_path
+        self._raw_file = open(log_path, 'wb', buffer_size)
+        if compress:
+            self._file = gzip.GzipFile(fileobj=self._raw_file, mode='wb')
+        else:
+            self._file = self._raw_file
+        if event_path is None:
+            self._event_file = None
+        else:
+            self._event_file = open(event_path, 'w', buffer_size)
+
+    @property
+    def events_enabled(self):
+        return self._event_file is not None
+
+    def write(self, text):
+        if isinstance(text, unicode):
+            text = text.encode("utf-8")
+        self._file.write(text)
+
+    def write_event(self, event, **details):
+        """Append an event (with a UTC timestamp) to the event log"""
+        if self._event_file is None:
+            return
+        details["event"] = event
+        details["time"] = datetime.utcnow().isoformat()
+        self._event_file.write(json.dumps(details, sort_keys=True) + "\n")
+
+    def flush(self):
+        self._file.flush()
+        self._raw_file.flush()
+        if self._event_file is not None:
+            self._event_file.flush()
+
+    def close(self):
+        if self._file is not self._raw_file:
+            self._file.close()
+        self._raw_file.close()
+        if self._event_file is not None:
+            self._event_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class CappedOutput(object):
+    """Passes lines to a log function, keeping only the head and tail
+
+       Call finish() once all of the lines have been added to log the
+       tail (preceded by a note of the number of lines omitted).
+    """
+
+    def __init__(self, log, max_lines=0):
+        self.log = log
+        self.max_lines = max_lines
+        self.head_lines = max_lines - max_lines // 2
+        self.tail = collections.deque(maxlen=max_lines // 2)
+        self.line_count = 0
+
+    def add(self, line):
+        self.line_count += 1
+        if not self.max_lines or self.line_count <= self.head_lines:
+            self.log(line)
+        elif self.tail.maxlen:
+            self.tail.append(line)
+
+    def finish(self):
+        """Log the retained tail, returning the number of lines omitted"""
+        omitted = max(self.line_count - self.head_lines - len(self.tail), 0)
+        if not self.max_lines:
+            omitted = 0
+        if omitted:
+            self.log(OMITTED_OUTPUT_MESSAGE.format(omitted))
+        for line in self.tail:
+            self.log(line)
+        self.tail.clear()
+        return omitted
+
+
+def collapse_progress(line):
+    """Drop all but the final rsync progress update from an output line"""
+    if "\r" not in line:
+        return line
+    return line.rstrip("\r\n").rpartition("\r")[2] + "\n"
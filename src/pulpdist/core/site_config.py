@@ -11,8 +11,26 @@
 # http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
 """Config definitions and helpers for pulpdist site configuration"""
 import collections
+import errno
+import hashlib
+import json
+import os
+import tempfile
 
-from . import validation, site_sql, repo_config, sync_config, mirror_config
+from . import (validation, site_sql, repo_config, sync_config, mirror_config,
+               util)
+
+# Only the most recently used site DBs are kept in the cache directory
+_MAX_CACHED_DBS = 5
+_CACHED_DB_PREFIX = "site-"
+_CACHED_DB_SUFFIX = ".sqlite"
+
+def default_cache_dir():
+    """Returns the default directory for cached site DBs"""
+    cache_home = os.environ.get("XDG_CACHE_HOME")
+    if not cache_home:
+        cache_home = os.path.expanduser("~/.cache")
+    return os.path.join(cache_home, "pulpdist")
 
 def _display_id(config):
     """Gets a nicely formatted Repo ID from a repo configuration"""
@@ -32,6 +50,10 @@ def check_path_mapping():
                                           validation.check_path(allow_none=True),
                                           allow_none=True)
 
+def _accept_entry(value, setting='setting'):
+    # Entries are checked separately during incremental validation
+    pass
+
 class RemoteServerConfig(validation.ValidatedConfig):
     _SPEC =  {
         u"server_id": validation.check_simple_id(),
@@ -140,12 +162,16 @@ class SiteSettingsConfig(validation.ValidatedConfig):
         u"exclude_from_listing": validation.check_rsync_filter_sequence(),
         u"server_prefixes": check_path_mapping(),
         u"source_prefixes": check_path_mapping(),
+        u"dedupe_index": validation.check_path(allow_none=True),
+        u"bandwidth_budget": validation.check_type(int, allow_none=True),
     }
     _DEFAULTS =  {
         u"exclude_from_sync": [],
         u"exclude_from_listing": [],
         u"server_prefixes": {},
         u"source_prefixes": {},
+        u"dedupe_index": None,
+        u"bandwidth_budget": None,
     }
 
 class SiteConfig(validation.ValidatedConfig):
@@ -174,9 +200,38 @@ class SiteConfig(validation.ValidatedConfig):
         (u"LOCAL_MIRRORS", site_sql.LocalMirror),
     )
 
-    def __init__(self, *args, **kwds):
-        super(SiteConfig, self).__init__(*args, **kwds)
+    # Fields identifying the entries in each section
+    _ENTRY_KEYS = {
+        u"REMOTE_SERVERS": (u"server_id",),
+        u"REMOTE_SOURCES": (u"source_id",),
+        u"REMOTE_TREES": (u"tree_id",),
+        u"SITE_SETTINGS": (u"site_id",),
+        u"LOCAL_MIRRORS": (u"mirror_id", u"site_id"),
+        u"RAW_REPOS": (u"repo_id",),
+    }
+
+    def __init__(self, config=None, previous=None, cache_dir=None):
+        """Site configuration, optionally revalidated incrementally
+
+           previous: an earlier SiteConfig for the same site. Only entries
+                     that differ from that config are validated again, and
+                     repo configs are only regenerated for mirrors that
+                     depend on modified entries.
+           cache_dir: if given, the populated site DB is saved in this
+                      directory, keyed by a hash of the config. Later
+                      instances with the same config open the saved DB
+                      instead of validating and converting the config.
+
+           After validation, changed_repo_ids is the set of repo IDs that
+           were added, removed or given a different config relative to the
+           previous config (all repo IDs if there is no previous config).
+        """
+        super(SiteConfig, self).__init__(config)
         self._db_session_factory = None
+        self.previous = previous
+        self.cache_dir = cache_dir
+        self.changed_repo_ids = None
+        self._db_build_path = None
 
     @property
     def repo_config(self):
@@ -185,7 +240,11 @@ class SiteConfig(validation.ValidatedConfig):
         return self._repo_config
 
     def _init_db(self):
-        self._db_session_factory = site_sql.in_memory_db()
+        build_path = self._db_build_path
+        if build_path is None:
+            self._db_session_factory = site_sql.in_memory_db()
+        else:
+            self._db_session_factory = site_sql.file_db(build_path, create=True)
 
     def _get_db_session(self):
         if self._db_session_factory is None:
@@ -198,32 +257,71 @@ class SiteConfig(validation.ValidatedConfig):
         # Populate with data
         config = self.config
         for key, model in self._SQL_LOAD_ORDER:
-            for model_data in config[key]:
-                db_session = self._get_db_session()
-                db_session.add(model.from_mapping(model_data))
-                try:
-                    db_session.commit()
-                except site_sql.IntegrityError as exc:
-                    validation.fail_validation(exc)
-        self._convert_raw_repos()
-        self._convert_mirrors()
+            self._load_entries(model, config[key])
+        previous = self.previous
+        repos = self._convert_raw_repos()
+        if previous is None:
+            repos.extend(self._convert_mirrors())
+            self._load_entries(site_sql.PulpRepository, repos)
+            self.changed_repo_ids = set(repo["repo_id"] for repo in repos)
+            return
+        previous_repos = dict((repo.repo_id, repo)
+                                  for repo in previous.query_repos())
+        repos.extend(self._update_mirror_repos(previous, previous_repos))
+        self._load_entries(site_sql.PulpRepository, repos)
+        repo_configs = ((repo["repo_id"], repo["config"]) for repo in repos)
+        self.changed_repo_ids = self._find_changed_repo_ids(previous_repos,
+                                                            repo_configs)
+
+    def _find_changed_repo_ids(self, previous_repos, repo_configs):
+        changed_repo_ids = set(previous_repos)
+        for repo_id, config in repo_configs:
+            previous_repo = previous_repos.get(repo_id)
+            if previous_repo is not None and previous_repo.config == config:
+                changed_repo_ids.discard(repo_id)
+            else:
+                changed_repo_ids.add(repo_id)
+        return changed_repo_ids
 
-    def _store_repo(self, config):
+    def _load_entries(self, model, entries):
+        """Adds entries to the DB in a single transaction
+
+           If that fails, the entries are added again one at a time to
+           find the one that is causing the problem.
+        """
+        if not entries:
+            return
         db_session = self._get_db_session()
-        db_session.add(site_sql.PulpRepository.from_mapping(config))
+        db_session.add_all([model.from_mapping(data) for data in entries])
         try:
             db_session.commit()
-        except site_sql.IntegrityError as exc:
-            validation.fail_validation(exc)
+            return
+        except (site_sql.IntegrityError, site_sql.FlushError) as exc:
+            bulk_error = exc
+            db_session.rollback()
+        for data in entries:
+            entry = model.from_mapping(data)
+            db_session.add(entry)
+            try:
+                db_session.flush()
+            except (site_sql.IntegrityError, site_sql.FlushError) as exc:
+                db_session.rollback()
+                validation.fail_validation("{0}", exc)
+            # Let the DB (rather than the session) report duplicates
+            db_session.expunge(entry)
+        db_session.rollback()
+        validation.fail_validation("{0}", bulk_error)
 
     def _convert_raw_repos(self):
         raw_repos = self.config["RAW_REPOS"]
+        repos = []
         for repo_data in raw_repos:
             repo_details = {
                 "repo_id": repo_data["repo_id"],
                 "config": repo_data,
             }
-            self._store_repo(repo_details)
+            repos.append(repo_details)
+        return repos
 
     def _convert_mirror(self, mirror):
         raw_data = mirror_config.make_repo(mirror)
@@ -231,19 +329,198 @@ class SiteConfig(validation.ValidatedConfig):
         repo_details = repo_data["notes"]["pulpdist"].copy()
         repo_details["repo_id"] = repo_data["repo_id"]
         repo_details["config"] = repo_data
-        self._store_repo(repo_details)
+        return repo_details
 
     def _convert_mirrors(self):
         mirrors = self.query_mirrors()
-        for m in mirrors:
-            self._convert_mirror(m)
+        return [self._convert_mirror(m) for m in mirrors]
+
+    def _get_entry_key(self, section, entry):
+        return tuple(entry.get(field) for field in self._ENTRY_KEYS[section])
+
+    def _index_entries(self, section, config):
+        return dict((self._get_entry_key(section, entry), entry)
+                        for entry in config[section])
+
+    def _find_changed_entries(self, previous):
+        """Returns the keys of added, removed or modified entries by section"""
+        changed = {}
+        for section in self._ENTRY_KEYS:
+            old_entries = self._index_entries(section, previous.config)
+            new_entries = self._index_entries(section, self.config)
+            modified = set(key for key, entry in new_entries.iteritems()
+                                 if old_entries.get(key) != entry)
+            modified.update(key for key in old_entries if key not in new_entries)
+            changed[section] = modified
+        return changed
+
+    def _update_mirror_repos(self, previous, previous_repos):
+        """Regenerates repo details for mirrors affected by changes"""
+        changed = self._find_changed_entries(previous)
+        trees = self._index_entries(u"REMOTE_TREES", self.config)
+        sources = self._index_entries(u"REMOTE_SOURCES", self.config)
+        default_site_changed = (u"default",) in changed[u"SITE_SETTINGS"]
+        db_session = self._get_db_session()
+        repos = []
+        for mirror in self.config[u"LOCAL_MIRRORS"]:
+            mirror_key = self._get_entry_key(u"LOCAL_MIRRORS", mirror)
+            repo_id = mirror_config.make_repo_id(*mirror_key)
+            previous_repo = previous_repos.get(repo_id)
+            tree_key = (mirror[u"tree_id"],)
+            source_key = (trees[tree_key][u"source_id"],)
+            server_key = (sources[source_key][u"server_id"],)
+            affected = (previous_repo is None or default_site_changed or
+                        mirror_key in changed[u"LOCAL_MIRRORS"] or
+                        tree_key in changed[u"REMOTE_TREES"] or
+                        source_key in changed[u"REMOTE_SOURCES"] or
+                        server_key in changed[u"REMOTE_SERVERS"] or
+                        (mirror[u"site_id"],) in changed[u"SITE_SETTINGS"])
+            if affected:
+                local_mirror = db_session.query(site_sql.LocalMirror).get(mirror_key)
+                repos.append(self._convert_mirror(local_mirror))
+            else:
+                repos.append(dict((field, getattr(previous_repo, field))
+                                    for field in site_sql.PulpRepository._FIELDS))
+        return repos
+
+    def _validate_changed_entries(self, previous):
+        # Check the overall structure, then any new or modified entries
+        sections = dict((section, validation.check_sequence(_accept_entry))
+                            for section in self._SPEC)
+        validation.check_mapping(sections, self._ALLOW_NONE,
+                                 self._ALLOW_EXTRA)(self.config, "config")
+        for section, (spec,) in self._SPEC.items():
+            old_entries = self._index_entries(section, previous.config)
+            check_entry = spec.check()
+            setting = "config[{0!r}]".format(section)
+            for i, entry in enumerate(self.config[section]):
+                if isinstance(entry, dict):
+                    old_entry = old_entries.get(self._get_entry_key(section, entry))
+                    if old_entry == entry:
+                        continue
+                check_entry(entry, setting + "[{0}]".format(i))
+
+    def _get_previous(self):
+        previous = self.previous
+        if previous is not None and previous._db_session_factory is None:
+            previous.validate()
+        return previous
 
     def _validate_spec(self):
-        super(SiteConfig, self).validate()
+        previous = self._get_previous()
+        if previous is None:
+            super(SiteConfig, self).validate()
+        else:
+            self._validate_changed_entries(previous)
+
+    def get_cache_key(self):
+        """Returns a hash of the canonical JSON form of the config
+
+           The hash also covers the DB schema and PulpDist versions. Returns
+           None if the config can't be serialised as JSON.
+        """
+        try:
+            canonical = json.dumps(self.config, sort_keys=True,
+                                   separators=(",", ":"))
+        except (TypeError, ValueError):
+            return None
+        key = hashlib.sha256(canonical)
+        key.update("\0{0}\0{1}".format(site_sql.SCHEMA_VERSION, util.__version__))
+        return key.hexdigest()
+
+    def _get_cached_db_path(self):
+        cache_dir = self.cache_dir
+        if cache_dir is None:
+            return None
+        cache_key = self.get_cache_key()
+        if cache_key is None:
+            return None
+        if not os.path.isdir(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError as ex:
+                if ex.errno != errno.EEXIST:
+                    # Just run without the cache
+                    return None
+        return os.path.join(cache_dir,
+                            _CACHED_DB_PREFIX + cache_key + _CACHED_DB_SUFFIX)
+
+    def _open_cached_db(self, db_path):
+        """Uses a previously saved site DB, returning False if there isn't one"""
+        if not os.path.exists(db_path):
+            return False
+        try:
+            # Record the use, so the DB isn't pruned from the cache
+            os.utime(db_path, None)
+        except OSError:
+            pass
+        self._db_session_factory = site_sql.file_db(db_path)
+        previous = self._get_previous()
+        if previous is None:
+            db_session = self._get_db_session()
+            repo_ids = db_session.query(site_sql.PulpRepository.repo_id)
+            self.changed_repo_ids = set(repo_id for (repo_id,) in repo_ids)
+        else:
+            previous_repos = dict((repo.repo_id, repo)
+                                      for repo in previous.query_repos())
+            repo_configs = ((repo.repo_id, repo.config)
+                                for repo in self.query_repos())
+            self.changed_repo_ids = self._find_changed_repo_ids(previous_repos,
+                                                                repo_configs)
+        return True
+
+    def _build_cached_db(self, db_path):
+        """Validates the config, saving the populated site DB as db_path"""
+        cache_dir = os.path.dirname(db_path)
+        try:
+            fd, build_path = tempfile.mkstemp(dir=cache_dir, prefix=".site-",
+                                              suffix=_CACHED_DB_SUFFIX)
+        except OSError:
+            # Just run without the cache
+            self._validate_spec()
+            self._populate_db()
+            return
+        os.close(fd)
+        self._db_build_path = build_path
+        try:
+            self._validate_spec()
+            self._populate_db()
+            os.rename(build_path, db_path)
+        except:
+            try:
+                os.unlink(build_path)
+            except OSError as ex:
+                if ex.errno != errno.ENOENT:
+                    raise
+            raise
+        finally:
+            self._db_build_path = None
+        self._db_session_factory = site_sql.file_db(db_path)
+        self._prune_cache(cache_dir)
+
+    def _prune_cache(self, cache_dir):
+        cached = []
+        for name in os.listdir(cache_dir):
+            if name.startswith(_CACHED_DB_PREFIX) and name.endswith(_CACHED_DB_SUFFIX):
+                db_path = os.path.join(cache_dir, name)
+                try:
+                    cached.append((os.path.getmtime(db_path), db_path))
+                except OSError:
+                    continue
+        cached.sort(reverse=True)
+        for __, db_path in cached[_MAX_CACHED_DBS:]:
+            try:
+                os.unlink(db_path)
+            except OSError:
+                pass
 
     def validate(self):
-        self._validate_spec()
-        self._populate_db()
+        db_path = self._get_cached_db_path()
+        if db_path is None:
+            self._validate_spec()
+            self._populate_db()
+        elif not self._open_cached_db(db_path):
+            self._build_cached_db(db_path)
 
     def query_mirrors(self, *args, **kwds):
         """Returns an SQLAlchemy query result. See site_sql.query_mirrors"""
@@ -12,21 +12,53 @@
 """SQL definitions for site configuration database definition"""
 
 
+import json
+
 import sqlalchemy as sqla
+from sqlalchemy import event
 from sqlalchemy.sql import or_
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relation, backref
+from sqlalchemy.orm.exc import FlushError
 from sqlalchemy.orm.collections import attribute_mapped_collection
 
 from . import util
 
+# Changes to the schema must increment this to invalidate cached site DBs
+SCHEMA_VERSION = 2
+
 def _linked_from(target, backref_attr, backref_key):
     return relation(target, backref=backref(backref_attr,
                     collection_class=attribute_mapped_collection(backref_key)))
 
 Base = declarative_base()
 
+class JSONType(sqla.types.TypeDecorator):
+    """Stores JSON compatible data structures as JSON text"""
+    impl = sqla.Text
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return json.dumps(value, sort_keys=True)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return json.loads(value)
+
+def _add_in_filters(filters, column, values):
+    """Adds an IN predicate matching any of the given values
+
+       Each value is still a separate query parameter, so the total number
+       of values across all filters is limited by SQLite (to 999 in
+       versions prior to 3.32.0).
+    """
+    values = list(values)
+    if values:
+        filters.append(column.in_(values))
+
 class FieldsMixin(object):
     _FIELDS = []
 
@@ -61,7 +93,8 @@ class RemoteSource(Base, FieldsMixin):
     __tablename__ = "remote_sources"
     _FIELDS = "source_id server_id name remote_path listing_suffix".split()
     source_id = sqla.Column(sqla.String, primary_key=True)
-    server_id = sqla.Column(sqla.String, sqla.ForeignKey("remote_servers.server_id"))
+    server_id = sqla.Column(sqla.String, sqla.ForeignKey("remote_servers.server_id"),
+                            index=True)
     server = _linked_from(RemoteServer, "sources", "source_id")
     name = sqla.Column(sqla.String, nullable=False)
     remote_path = sqla.Column(sqla.String, nullable=False)
@@ -75,32 +108,36 @@ class RemoteTree(Base, FieldsMixin):
                  listing_pattern listing_prefix latest_link
                  exclude_from_listing listing_filters""".split()
     tree_id = sqla.Column(sqla.String, primary_key=True)
-    source_id = sqla.Column(sqla.String, sqla.ForeignKey("remote_sources.source_id"))
+    source_id = sqla.Column(sqla.String, sqla.ForeignKey("remote_sources.source_id"),
+                            index=True)
     source = _linked_from(RemoteSource, "trees", "tree_id")
     name = sqla.Column(sqla.String, nullable=False)
     description = sqla.Column(sqla.String, server_default="")
     tree_path = sqla.Column(sqla.String, nullable=False)
     sync_hours = sqla.Column(sqla.Integer)
     sync_type = sqla.Column(sqla.String)
-    exclude_from_sync = sqla.Column(sqla.PickleType)
-    sync_filters = sqla.Column(sqla.PickleType)
+    exclude_from_sync = sqla.Column(JSONType)
+    sync_filters = sqla.Column(JSONType)
     listing_pattern = sqla.Column(sqla.String)
     listing_prefix = sqla.Column(sqla.String)
     latest_link = sqla.Column(sqla.String)
-    exclude_from_listing = sqla.Column(sqla.PickleType)
-    listing_filters = sqla.Column(sqla.PickleType)
+    exclude_from_listing = sqla.Column(JSONType)
+    listing_filters = sqla.Column(JSONType)
 
 
 class SiteSettings(Base, FieldsMixin):
     __tablename__ = "site_settings"
     _FIELDS = """site_id name storage_prefix
                  exclude_from_sync exclude_from_listing
-                 server_prefixes source_prefixes""".split()
+                 server_prefixes source_prefixes dedupe_index
+                 bandwidth_budget""".split()
     site_id = sqla.Column(sqla.String, nullable=False, primary_key=True)
     name = sqla.Column(sqla.String, nullable=False)
     storage_prefix = sqla.Column(sqla.String, nullable=False)
-    exclude_from_sync = sqla.Column(sqla.PickleType)
-    exclude_from_listing = sqla.Column(sqla.PickleType)
+    dedupe_index = sqla.Column(sqla.String)
+    bandwidth_budget = sqla.Column(sqla.Integer)
+    exclude_from_sync = sqla.Column(JSONType)
+    exclude_from_listing = sqla.Column(JSONType)
 
     @property
     def server_prefixes(self):
@@ -159,20 +196,21 @@ class LocalMirror(Base, FieldsMixin):
                  notes enabled dry_run_only
                  delete_old_dirs sync_latest_only""".split()
     mirror_id = sqla.Column(sqla.String, primary_key=True)
-    tree_id = sqla.Column(sqla.String, sqla.ForeignKey("remote_trees.tree_id"))
+    tree_id = sqla.Column(sqla.String, sqla.ForeignKey("remote_trees.tree_id"),
+                          index=True)
     tree = relation(RemoteTree, backref=backref("mirrors", order_by=mirror_id))
     site_id = sqla.Column(sqla.String, sqla.ForeignKey("site_settings.site_id"),
-                          primary_key=True)
+                          primary_key=True, index=True)
     site = relation(SiteSettings, backref=backref("mirrors", order_by=mirror_id),
                     primaryjoin = SiteSettings.site_id == site_id)
     name = sqla.Column(sqla.String)
     description = sqla.Column(sqla.String)
     mirror_path = sqla.Column(sqla.String)
-    exclude_from_sync = sqla.Column(sqla.PickleType)
-    sync_filters = sqla.Column(sqla.PickleType)
-    exclude_from_listing = sqla.Column(sqla.PickleType)
-    listing_filters = sqla.Column(sqla.PickleType)
-    notes = sqla.Column(sqla.PickleType)
+    exclude_from_sync = sqla.Column(JSONType)
+    sync_filters = sqla.Column(JSONType)
+    exclude_from_listing = sqla.Column(JSONType)
+    listing_filters = sqla.Column(JSONType)
+    notes = sqla.Column(JSONType)
     enabled = sqla.Column(sqla.Boolean, default=False)
     dry_run_only = sqla.Column(sqla.Boolean, default=False)
     delete_old_dirs = sqla.Column(sqla.Boolean, default=False)
@@ -196,13 +234,16 @@ class PulpRepository(Base, FieldsMixin):
     _FIELDS = """repo_id mirror_id site_id tree_id source_id
                  server_id sync_hours config""".split()
     repo_id = sqla.Column(sqla.String, primary_key=True)
-    mirror_id = sqla.Column(sqla.String)
-    site_id = sqla.Column(sqla.String)
-    tree_id = sqla.Column(sqla.String, sqla.ForeignKey("remote_trees.tree_id"))
-    source_id = sqla.Column(sqla.String, sqla.ForeignKey("remote_sources.source_id"))
-    server_id = sqla.Column(sqla.String, sqla.ForeignKey("remote_servers.server_id"))
+    mirror_id = sqla.Column(sqla.String, index=True)
+    site_id = sqla.Column(sqla.String, index=True)
+    tree_id = sqla.Column(sqla.String, sqla.ForeignKey("remote_trees.tree_id"),
+                          index=True)
+    source_id = sqla.Column(sqla.String, sqla.ForeignKey("remote_sources.source_id"),
+                            index=True)
+    server_id = sqla.Column(sqla.String, sqla.ForeignKey("remote_servers.server_id"),
+                            index=True)
     sync_hours = sqla.Column(sqla.Integer)
-    config = sqla.Column(sqla.PickleType)
+    config = sqla.Column(JSONType)
 
 
 def query_mirrors(session, mirrors=(), trees=(), sources=(), servers=(), sites=()):
@@ -211,21 +252,16 @@ def query_mirrors(session, mirrors=(), trees=(), sources=(), servers=(), sites=(
     """
     query = session.query(LocalMirror)
     filters = []
-    for mirror in mirrors:
-        filters.append(LocalMirror.mirror_id == mirror)
-    for tree in trees:
-        filters.append(LocalMirror.tree_id == tree)
-    for site in sites:
-        filters.append(LocalMirror.site_id == site)
+    _add_in_filters(filters, LocalMirror.mirror_id, mirrors)
+    _add_in_filters(filters, LocalMirror.tree_id, trees)
+    _add_in_filters(filters, LocalMirror.site_id, sites)
     if sources or servers:
         query = query.join(RemoteTree)
         query = query.join(RemoteSource)
-        for source in sources:
-            filters.append(RemoteSource.source_id == source)
+        _add_in_filters(filters, RemoteSource.source_id, sources)
         if servers:
             query = query.join(RemoteServer)
-            for server in servers:
-                filters.append(RemoteServer.server_id == server)
+            _add_in_filters(filters, RemoteServer.server_id, servers)
     if filters:
         if len(filters) == 1:
             qfilter = filters[0]
@@ -241,18 +277,12 @@ def query_repos(session, repos=(), mirrors=(), trees=(), sources=(), servers=(),
     """
     query = session.query(PulpRepository)
     filters = []
-    for repo in repos:
-        filters.append(PulpRepository.repo_id == repo)
-    for mirror in mirrors:
-        filters.append(PulpRepository.mirror_id == mirror)
-    for tree in trees:
-        filters.append(PulpRepository.tree_id == tree)
-    for site in sites:
-        filters.append(PulpRepository.site_id == site)
-    for source in sources:
-        filters.append(PulpRepository.source_id == source)
-    for server in servers:
-        filters.append(PulpRepository.server_id == server)
+    _add_in_filters(filters, PulpRepository.repo_id, repos)
+    _add_in_filters(filters, PulpRepository.mirror_id, mirrors)
+    _add_in_filters(filters, PulpRepository.tree_id, trees)
+    _add_in_filters(filters, PulpRepository.site_id, sites)
+    _add_in_filters(filters, PulpRepository.source_id, sources)
+    _add_in_filters(filters, PulpRepository.server_id, servers)
     if filters:
         if len(filters) == 1:
             qfilter = filters[0]
@@ -262,13 +292,34 @@ def query_repos(session, repos=(), mirrors=(), trees=(), sources=(), servers=(),
     return query
 
 
-def in_memory_db():
-    engine = sqla.create_engine("sqlite:///:memory:")
-    site_db = Base.metadata
-    site_db.create_all(engine)
+def _make_session_factory(engine):
     Session = sessionmaker(engine)
     def _get_session():
         db_session = Session()
         db_session.execute('pragma foreign_keys=on')
         return db_session
     return _get_session
+
+def in_memory_db():
+    engine = sqla.create_engine("sqlite:///:memory:")
+    site_db = Base.metadata
+    site_db.create_all(engine)
+    return _make_session_factory(engine)
+
+def file_db(db_path, create=False):
+    """Returns a session factory for a site DB stored in an SQLite file
+
+       If create is true, the schema is created first, and changes aren't
+       synced to disk as they are made (so the file should only be moved
+       into place once it has been fully populated).
+    """
+    engine = sqla.create_engine("sqlite:///" + db_path)
+    if create:
+        @event.listens_for(engine, "connect")
+        def _fast_writes(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            cursor.execute("pragma journal_mode=memory")
+            cursor.execute("pragma synchronous=off")
+            cursor.close()
+        Base.metadata.create_all(engine)
+    return _make_session_factory(engine)
@@ -0,0 +1,331 @@
+#
+# Copyright (C) 2012 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+"""Local time series store for sync statistics
+
+The importer records the result and statistics of every sync run in an
+SQLite database. Hourly and daily rollups are maintained for each repo,
+remote server and site as runs are recorded, so trends can be reported
+without retrieving and scanning the full sync history of each repo.
+"""
+
+import calendar
+import collections
+import contextlib
+import os
+import sqlite3
+import time
+
+from .sync_trees import SyncStats
+
+DEFAULT_STATS_DB = "/var/lib/pulpdist/sync_stats.sqlite"
+
+# Rollup periods and their length in seconds
+ROLLUP_PERIODS = {
+    "hour": 60 * 60,
+    "day": 24 * 60 * 60,
+}
+
+ROLLUP_SCOPES = ("repo", "server", "site")
+
+_SUCCESSFUL_RESULTS = ("SYNC_COMPLETED", "SYNC_UP_TO_DATE")
+_FAILED_RESULTS = ("SYNC_FAILED", "SYNC_PARTIAL")
+_IGNORED_RESULTS = ("SYNC_DISABLED",)
+
+_LOCK_TIMEOUT_SECONDS = 300
+
+# Increment when the rollups table changes. Rollups are rebuilt from the
+# recorded runs when an older database is opened.
+_SCHEMA_VERSION = 2
+
+_STATS_COLUMNS = ", ".join("{0} REAL".format(field) for field in SyncStats._fields)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sync_runs (
+    repo_id TEXT,
+    server_id TEXT,
+    site_id TEXT,
+    result TEXT,
+    start_time REAL,
+    finish_time REAL,
+    duration REAL,
+    {0}
+);
+CREATE INDEX IF NOT EXISTS sync_runs_by_repo ON sync_runs (repo_id, start_time);
+""".format(_STATS_COLUMNS)
+
+# Duration and tree size totals only include successful runs, while the
+# transferred and received bytes include all runs
+_ROLLUPS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS rollups (
+    period TEXT,
+    bucket INTEGER,
+    scope TEXT,
+    key TEXT,
+    runs INTEGER,
+    failures INTEGER,
+    successes INTEGER,
+    total_duration REAL,
+    max_duration REAL,
+    total_tree_bytes REAL,
+    transferred_bytes REAL,
+    received_bytes REAL,
+    PRIMARY KEY (period, bucket, scope, key)
+)
+"""
+
+Rollup = collections.namedtuple("Rollup", """
+    period bucket scope key runs failures successes total_duration
+    max_duration total_tree_bytes transferred_bytes received_bytes
+""".split())
+
+_ROLLUP_COLUMNS = ", ".join(Rollup._fields)
+
+# Averages are per successful run, while changes compare the averages for
+# the most recent half of the reporting window with those for the earlier
+# half (None if either half has no successful runs)
+Trend = collections.namedtuple("Trend", """
+    scope key runs failures avg_duration duration_change
+    avg_tree_bytes tree_bytes_change
+""".split())
+
+def _timestamp(dt):
+    return calendar.timegm(dt.utctimetuple()) + dt.microsecond / 1e6
+
+def _change(earlier, later):
+    if not earlier:
+        return None
+    return (later - earlier) / earlier
+
+def _sql_values(values):
+    return ",".join("'{0}'".format(value) for value in values)
+
+
+class SyncStatsHistory(object):
+    """Time series of sync results and statistics
+
+       db_path: the SQLite database used to store the history
+                (defaults to DEFAULT_STATS_DB)
+    """
+
+    def __init__(self, db_path=None):
+        if db_path is None:
+            db_path = DEFAULT_STATS_DB
+        self.db_path = db_path
+        self._db = None
+
+    def open(self):
+        db_dir = os.path.dirname(self.db_path)
+        if db_dir and not os.path.isdir(db_dir):
+            os.makedirs(db_dir)
+        db = sqlite3.connect(self.db_path, timeout=_LOCK_TIMEOUT_SECONDS)
+        db.executescript(_SCHEMA)
+        self._db = db
+        self._add_stats_columns()
+        if db.execute("PRAGMA user_version").fetchone()[0] != _SCHEMA_VERSION:
+            self._rebuild_rollups()
+
+    def _get_run_columns(self):
+        return set(row[1] for row in self._db.execute("PRAGMA table_info(sync_runs)"))
+
+    def _add_stats_columns(self):
+        # Databases created before a SyncStats field was added lack its column
+        for field in SyncStats._fields:
+            if field in self._get_run_columns():
+                continue
+            try:
+                with self._db:
+                    self._db.execute("ALTER TABLE sync_runs ADD COLUMN {0} REAL".format(field))
+            except sqlite3.OperationalError:
+                # Another process may have added it first
+                if field not in self._get_run_columns():
+                    raise
+
+    def _rebuild_rollups(self):
+        """Recreate the rollups table from the recorded sync runs"""
+        db = sqlite3.connect(self.db_path, timeout=_LOCK_TIMEOUT_SECONDS,
+                             isolation_level=None)
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                # Another process may have already rebuilt the rollups
+                if db.execute("PRAGMA user_version").fetchone()[0] != _SCHEMA_VERSION:
+                    db.execute("DROP TABLE IF EXISTS rollups")
+                    db.execute(_ROLLUPS_SCHEMA)
+                    for period, seconds in sorted(ROLLUP_PERIODS.items()):
+                        for scope in ROLLUP_SCOPES:
+                            self._rebuild_scope(db, period, seconds, scope)
+                    db.execute("PRAGMA user_version = {0:d}".format(_SCHEMA_VERSION))
+            except:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+        finally:
+            db.close()
+
+    def _rebuild_scope(self, db, period, seconds, scope):
+        succeeded = "result IN ({0})".format(_sql_values(_SUCCESSFUL_RESULTS))
+        failed = "result IN ({0})".format(_sql_values(_FAILED_RESULTS))
+        query = """
+            INSERT INTO rollups ({columns})
+            SELECT ?, CAST(start_time / ? AS INTEGER) * ? AS run_bucket, ?,
+                   {scope}_id, COUNT(*), SUM({failed}), SUM({succeeded}),
+                   SUM(CASE WHEN {succeeded} THEN duration ELSE 0 END),
+                   MAX(CASE WHEN {succeeded} THEN duration ELSE 0 END),
+                   SUM(CASE WHEN {succeeded} THEN total_bytes ELSE 0 END),
+                   SUM(transferred_bytes), SUM(received_bytes)
+            FROM sync_runs
+            WHERE {scope}_id IS NOT NULL AND result NOT IN ({ignored})
+            GROUP BY run_bucket, {scope}_id
+        """.format(columns=_ROLLUP_COLUMNS, scope=scope, failed=failed,
+                   succeeded=succeeded, ignored=_sql_values(_IGNORED_RESULTS))
+        db.execute(query, (period, seconds, seconds, scope))
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    @contextlib.contextmanager
+    def opened(self):
+        self.open()
+        try:
+            yield self
+        finally:
+            self.close()
+
+    def record(self, repo_id, result, start_time, finish_time, stats,
+               server_id=None, site_id=None):
+        """Record a sync run and update the rollups that include it
+
+           start_time and finish_time are naive UTC datetime objects
+           (as returned by run_sync()). Runs of disabled trees are ignored.
+        """
+        if result in _IGNORED_RESULTS:
+            return
+        start = _timestamp(start_time)
+        duration = _timestamp(finish_time) - start
+        failures = 1 if result in _FAILED_RESULTS else 0
+        if result in _SUCCESSFUL_RESULTS:
+            successes = 1
+            success_duration = duration
+            tree_bytes = stats.total_bytes
+        else:
+            successes = success_duration = tree_bytes = 0
+        columns = ("repo_id", "server_id", "site_id", "result",
+                   "start_time", "finish_time", "duration") + SyncStats._fields
+        placeholders = ",".join("?" * len(columns))
+        keys = zip(ROLLUP_SCOPES, (repo_id, server_id, site_id))
+        with self._db:
+            self._db.execute("INSERT INTO sync_runs ({0}) VALUES ({1})".format(
+                                 ", ".join(columns), placeholders),
+                             (repo_id, server_id, site_id, result,
+                              start, start + duration, duration) + tuple(stats))
+            for period, seconds in sorted(ROLLUP_PERIODS.items()):
+                bucket = int(start // seconds) * seconds
+                for scope, key in keys:
+                    if key is None:
+                        continue
+                    self._db.execute(
+                        "INSERT OR IGNORE INTO rollups ({0})"
+                        " VALUES (?,?,?,?,0,0,0,0,0,0,0,0)".format(_ROLLUP_COLUMNS),
+                        (period, bucket, scope, key))
+                    self._db.execute(
+                        "UPDATE rollups SET runs=runs+1, failures=failures+?,"
+                        " successes=successes+?,"
+                        " total_duration=total_duration+?,"
+                        " max_duration=MAX(max_duration, ?),"
+                        " total_tree_bytes=total_tree_bytes+?,"
+                        " transferred_bytes=transferred_bytes+?,"
+                        " received_bytes=received_bytes+?"
+                        " WHERE period=? AND bucket=? AND scope=? AND key=?",
+                        (failures, successes, success_duration, success_duration,
+                         tree_bytes, stats.transferred_bytes,
+                         stats.received_bytes, period, bucket, scope, key))
+
+    def iter_rollups(self, period="day", scope="repo", since=None, keys=None):
+        """Yields Rollup entries in (key, bucket) order
+
+           since: if given, only buckets starting at or after this
+                  timestamp are included
+           keys: if given, only rollups for these keys are included
+        """
+        if period not in ROLLUP_PERIODS:
+            raise ValueError("Unknown rollup period {0!r}".format(period))
+        if scope not in ROLLUP_SCOPES:
+            raise ValueError("Unknown rollup scope {0!r}".format(scope))
+        query = "SELECT {0} FROM rollups WHERE period=? AND scope=?".format(_ROLLUP_COLUMNS)
+        params = [period, scope]
+        if since is not None:
+            query += " AND bucket>=?"
+            params.append(since)
+        query += " ORDER BY key, bucket"
+        if keys is not None:
+            keys = set(keys)
+        for row in self._db.execute(query, params):
+            rollup = Rollup(*row)
+            if keys is None or rollup.key in keys:
+                yield rollup
+
+    def get_trends(self, period="day", scope="repo", num_buckets=7,
+                   keys=None, now=None):
+        """Returns a list of Trend entries covering the last 2*num_buckets periods
+
+           Average durations and tree sizes only reflect successful runs, so
+           failed runs don't make a tree appear to get faster or smaller.
+           Entries are sorted with the largest increase in average duration
+           first, followed by entries without enough data to compare.
+        """
+        if now is None:
+            now = time.time()
+        seconds = ROLLUP_PERIODS.get(period)
+        if seconds is None:
+            raise ValueError("Unknown rollup period {0!r}".format(period))
+        current_bucket = int(now // seconds) * seconds
+        midpoint = current_bucket - (num_buckets - 1) * seconds
+        since = midpoint - num_buckets * seconds
+        totals = {}
+        for rollup in self.iter_rollups(period, scope, since, keys):
+            halves = totals.setdefault(rollup.key, ([0, 0, 0, 0.0, 0.0],
+                                                    [0, 0, 0, 0.0, 0.0]))
+            half = halves[rollup.bucket >= midpoint]
+            half[0] += rollup.runs
+            half[1] += rollup.failures
+            half[2] += rollup.successes
+            half[3] += rollup.total_duration
+            half[4] += rollup.total_tree_bytes
+        trends = []
+        for key, (earlier, later) in totals.items():
+            runs = earlier[0] + later[0]
+            averages = []
+            for half in (earlier, later):
+                if half[2]:
+                    averages.append((half[3] / half[2], half[4] / half[2]))
+                else:
+                    averages.append((None, None))
+            (early_duration, early_size), (late_duration, late_size) = averages
+            if late_duration is None:
+                avg_duration, avg_size = early_duration, early_size
+                duration_change = size_change = None
+            else:
+                avg_duration, avg_size = late_duration, late_size
+                duration_change = size_change = None
+                if early_duration is not None:
+                    duration_change = _change(early_duration, late_duration)
+                    size_change = _change(early_size, late_size)
+            trends.append(Trend(scope, key, runs, earlier[1] + later[1],
+                                avg_duration, duration_change,
+                                avg_size, size_change))
+        def _sort_key(trend):
+            change = trend.duration_change
+            return (change is None, -(change or 0), trend.key)
+        trends.sort(key=_sort_key)
+        return trends
@@ -36,6 +36,14 @@ class TreeSyncConfig(validation.ValidatedConfig):
         u"old_remote_daemon": validation.check_type(int),
         u"rsync_port": validation.check_type(int, allow_none=True),
         u"enabled": validation.check_type(int),
+        u"dedupe_index_path": validation.check_path(allow_none=True),
+        u"parallel_streams": validation.check_type(int),
+        u"bandwidth_budget": validation.check_type(int),
+        u"manifest_name": validation.check_path(allow_none=True),
+        u"manifest_full_sync_days": validation.check_type(int),
+        u"compress_sync_log": validation.check_type(int),
+        u"max_log_output_lines": validation.check_type(int),
+        u"log_sync_events": validation.check_type(int),
     }
     _DEFAULTS = {
         u"exclude_from_sync": (),
@@ -45,6 +53,14 @@ class TreeSyncConfig(validation.ValidatedConfig):
         u"old_remote_daemon": False,
         u"rsync_port": None,
         u"enabled": False,
+        u"dedupe_index_path": None,
+        u"parallel_streams": 1,
+        u"bandwidth_budget": 0,
+        u"manifest_name": None,
+        u"manifest_full_sync_days": 7,
+        u"compress_sync_log": False,
+        u"max_log_output_lines": 0,
+        u"log_sync_events": False,
     }
 
 class VersionedSyncConfig(TreeSyncConfig):
@@ -53,27 +69,46 @@ class VersionedSyncConfig(TreeSyncConfig):
         u"exclude_from_listing": validation.check_rsync_filter_sequence(),
         u"listing_filters": validation.check_rsync_filter_sequence(),
         u"delete_old_dirs": validation.check_type(int),
+        u"trash_old_dirs": validation.check_type(int),
+        u"reaper_python": validation.check_path(allow_none=True),
+        u"max_parallel_fetches": validation.check_type(int),
     })
     _DEFAULTS = _updated(TreeSyncConfig._DEFAULTS, {
         u"listing_pattern": u'*',
         u"exclude_from_listing": (),
         u"listing_filters": (),
         u"delete_old_dirs": False,
+        u"trash_old_dirs": False,
+        u"reaper_python": None,
+        u"max_parallel_fetches": 1,
     })
 
 class SnapshotSyncConfig(VersionedSyncConfig):
+    DEFAULT_EXCLUDES = [u"STATUS", u".STATUS"]
     _SPEC = _updated(VersionedSyncConfig._SPEC, {
         u"latest_link_name": validation.check_path(allow_none=True),
         u"sync_latest_only": validation.check_type(int),
+        u"staged_publication": validation.check_type(int),
     })
     _DEFAULTS = _updated(VersionedSyncConfig._DEFAULTS, {
         u"latest_link_name": None,
         u"sync_latest_only": False,
+        u"staged_publication": False,
     })
 
     def __init__(self, config=None):
         super(SnapshotSyncConfig, self).__init__(config)
         exclude_from_sync = list(self.config[u"exclude_from_sync"])
-        exclude_from_sync += [u"STATUS", u".STATUS"]
+        exclude_from_sync += self.DEFAULT_EXCLUDES
         self.config[u"exclude_from_sync"] = exclude_from_sync
 
+class SnapshotDeltaSyncConfig(SnapshotSyncConfig):
+    _SPEC = _updated(SnapshotSyncConfig._SPEC, {
+        u"delta_path": validation.check_path(),
+    })
+
+class DeltaSyncConfig(SnapshotSyncConfig):
+    _SPEC = _updated(SnapshotSyncConfig._SPEC, {
+        u"remote_delta_path": validation.check_remote_path(),
+    })
+
@@ -0,0 +1,176 @@
+#
+# Copyright (C) 2012 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+"""Run many tree sync operations concurrently in a single process
+
+Each sync command still drives rsync synchronously, so the supervisor runs
+them on a bounded pool of worker threads. The sync commands are unmodified,
+so they produce exactly the same results as when run individually.
+"""
+
+import collections
+import sys
+import threading
+import traceback
+from datetime import datetime
+import Queue
+
+from .sync_trees import SyncCancelled
+
+DEFAULT_MAX_CONCURRENT_SYNCS = 4
+
+# Allows KeyboardInterrupt to be handled while waiting for the workers
+_JOIN_POLL_SECONDS = 0.5
+
+# sync_info is the result of run_sync() (or None if an exception was
+# raised), while exc_info is the exception details (or None on success)
+SupervisedResult = collections.namedtuple("SupervisedResult",
+                                          "sync_info exc_info")
+
+
+class SyncSupervisor(object):
+    """Runs sync commands concurrently with bounded concurrency
+
+       max_concurrent_syncs: the maximum number of commands run at once
+       log_dest: file or path for the supervisor log, which records when
+                 each command starts and finishes (each command continues
+                 to write its detailed output to its own run log)
+    """
+
+    def __init__(self, max_concurrent_syncs=DEFAULT_MAX_CONCURRENT_SYNCS,
+                 log_dest=None):
+        if max_concurrent_syncs < 1:
+            raise ValueError("max_concurrent_syncs must be at least 1")
+        self.max_concurrent_syncs = max_concurrent_syncs
+        if isinstance(log_dest, basestring):
+            # Use line buffered output by default
+            log_dest = open(log_dest, 'a', 1)
+        self._log_file = log_dest
+        self._lock = threading.RLock()
+        self._commands = {}
+        self._order = []
+        self._running = set()
+        self._cancelled = set()
+        self._results = {}
+        self._started = False
+
+    def _log(self, _fmt, *args):
+        if self._log_file is None:
+            return
+        msg = "{0} {1}".format(datetime.utcnow(), _fmt.format(*args))
+        with self._lock:
+            self._log_file.write(msg.rstrip() + '\n')
+            self._log_file.flush()
+
+    def add(self, name, command):
+        """Add a sync command to be executed by run()"""
+        with self._lock:
+            if self._started:
+                raise RuntimeError("Cannot add commands after run() is called")
+            if name in self._commands:
+                raise ValueError("Duplicate sync name {0!r}".format(name))
+            self._commands[name] = command
+            self._order.append(name)
+
+    def cancel(self, name=None):
+        """Cancel the named sync command (or all of them if no name is given)
+
+           Pending commands are never started, while running commands are
+           cancelled via their cancel() method. The result for each cancelled
+           command reports a SyncCancelled exception.
+        """
+        with self._lock:
+            if name is None:
+                names = list(self._order)
+            elif name not in self._commands:
+                raise KeyError(name)
+            else:
+                names = [name]
+            running = []
+            for name in names:
+                if name in self._results or name in self._cancelled:
+                    continue
+                self._cancelled.add(name)
+                if name in self._running:
+                    running.append(name)
+        for name in running:
+            self._log("Cancelling sync {0!r}", name)
+            self._commands[name].cancel()
+
+    def run(self):
+        """Execute all of the sync commands
+
+           Returns a dict mapping each name to a SupervisedResult
+        """
+        with self._lock:
+            if self._started:
+                raise RuntimeError("run() may only be called once")
+            self._started = True
+        pending = Queue.Queue()
+        for name in self._order:
+            pending.put(name)
+        num_workers = min(self.max_concurrent_syncs, len(self._order))
+        self._log("Running {0} syncs ({1} at a time)",
+                  len(self._order), num_workers)
+        workers = []
+        for __ in range(num_workers):
+            worker = threading.Thread(target=self._run_worker, args=(pending,))
+            worker.start()
+            workers.append(worker)
+        try:
+            for worker in workers:
+                while worker.is_alive():
+                    worker.join(_JOIN_POLL_SECONDS)
+        except KeyboardInterrupt:
+            self._log("Interrupted, cancelling all syncs")
+            self.cancel()
+            for worker in workers:
+                worker.join()
+            raise
+        self._log("Completed {0} syncs", len(self._results))
+        return dict(self._results)
+
+    def _run_worker(self, pending):
+        while True:
+            try:
+                name = pending.get_nowait()
+            except Queue.Empty:
+                return
+            self._run_command(name)
+
+    def _run_command(self, name):
+        command = self._commands[name]
+        with self._lock:
+            cancelled = name in self._cancelled
+            if not cancelled:
+                self._running.add(name)
+        if cancelled:
+            self._log("Skipping cancelled sync {0!r}", name)
+            try:
+                raise SyncCancelled("Sync {0!r} cancelled".format(name))
+            except SyncCancelled:
+                result = SupervisedResult(None, sys.exc_info())
+        else:
+            self._log("Starting sync {0!r}", name)
+            try:
+                sync_info = command.run_sync()
+            except SyncCancelled:
+                self._log("Cancelled sync {0!r}", name)
+                result = SupervisedResult(None, sys.exc_info())
+            except:
+                self._log("Failed sync {0!r}\n{1}", name, traceback.format_exc())
+                result = SupervisedResult(None, sys.exc_info())
+            else:
+                self._log("Finished sync {0!r} (Result: {1})", name, sync_info[0])
+                result = SupervisedResult(sync_info, None)
+        with self._lock:
+            self._running.discard(name)
+            self._results[name] = result
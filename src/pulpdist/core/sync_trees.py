@@ -25,16 +25,36 @@ import collections
 import re
 import contextlib
 import errno
+import fnmatch
+import functools
+import stat
+import tempfile
+import threading
+import time
 
-from . import sync_config, util
+from . import (sync_config, util, protected_index, hardlink_index, trash,
+               bandwidth, manifest, run_log)
 
 _BASE_FETCH_DIR_PARAMS = """
     -rlptDvH --delete-after --ignore-errors --progress --stats --human-readable
-    --timeout=18000 --partial --delay-updates
+    --timeout=18000 --partial --delay-updates --itemize-changes
 """.split()
 
+# Local metadata files maintained by pulpdist in the top level directory
+_LOCAL_METADATA_PATTERN = "/.pulpdist-*"
+_LOCAL_METADATA_NAMES = _LOCAL_METADATA_PATTERN.lstrip("/")
+_STAGING_NAME = ".pulpdist-staging"
+_LOCAL_MANIFEST_NAME = ".pulpdist-manifest.gz"
+_LOCAL_FULL_SYNC_NAME = ".pulpdist-full-sync"
+
+# rsync filter rules (without modifiers) that keep local files from being deleted
+_FILTER_RULE_REGEX = re.compile(r"^([-+PRHS]|exclude|include|protect|risk|hide|show)[ _](.+)$")
+_EXCLUDE_FILTER_RULES = ("-", "exclude", "P", "protect")
+
 # Rsync statistics collection
-_sync_stats_pattern = re.compile(r"""
+# Each line of the stats block is matched separately, so the output can
+# be processed as it is produced rather than being captured and scanned
+_stats_line_patterns = [re.compile(p) for p in r"""
 Number of files: (?P<total_file_count>\d+)
 Number of files transferred: (?P<transferred_file_count>\d+)
 Total file size: (?P<total_size>[.\d]+)(?P<total_size_kind>[BKMG]?) bytes
@@ -46,24 +66,23 @@ File list generation time: (?P<listing_creation_seconds>[.\d]+) seconds
 File list transfer time: (?P<listing_transfer_seconds>[.\d]+) seconds
 Total bytes sent: (?P<sent_size>[.\d]+)(?P<sent_size_kind>[BKMG]?)
 Total bytes received: (?P<received_size>[.\d]+)(?P<received_size_kind>[BKMG]?)
-
+$
 sent [.\d]+[BKMG]? bytes\s+received [.\d]+[BKMG]? bytes\s+(?P<transfer_rate>[.\d]+)(?P<transfer_rate_kind>[BKMG]?)\s+bytes/sec
-""", re.DOTALL)
-
-_old_sync_stats_pattern = re.compile(r"""
-Number of files: (?P<total_file_count>\d+)
-Number of files transferred: (?P<transferred_file_count>\d+)
-Total file size: (?P<total_size>[.\d]+)(?P<total_size_kind>[BKMG]?) bytes
-Total transferred file size: (?P<transferred_size>[.\d]+)(?P<transferred_size_kind>[BKMG]?) bytes
-Literal data: (?P<literal_size>[.\d]+)(?P<literal_size_kind>[BKMG]?) bytes
-Matched data: (?P<matched_size>[.\d]+)(?P<matched_size_kind>[BKMG]?) bytes
-File list size: (?P<listing_size>[.\d]+)(?P<listing_size_kind>[BKMG]?)
-Total bytes sent: (?P<sent_size>[.\d]+)(?P<sent_size_kind>[BKMG]?)
-Total bytes received: (?P<received_size>[.\d]+)(?P<received_size_kind>[BKMG]?)
-
-sent [.\d]+[BKMG]? bytes\s+received [.\d]+[BKMG]? bytes\s+(?P<transfer_rate>[.\d]+)(?P<transfer_rate_kind>[BKMG]?)\s+bytes/sec
-""", re.DOTALL)
-
+""".strip().splitlines()]
+
+# Old rsync daemons don't report the file list timing details
+_old_stats_line_patterns = [p for p in _stats_line_patterns
+                                if "_seconds>" not in p.pattern]
+
+_itemized_change_pattern = re.compile(
+    r"^(?P<update_type>[<>ch.])(?P<file_type>[fdLDS])(?P<attributes>[^\s]{7,9}|\s{7,9}) (?P<path>.+)$")
+_itemized_delete_pattern = re.compile(r"^\*(?P<attributes>deleting)\s+(?P<path>.+)$")
+_error_pattern = re.compile(r"^(rsync:|rsync error:|IO error|ERROR:)")
+_progress_pattern = re.compile(
+    r"^\s*(?P<size>[\d.,]+)(?P<size_kind>[BKMGT]?)\s+\d+%"
+    r"\s+(?P<rate>[\d.]+)(?P<rate_kind>[kKMGT]?)B/s\s+\S+"
+    r"(\s+\((xfer|xfr)#\d+, (to-check|to-chk|ir-chk)=(?P<remaining>\d+)/\d+\))?")
+_output_segment_pattern = re.compile(r"[^\r\n]*\n|\r[^\r\n]*\n?|[^\r\n]+")
 
 _kind_scale = {
     None : 1,
@@ -96,14 +115,15 @@ class SyncStats(collections.namedtuple("SyncStats", _sync_stats_fields)):
 
     @classmethod
     def from_rsync_output(cls, raw_data, old_daemon=False):
+        parser = RsyncOutputParser(old_daemon)
+        for line in raw_data.splitlines():
+            parser.feed(line)
+        return parser.get_stats()
+
+    @classmethod
+    def from_scraped_data(cls, scraped_blocks, old_daemon=False):
         stats = collections.defaultdict(int)
-        scraped = None
-        if old_daemon:
-            pattern = _old_sync_stats_pattern
-        else:
-            pattern = _sync_stats_pattern
-        for scraped in pattern.finditer(raw_data):
-            data = scraped.groupdict()
+        for data in scraped_blocks:
             if old_daemon:
                 data["listing_creation_seconds"] = 0
                 data["listing_transfer_seconds"] = 0
@@ -122,20 +142,240 @@ class SyncStats(collections.namedtuple("SyncStats", _sync_stats_fields)):
                     size = data[field_prefix + "_size"]
                     kind = data[field_prefix + "_size_kind"]
                     stats[field] += _bytes_from_size_and_kind(size, kind)
-        if scraped is None:
-            raise ValueError("No rsync stats found in output")
         return cls(**stats)
 
 _null_sync_stats = SyncStats(*([0]*len(SyncStats._fields)))
 
+
+ItemizedChange = collections.namedtuple("ItemizedChange",
+                                        "update_type file_type attributes path")
+
+# files_remaining is None until rsync reports it
+ProgressEvent = collections.namedtuple("ProgressEvent",
+                                       "current_file bytes_done transfer_bps files_remaining")
+
+class RsyncOutputParser(object):
+    """Incremental parser for the output of an rsync fetch operation
+
+       Lines are fed in one at a time as rsync produces them. The stats
+       blocks, itemized changes and error messages are extracted on the fly
+       without retaining the raw output. Progress updates (which rsync
+       starts with a carriage return, only ending the last update for each
+       file with a newline) may also be fed in separately, and are reported
+       to the progress handler at most once every PROGRESS_INTERVAL seconds.
+    """
+    MAX_ERRORS = 20
+    PROGRESS_INTERVAL = 1.0
+
+    _time = staticmethod(time.time)
+
+    def __init__(self, old_daemon=False, itemized_change_handler=None,
+                 progress_handler=None):
+        self.old_daemon = old_daemon
+        if old_daemon:
+            self._stats_patterns = _old_stats_line_patterns
+        else:
+            self._stats_patterns = _stats_line_patterns
+        self._itemized_change_handler = itemized_change_handler
+        self._progress_handler = progress_handler
+        self._stats_blocks = []
+        self._partial_block = None
+        self.change_counts = collections.defaultdict(int)
+        self.errors = collections.deque(maxlen=self.MAX_ERRORS)
+        self.error_count = 0
+        self._current_file = None
+        self._completed_bytes = 0
+        self._current_bytes = 0
+        self._files_remaining = None
+        self._last_progress_time = None
+        self.restarts = 0
+        self._restarted_bytes = 0
+
+    def start_new_run(self):
+        """Prepare to parse the output of a restarted rsync command"""
+        self.restarts += 1
+        self._partial_block = None
+        # The interrupted file is transferred again by the new command
+        self._current_bytes = 0
+        self._restarted_bytes = self._completed_bytes
+
+    def feed(self, line):
+        line = line.strip("\r\n")
+        if self._partial_block is not None and self._feed_stats(line):
+            return
+        # Progress is tracked even without a handler, since it is the only
+        # record of the data transferred before a restart
+        if self._feed_progress(line):
+            return
+        scraped = self._stats_patterns[0].search(line)
+        if scraped is not None:
+            self._partial_block = scraped.groupdict()
+            self._next_stats_line = 1
+            return
+        itemized = _itemized_change_pattern.match(line)
+        if itemized is not None:
+            self._record_change(ItemizedChange(**itemized.groupdict()))
+            return
+        deleted = _itemized_delete_pattern.match(line)
+        if deleted is not None:
+            self._record_change(ItemizedChange('*', '', **deleted.groupdict()))
+            return
+        if _error_pattern.match(line):
+            self.errors.append(line)
+            self.error_count += 1
+
+    def _feed_stats(self, line):
+        pattern = self._stats_patterns[self._next_stats_line]
+        scraped = pattern.match(line)
+        if scraped is None:
+            # Not a complete stats block, so discard it
+            self._partial_block = None
+            return False
+        self._partial_block.update(scraped.groupdict())
+        self._next_stats_line += 1
+        if self._next_stats_line == len(self._stats_patterns):
+            self._stats_blocks.append(self._partial_block)
+            self._partial_block = None
+        return True
+
+    def _feed_progress(self, line):
+        progress = _progress_pattern.match(line)
+        if progress is None:
+            return False
+        size = progress.group("size").replace(",", "")
+        self._current_bytes = _bytes_from_size_and_kind(size, progress.group("size_kind"))
+        remaining = progress.group("remaining")
+        if remaining is not None:
+            self._files_remaining = int(remaining)
+        if self._progress_handler is not None:
+            self._report_progress(progress)
+        if remaining is not None:
+            # Only the final update for each file reports the files remaining
+            self._completed_bytes += self._current_bytes
+            self._current_bytes = 0
+        return True
+
+    def _report_progress(self, progress):
+        now = self._time()
+        last_time = self._last_progress_time
+        if last_time is None or now - last_time >= self.PROGRESS_INTERVAL:
+            self._last_progress_time = now
+            rate_kind = progress.group("rate_kind").upper()
+            rate = _bytes_from_size_and_kind(progress.group("rate"), rate_kind)
+            event = ProgressEvent(self._current_file,
+                                  self._completed_bytes + self._current_bytes,
+                                  rate, self._files_remaining)
+            self._progress_handler(event)
+
+    def _record_change(self, change):
+        self.change_counts[change.update_type + change.file_type] += 1
+        if change.update_type == '>' and change.file_type == 'f':
+            self._current_file = change.path
+            self._completed_bytes += self._current_bytes
+            self._current_bytes = 0
+        handler = self._itemized_change_handler
+        if handler is not None:
+            handler(change)
+
+    def get_stats(self):
+        if not self._stats_blocks:
+            raise ValueError("No rsync stats found in output")
+        stats = SyncStats.from_scraped_data(self._stats_blocks, self.old_daemon)
+        if self.restarts:
+            # Only the final command reports stats, so files transferred
+            # before a restart are counted from the itemized changes, and
+            # their size from the progress updates. Other byte counts only
+            # cover the final command.
+            transferred = self.change_counts[">f"]
+            if transferred > stats.transferred_file_count:
+                stats = stats._replace(transferred_file_count=transferred)
+            transferred_bytes = stats.transferred_bytes + self._restarted_bytes
+            stats = stats._replace(transferred_bytes=transferred_bytes)
+        return stats
+
 # rsync remote ls scraping
 
+def _escape_rsync_pattern(name):
+    """Escape any wildcard characters in a literal rsync filter pattern"""
+    return re.sub(r"([[*?\\])", r"\\\1", name)
+
 _remote_ls_entry_pattern = re.compile(
 "^(?P<entry_kind>.).*"
 " (?P<mtime>\d\d\d\d\/\d\d\/\d\d \d\d:\d\d:\d\d)"
 " (?P<entry_details>.*)$", re.MULTILINE)
 
 
+class SyncCancelled(Exception):
+    """Raised when a sync operation is cancelled while it is running"""
+
+
+class PhaseTimer(object):
+    """Accumulates the time spent in each phase of a sync operation
+
+       Phases may be timed from several threads at once. Time spent on
+       individual versions is also recorded separately for each version.
+    """
+    _time = staticmethod(time.time)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._phases = {}
+        self._phase_order = []
+        self._versions = {}
+
+    @contextlib.contextmanager
+    def timed(self, phase, version=None):
+        """Context manager that adds the time spent in its body to a phase"""
+        start = self._time()
+        try:
+            yield
+        finally:
+            self.add(phase, self._time() - start, version)
+
+    def add(self, phase, seconds, version=None):
+        with self._lock:
+            if phase not in self._phases:
+                self._phases[phase] = 0.0
+                self._phase_order.append(phase)
+            self._phases[phase] += seconds
+            if version is not None:
+                version_phases = self._versions.setdefault(version, {})
+                version_phases[phase] = version_phases.get(phase, 0.0) + seconds
+
+    def iter_phases(self):
+        """Yields (phase, seconds, version_seconds) in the order the phases started
+
+           version_seconds is a sorted list of (version, seconds) pairs
+        """
+        with self._lock:
+            for phase in self._phase_order:
+                version_seconds = sorted((version, phases[phase])
+                                          for version, phases in self._versions.items()
+                                             if phase in phases)
+                yield phase, self._phases[phase], version_seconds
+
+    def as_dict(self):
+        """Returns the timings (in seconds) as a JSON compatible dict"""
+        with self._lock:
+            return {
+                "phases": dict(self._phases),
+                "versions": dict((version, dict(phases))
+                                   for version, phases in self._versions.items()),
+            }
+
+
+def _total_seconds(delta):
+    # timedelta.total_seconds() is only available in Python 2.7+
+    return delta.days * 86400 + delta.seconds + delta.microseconds / 1e6
+
+
+class _RunLogState(threading.local):
+    # Each thread gets its own indent level, and may also redirect
+    # its log output to a temporary buffer (see _buffer_run_log)
+    indent_level = 0
+    buffer = None
+
+
 class BaseSyncCommand(object):
 
     SYNC_UP_TO_DATE = "SYNC_UP_TO_DATE"
@@ -146,9 +386,17 @@ class BaseSyncCommand(object):
 
     DRY_RUN_SUFFIX = "_DRY_RUN"
 
+    # Transfers sharing a bandwidth budget are checked this often (in
+    # seconds), and restarted if their share has changed by this fraction
+    BANDWIDTH_REBALANCE_INTERVAL = 30
+    BANDWIDTH_REBALANCE_THRESHOLD = 0.25
+
     CONFIG_TYPE = None
 
-    def __init__(self, config, log_dest=None):
+    _protected_index = None
+    _transferred_paths = None
+
+    def __init__(self, config, log_dest=None, progress_callback=None):
         config_type = self.CONFIG_TYPE
         if config_type is None:
             raise NotImplementedError("CONFIG_TYPE not set by subclass")
@@ -156,9 +404,45 @@ class BaseSyncCommand(object):
         config_data.validate()
         self.__dict__.update(config_data.config)
         self._init_run_log(log_dest)
+        self._progress_callback = progress_callback
+        # rsync sessions may run concurrently (see parallel_streams and
+        # max_parallel_fetches), so their progress is combined under a lock
+        self._progress_lock = threading.Lock()
+        self._active_progress = {}
+        self._finished_progress_bytes = 0
+        self._cancel_event = threading.Event()
+        self._active_procs_lock = threading.Lock()
+        self._active_procs = set()
+        self.phase_timings = PhaseTimer()
+
+    def cancel(self):
+        """Request cancellation of the running sync operation
+
+           Any running shell commands are terminated, and the sync operation
+           raises SyncCancelled instead of starting any further commands.
+           This may be called from any thread.
+        """
+        self._cancel_event.set()
+        with self._active_procs_lock:
+            procs = list(self._active_procs)
+        for proc in procs:
+            try:
+                proc.terminate()
+            except OSError:
+                # Already finished
+                pass
+
+    @property
+    def cancelled(self):
+        return self._cancel_event.is_set()
+
+    def _check_cancelled(self):
+        if self._cancel_event.is_set():
+            raise SyncCancelled("Sync of {0!r} cancelled".format(self.tree_name))
 
     def _init_run_log(self, log_dest):
-        self._run_log_indent_level = 0
+        self._run_log_state = _RunLogState()
+        self._run_log_lock = threading.RLock()
         if log_dest is None:
             self._run_log_file = None
         elif isinstance(log_dest, basestring):
@@ -166,30 +450,71 @@ class BaseSyncCommand(object):
             self._run_log_file = open(log_dest, 'w', 1)
         else:
             self._run_log_file = log_dest
+        # A RunLog also caps shell output and accepts structured events
+        if isinstance(log_dest, run_log.RunLog):
+            self._run_log_sink = log_dest
+        else:
+            self._run_log_sink = None
         self._update_run_log("Log initialised: {0} {1}",
                              type(self).__name__,
                              util.__version__)
 
     @contextlib.contextmanager
     def _indent_run_log(self, level=None):
-        old_level = self._run_log_indent_level
+        state = self._run_log_state
+        old_level = state.indent_level
         if level is None:
             level = old_level + 1
-        self._run_log_indent_level = level
+        state.indent_level = level
         try:
             yield
         finally:
-            self._run_log_indent_level = old_level
+            state.indent_level = old_level
 
     def _update_run_log(self, _fmt, *args, **kwds):
         if self._run_log_file is None:
             return
-        fmt = ("  " * self._run_log_indent_level) + _fmt
+        state = self._run_log_state
+        fmt = ("  " * state.indent_level) + _fmt
         if args:
             msg = fmt.format(*args, **kwds)
         else:
             msg = fmt
-        self._run_log_file.write(msg.rstrip() + '\n')
+        if state.buffer is not None:
+            state.buffer.write(msg.rstrip() + '\n')
+            return
+        with self._run_log_lock:
+            self._run_log_file.write(msg.rstrip() + '\n')
+
+    def _log_event(self, _event, **details):
+        """Records a structured event if the run log accepts them"""
+        sink = self._run_log_sink
+        if sink is None or not sink.events_enabled:
+            return
+        details.setdefault("tree_name", self.tree_name)
+        with self._run_log_lock:
+            sink.write_event(_event, **details)
+
+    @contextlib.contextmanager
+    def _buffer_run_log(self):
+        """Redirects log output from the current thread to a temporary file
+
+           The buffered output is written to the run log as a single block
+           on exit, so concurrent operations don't interleave their output.
+        """
+        state = self._run_log_state
+        if self._run_log_file is None or state.buffer is not None:
+            yield
+            return
+        state.buffer = buffer = tempfile.TemporaryFile()
+        try:
+            yield
+        finally:
+            state.buffer = None
+            buffer.seek(0)
+            with self._run_log_lock:
+                shutil.copyfileobj(buffer, self._run_log_file)
+            buffer.close()
 
     @contextlib.contextmanager
     def _flush_run_log(self):
@@ -201,35 +526,193 @@ class BaseSyncCommand(object):
             finally:
                 self._run_log_file.flush()
 
-    def _run_shell_command(self, cmd):
-        shell_output = []
+    def _run_shell_command(self, cmd, output_handler=None, proc_handler=None):
+        self._check_cancelled()
+        sink = self._run_log_sink
+        if sink is None:
+            output_log = run_log.CappedOutput(self._update_run_log)
+        else:
+            output_log = run_log.CappedOutput(self._update_run_log,
+                                              sink.max_output_lines)
+        self._log_event("command_started", command=cmd)
         with self._indent_run_log(0):
             self._update_run_log("_"*75)
             self._update_run_log("Getting shell output for:\n\n  {0}\n\n", cmd)
             proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
                                          stderr=subprocess.STDOUT)
-            for line in proc.stdout:
-                shell_output.append(line)
-                self._update_run_log(line)
-            result = proc.wait()
+            with self._active_procs_lock:
+                self._active_procs.add(proc)
+                if self._cancel_event.is_set():
+                    # Cancelled while the process was being started
+                    proc.terminate()
+            try:
+                if proc_handler is not None:
+                    proc_handler(proc)
+                log_line = []
+                for segment in self._iter_shell_output(proc.stdout):
+                    if output_handler is not None:
+                        output_handler(segment)
+                    log_line.append(segment)
+                    if segment.endswith("\n"):
+                        self._log_shell_output(output_log, "".join(log_line))
+                        log_line = []
+                if log_line:
+                    self._log_shell_output(output_log, "".join(log_line))
+                result = proc.wait()
+            finally:
+                with self._active_procs_lock:
+                    self._active_procs.discard(proc)
+            omitted_lines = output_log.finish()
             self._update_run_log("^"*75)
-        return result, "".join(shell_output)
+        self._log_event("command_finished", command=cmd, return_code=result,
+                        output_lines=output_log.line_count,
+                        omitted_lines=omitted_lines)
+        self._check_cancelled()
+        return result
+
+    def _log_shell_output(self, output_log, line):
+        if self._run_log_sink is not None:
+            # Only the final progress update for each file is kept
+            line = run_log.collapse_progress(line)
+        output_log.add(line)
+
+    def _iter_shell_output(self, stream):
+        """Yields output segments as soon as they are produced
+
+           Segments are terminated by a newline or by the carriage return
+           that starts the next segment. rsync writes each progress update
+           (a carriage return followed by the new status) in one go, so
+           updates are reported as they occur rather than when the next
+           one arrives.
+        """
+        fd = stream.fileno()
+        pending = ""
+        while True:
+            data = os.read(fd, 65536)
+            if not data:
+                break
+            pending += data
+            segments = _output_segment_pattern.findall(pending)
+            pending = ""
+            if segments:
+                last = segments[-1]
+                if not last.startswith("\r") and not last.endswith("\n"):
+                    # Incomplete line
+                    pending = segments.pop()
+            for segment in segments:
+                yield segment
+        if pending:
+            yield pending
+
+    def _report_progress(self, local_dest_path, session, event):
+        """Report the combined progress of all active rsync sessions
+
+           bytes_done covers the entire sync operation, while the transfer
+           rate and the files remaining are those of the active sessions.
+           The callback is never invoked concurrently.
+        """
+        if event.current_file is not None:
+            current_file = os.path.join(hardlink_index.fs_path(local_dest_path),
+                                        event.current_file)
+            event = event._replace(current_file=current_file)
+        with self._progress_lock:
+            callback = self._progress_callback
+            if callback is None:
+                return
+            active = self._active_progress
+            active[session] = event
+            bytes_done = self._finished_progress_bytes
+            transfer_bps = 0
+            files_remaining = None
+            for session_event in active.values():
+                bytes_done += session_event.bytes_done
+                transfer_bps += session_event.transfer_bps
+                if session_event.files_remaining is not None:
+                    files_remaining = ((files_remaining or 0) +
+                                       session_event.files_remaining)
+            event = ProgressEvent(event.current_file, bytes_done,
+                                  transfer_bps, files_remaining)
+            try:
+                callback(event)
+            except:
+                # Progress reporting problems shouldn't break the sync operation
+                self._update_run_log(traceback.format_exc())
+                self._update_run_log("Disabling progress reporting")
+                self._progress_callback = None
+
+    def _finish_progress(self, session):
+        with self._progress_lock:
+            event = self._active_progress.pop(session, None)
+            if event is not None:
+                self._finished_progress_bytes += event.bytes_done
+
+    def _timed_phase(self, phase, version=None):
+        return self.phase_timings.timed(phase, version)
+
+    def _log_phase_timings(self):
+        self._update_run_log("Phase timings:")
+        with self._indent_run_log():
+            for phase, seconds, version_seconds in self.phase_timings.iter_phases():
+                self._update_run_log("{0}: {1:.2f}s", phase, seconds)
+                with self._indent_run_log():
+                    for version, seconds in version_seconds:
+                        self._update_run_log("{0}: {1:.2f}s", version, seconds)
+
+    def _get_published_path(self, local_dest_path):
+        """Returns the path where a fetched directory will be made visible"""
+        return local_dest_path
+
+    def _record_itemized_change(self, local_dest_path, change):
+        transferred_paths = self._transferred_paths
+        if transferred_paths is None:
+            return
+        if change.update_type == '>' and change.file_type == 'f':
+            local_dest_path = self._get_published_path(local_dest_path)
+            local_dest_path = hardlink_index.fs_path(local_dest_path)
+            transferred_paths.append(os.path.join(local_dest_path, change.path))
 
     def _consolidate_tree(self):
         local_path = self.local_path
-        hardlink_cmd = ["hardlink", "-v", self.local_path]
+        if self.dry_run_only:
+            self._update_run_log("Not hard linking duplicates for test run")
+            return
+        index = hardlink_index.HardlinkIndex(local_path, self.dedupe_index_path)
+        if self.dedupe_index_path is not None:
+            self._update_run_log("Using shared dedupe index {0!r}", self.dedupe_index_path)
         try:
-            return_code, __ = self._run_shell_command(hardlink_cmd)
+            with index.opened():
+                if index.needs_full_scan():
+                    self._update_run_log("Indexing all files in {0!r}", local_path)
+                    with self._indent_run_log():
+                        link_stats = index.consolidate_all(self._update_run_log)
+                else:
+                    transferred_paths = self._transferred_paths or ()
+                    self._update_run_log("Indexing {0} transferred files", len(transferred_paths))
+                    with self._indent_run_log():
+                        link_stats = index.consolidate(transferred_paths,
+                                                       self._update_run_log)
         except:
             self._update_run_log(traceback.format_exc())
             result_msg = "Exception while hard linking duplicates in {0!r}"
         else:
-            if return_code == 0:
-                result_msg = "Successfully hard linked duplicates in {0!r}"
-            else:
-                result_msg = "Failed to hard link duplicates in {0!r}"
+            self._update_run_log("Checked {0} files, linked {1} ({2} bytes)", *link_stats)
+            result_msg = "Successfully hard linked duplicates in {0!r}"
         self._update_run_log(result_msg, local_path)
 
+    def _forget_consolidated_dirs(self, dir_paths):
+        index_path = self.dedupe_index_path
+        if index_path is None:
+            index_path = os.path.join(self.local_path, hardlink_index.INDEX_NAME)
+        if not dir_paths or not os.path.exists(index_path):
+            return
+        index = hardlink_index.HardlinkIndex(self.local_path, index_path)
+        try:
+            with index.opened():
+                for dir_path in dir_paths:
+                    index.forget(dir_path)
+        except:
+            self._update_run_log(traceback.format_exc())
+            self._update_run_log("Failed to remove deleted directories from hard link index")
 
     def _send_amqp_message(self, result, sync_stats):
         details = "{0!r} transfer {1!r} -> {2!r}: {3}, {4}".format(
@@ -241,11 +724,17 @@ class BaseSyncCommand(object):
 
     def _run_sync_inner(self):
         start_time = datetime.utcnow()
+        self.phase_timings = PhaseTimer()
         if not self.enabled:
             self._update_run_log("Ignoring sync request for {0!r} at {1}", self.tree_name, start_time)
             return self.SYNC_DISABLED, start_time, start_time, _null_sync_stats
 
         self._update_run_log("Syncing tree {0!r} at {1}", self.tree_name, start_time)
+        self._log_event("sync_started", command=type(self).__name__,
+                        remote_server=self.remote_server,
+                        remote_path=self.remote_path,
+                        local_path=self.local_path,
+                        dry_run=self.dry_run_only)
 
         with self._indent_run_log():
             if self.dry_run_only:
@@ -259,12 +748,22 @@ class BaseSyncCommand(object):
                         raise
                     self._update_run_log("  Destination directory already created by another process")
 
-            result, sync_stats = self._do_transfer()
+            self._protected_index = protected_index.ProtectedIndex(self.local_path)
+            self._transferred_paths = []
+            try:
+                result, sync_stats = self._do_transfer()
+            except SyncCancelled:
+                self._update_run_log("Cancelled sync of {0!r} at {1}", self.tree_name, datetime.utcnow())
+                self._log_event("sync_cancelled")
+                raise
+            finally:
+                self._save_protected_index()
 
             if sync_stats.transferred_file_count > 0:
                 self._update_run_log("Consolidating downloaded data with hard links")
                 with self._indent_run_log():
-                    self._consolidate_tree()
+                    with self._timed_phase("consolidation"):
+                        self._consolidate_tree()
                 self._update_run_log("Sending AMQP message")
                 with self._indent_run_log():
                     self._send_amqp_message(result, sync_stats)
@@ -276,8 +775,66 @@ class BaseSyncCommand(object):
         msg = "Completed sync of {0!r} at {1} (Result: {2}, Duration: {3})"
         self._update_run_log(msg, self.tree_name,
                              finish_time, result, finish_time - start_time)
+        with self._indent_run_log():
+            self._log_phase_timings()
+        self._log_event("sync_finished", result=result,
+                        start_time=start_time.isoformat(),
+                        finish_time=finish_time.isoformat(),
+                        duration=_total_seconds(finish_time - start_time),
+                        stats=sync_stats._asdict(),
+                        phase_timings=self.phase_timings.as_dict())
         return result, start_time, finish_time, sync_stats
 
+    def _save_protected_index(self):
+        index = self._protected_index
+        self._protected_index = None
+        if self.dry_run_only:
+            return
+        try:
+            index.save()
+        except:
+            self._update_run_log(traceback.format_exc())
+            self._update_run_log("Failed to save index of protected directories")
+
+    def _find_protected_dirs(self, local_dest_path):
+        index = self._protected_index
+        if index is not None:
+            try:
+                return index.find_protected(local_dest_path)
+            except ValueError:
+                # Not inside the local mirror, so walk it instead
+                pass
+        protected = []
+        for dir_info in shellutil.filtered_walk(local_dest_path, file_pattern='PROTECTED'):
+            if dir_info.files:
+                rel_path = dir_info.path
+                if os.path.isabs(rel_path):
+                    rel_path = os.path.relpath(rel_path, local_dest_path)
+                protected.append(rel_path)
+        return protected
+
+    def _call_in_thread(self, results, index, log_level, func, *args):
+        """Thread target that stores the result of func(*args) in results
+
+           Exceptions are stored for the caller to reraise, and the run log
+           output is buffered so it doesn't interleave with other threads.
+        """
+        with self._buffer_run_log():
+            with self._indent_run_log(log_level):
+                try:
+                    results[index] = func(*args), None
+                except:
+                    self._update_run_log(traceback.format_exc())
+                    results[index] = None, sys.exc_info()
+
+    def _join_threads(self, workers, results):
+        for worker in workers:
+            worker.join()
+        for result, exc_info in results:
+            if exc_info is not None:
+                raise exc_info[0], exc_info[1], exc_info[2]
+        return [result for result, exc_info in results]
+
     def run_sync(self):
         """Execute the full synchronisation task
 
@@ -297,9 +854,29 @@ class BaseSyncCommand(object):
         return params
 
     def _build_fetch_dir_rsync_params(self, remote_source_path, local_dest_path,
-                                      local_seed_paths=()):
-        """Construct rsync parameters to fetch a remote directory"""
+                                      local_seed_paths=(), partition=None,
+                                      files_from=None):
+        """Construct rsync parameters to fetch a remote directory
+
+           If a partition is given, only the named top level subdirectories
+           are retrieved, and nothing is deleted locally.
+
+           If a files_from list is given, only the files it names are
+           retrieved, and nothing is deleted locally (other than directories
+           that have been replaced with files on the source server).
+        """
         params = _BASE_FETCH_DIR_PARAMS[:]
+        if partition is not None or files_from is not None:
+            params.remove("--delete-after")
+        if files_from is not None:
+            # Without --delete, rsync only replaces non-empty directories
+            # when forced to
+            params.append("--force")
+            params.append("--from0")
+            params.append("--files-from={0}".format(files_from))
+        if self._get_published_path(local_dest_path) != local_dest_path:
+            # Staged directories aren't visible until they're complete
+            params.remove("--delay-updates")
         params.extend(self._build_common_rsync_params())
         if self.dry_run_only:
             params.append("-n")
@@ -311,22 +888,42 @@ class BaseSyncCommand(object):
         # Add exclude filters
         for excluded_file in self.exclude_from_sync:
             params.append("--exclude={0}".format(excluded_file))
-        # Protect directories from deletion if they contain a file called PROTECTED
-        for dir_info in shellutil.filtered_walk(local_dest_path, file_pattern='PROTECTED'):
-            if dir_info.files:
-                rel_path = dir_info.path
-                if os.path.isabs(rel_path):
-                    rel_path = os.path.relpath(rel_path, local_dest_path)
+        # Leave local metadata files alone
+        params.append("--exclude={0}".format(_LOCAL_METADATA_PATTERN))
+        if partition is None:
+            # Protect directories from deletion if they contain a file called PROTECTED
+            for rel_path in self._find_protected_dirs(local_dest_path):
                 params.append("--filter=protect {0}".format(rel_path))
+        else:
+            # These come after the other filters, so exclusions still apply
+            for dirname in partition:
+                pattern = "/" + _escape_rsync_pattern(dirname)
+                params.append("--include={0}/".format(pattern))
+                params.append("--include={0}/**".format(pattern))
+            params.append("--exclude=/*")
         for seed_path in local_seed_paths:
             params.append("--link-dest={0}".format(seed_path))
         params.append(remote_source_path)
         params.append(local_dest_path)
         return params
 
-    def _scrape_fetch_dir_rsync_stats(self, data):
+    def _scrape_fetch_dir_rsync_stats(self, parser):
+        if parser.error_count:
+            self._update_run_log("rsync reported {0} error(s), most recent:", parser.error_count)
+            with self._indent_run_log():
+                for error in parser.errors:
+                    self._update_run_log(error)
+        if parser.change_counts:
+            self._update_run_log("Itemized changes:")
+            with self._indent_run_log():
+                for change_kind, count in sorted(parser.change_counts.items()):
+                    self._update_run_log("{0}={1}", change_kind, count)
+        if parser.restarts:
+            self._update_run_log("rsync was restarted {0} time(s), so the sent, received,"
+                                 " literal and matched byte counts only cover the final"
+                                 " command", parser.restarts)
         try:
-            return SyncStats.from_rsync_output(data, self.old_remote_daemon)
+            return parser.get_stats()
         except ValueError:
             self._update_run_log("No stats data found in rsync output")
             raise RuntimeError("No stats data found in rsync output")
@@ -334,14 +931,342 @@ class BaseSyncCommand(object):
     def _fetch_dir_complete(self, result, remote_source_path, local_dest_path):
         return result
 
-    def fetch_dir(self, remote_source_path, local_dest_path, local_seed_paths=()):
-        """Fetch a single directory from the remote server"""
+    def _get_bandwidth_governor(self):
+        if not self.bandwidth_budget:
+            return None
+        return bandwidth.BandwidthGovernor(self.bandwidth_budget)
+
+    def _get_bandwidth_limit(self, lease):
+        limit = lease.share()
+        if self.bandwidth_limit:
+            limit = min(limit, self.bandwidth_limit)
+        return limit
+
+    def _run_fetch_command(self, rsync_fetch_command, parser):
+        """Run an rsync fetch command, sharing the site bandwidth budget
+
+           The command is restarted with a new --bwlimit whenever its share
+           of the budget changes significantly. Partially transferred files
+           are resumed rather than being transferred again from scratch.
+        """
+        governor = self._get_bandwidth_governor()
+        lease = None
+        if governor is not None:
+            try:
+                lease = governor.acquire()
+            except (IOError, OSError) as ex:
+                # Problems with the shared registry shouldn't stop the sync
+                self._update_run_log("Unable to share bandwidth budget ({0})", ex)
+                self._update_run_log("Using bandwidth_limit instead")
+        if lease is None:
+            return self._run_shell_command(rsync_fetch_command, parser.feed)
+        try:
+            while True:
+                try:
+                    limit = self._get_bandwidth_limit(lease)
+                except OSError as ex:
+                    self._update_run_log("Unable to check bandwidth share ({0})", ex)
+                    self._update_run_log("Using bandwidth_limit instead")
+                    return self._run_shell_command(rsync_fetch_command, parser.feed)
+                self._update_run_log("Using bandwidth limit of {0} KiB/s", limit)
+                cmd = [arg for arg in rsync_fetch_command
+                               if not arg.startswith("--bwlimit=")]
+                cmd.insert(1, "--bwlimit={0}".format(limit))
+                finished = threading.Event()
+                rebalanced = threading.Event()
+                def _start_watchdog(proc):
+                    args = (proc, lease, limit, finished, rebalanced)
+                    watchdog = threading.Thread(target=self._watch_bandwidth_share,
+                                                args=args)
+                    watchdog.daemon = True
+                    watchdog.start()
+                try:
+                    return_code = self._run_shell_command(cmd, parser.feed,
+                                                          _start_watchdog)
+                finally:
+                    finished.set()
+                if not rebalanced.is_set():
+                    return return_code
+                self._update_run_log("Restarting transfer to rebalance bandwidth")
+                parser.start_new_run()
+        finally:
+            try:
+                lease.release()
+            except OSError as ex:
+                # Other transfers keep sharing the budget with this lease
+                # until this process exits
+                self._update_run_log("Unable to release bandwidth lease ({0})", ex)
+
+    def _watch_bandwidth_share(self, proc, lease, limit, finished, rebalanced):
+        while True:
+            finished.wait(self.BANDWIDTH_REBALANCE_INTERVAL)
+            if finished.is_set():
+                return
+            try:
+                new_limit = self._get_bandwidth_limit(lease)
+            except OSError as ex:
+                # Keep the current limit for the rest of this transfer
+                self._update_run_log("Unable to check bandwidth share ({0})", ex)
+                return
+            if abs(new_limit - limit) >= limit * self.BANDWIDTH_REBALANCE_THRESHOLD:
+                rebalanced.set()
+                try:
+                    proc.terminate()
+                except OSError:
+                    # Already finished
+                    pass
+                return
+
+    def fetch_dir(self, remote_source_path, local_dest_path, local_seed_paths=(),
+                  partition=None):
+        """Fetch a single directory from the remote server
+
+           If a partition is given, only the named top level subdirectories
+           are retrieved, and nothing is deleted locally.
+        """
+        if self.manifest_name and partition is None and not self.dry_run_only:
+            return self._fetch_dir_from_manifest(remote_source_path,
+                                                 local_dest_path,
+                                                 local_seed_paths)
+        return self._fetch_dir_with_rsync(remote_source_path, local_dest_path,
+                                          local_seed_paths, partition)
+
+    def _get_local_manifest_path(self, local_dest_path):
+        return os.path.join(local_dest_path, _LOCAL_MANIFEST_NAME)
+
+    def _build_fetch_manifest_rsync_params(self, remote_source_path, local_manifest_path):
+        """Construct rsync parameters to retrieve the remote tree manifest"""
+        params = ["-t"]
+        params.extend(self._build_common_rsync_params())
+        if self.bandwidth_limit:
+            params.append("--bwlimit={0}".format(self.bandwidth_limit))
+        params.append(remote_source_path.rstrip("/") + "/" + self.manifest_name)
+        params.append(local_manifest_path)
+        return params
+
+    def _retrieve_manifest(self, remote_source_path, local_manifest_path):
+        """Returns the entries in the remote manifest (or None if unavailable)"""
+        params = self._build_fetch_manifest_rsync_params(remote_source_path,
+                                                         local_manifest_path)
+        try:
+            return_code = self._run_shell_command(["rsync"] + params)
+        except SyncCancelled:
+            raise
+        except:
+            self._update_run_log(traceback.format_exc())
+            self._update_run_log("Exception while retrieving manifest {0!r}", self.manifest_name)
+            return None
+        if return_code != 0:
+            self._update_run_log("No manifest retrieved ({0:d})", return_code)
+            return None
+        try:
+            return manifest.read_manifest(local_manifest_path)
+        except (IOError, manifest.ManifestError) as ex:
+            self._update_run_log("Ignoring invalid remote manifest ({0})", ex)
+            return None
+
+    def _read_local_manifest(self, local_dest_path):
+        """Returns the manifest for the local tree (or None if unavailable)"""
+        if (os.path.islink(local_dest_path) or
+                not os.path.isdir(local_dest_path)):
+            return None
+        local_manifest_path = self._get_local_manifest_path(local_dest_path)
+        if not os.path.exists(local_manifest_path):
+            self._update_run_log("No local manifest found")
+            return None
+        try:
+            return manifest.read_manifest(local_manifest_path)
+        except (IOError, manifest.ManifestError) as ex:
+            self._update_run_log("Ignoring invalid local manifest ({0})", ex)
+            return None
+
+    def _save_local_manifest(self, remote_manifest_path, local_dest_path):
+        local_manifest_path = self._get_local_manifest_path(local_dest_path)
+        temp_path = local_manifest_path + ".tmp"
+        shutil.copy2(remote_manifest_path, temp_path)
+        os.rename(temp_path, local_manifest_path)
+
+    def _get_full_sync_marker_path(self, local_dest_path):
+        return os.path.join(local_dest_path, _LOCAL_FULL_SYNC_NAME)
+
+    def _full_sync_due(self, local_dest_path):
+        """Returns True if the local tree should be checked by a full rsync
+
+           The manifests only describe the remote tree, so a full rsync is
+           needed periodically to repair local files that were deleted or
+           damaged without changing upstream. It is also needed after an
+           incomplete manifest based sync (the marker is removed then).
+        """
+        marker_path = self._get_full_sync_marker_path(local_dest_path)
+        try:
+            last_full_sync = os.path.getmtime(marker_path)
+        except OSError:
+            self._update_run_log("No record of a complete full sync")
+            return True
+        if not self.manifest_full_sync_days:
+            return False
+        age = time.time() - last_full_sync
+        if age >= self.manifest_full_sync_days * 24 * 60 * 60:
+            self._update_run_log("Last full sync was {0:.1f} days ago",
+                                 age / (24 * 60 * 60))
+            return True
+        return False
+
+    def _record_full_sync(self, local_dest_path):
+        marker_path = self._get_full_sync_marker_path(local_dest_path)
+        with open(marker_path, 'w'):
+            pass
+        os.utime(marker_path, None)
+
+    def _clear_full_sync(self, local_dest_path):
+        marker_path = self._get_full_sync_marker_path(local_dest_path)
+        try:
+            os.unlink(marker_path)
+        except OSError as ex:
+            if ex.errno != errno.ENOENT:
+                raise
+
+    def _get_deletion_exclusions(self):
+        """Returns the exclusions that protect local files from deletion
+
+           Returns None if the sync filters can't be approximated.
+        """
+        patterns = list(self.exclude_from_sync)
+        patterns.append(_LOCAL_METADATA_PATTERN)
+        for rsync_filter in self.sync_filters:
+            match = _FILTER_RULE_REGEX.match(rsync_filter)
+            if match is None:
+                return None
+            rule, pattern = match.groups()
+            # Include, risk, hide and show rules are ignored, which may
+            # leave files behind, but never deletes anything rsync wouldn't
+            if rule in _EXCLUDE_FILTER_RULES:
+                patterns.append(pattern)
+        return manifest._Exclusions(patterns)
+
+    def _delete_manifest_paths(self, local_dest_path, deleted_paths, exclusions):
+        """Delete files no longer listed in the remote manifest
+
+           Directories left empty are also removed, while excluded files
+           and files in protected directories are left alone.
+        """
+        protected = []
+        for rel_path in self._find_protected_dirs(local_dest_path):
+            rel_path = os.path.normpath(rel_path).strip("/")
+            if rel_path == os.curdir:
+                # The entire tree is protected
+                return
+            protected.append(rel_path + "/")
+        for rel_path in deleted_paths:
+            if any((rel_path + "/").startswith(prefix) for prefix in protected):
+                continue
+            if exclusions.excludes_file(rel_path):
+                continue
+            full_path = os.path.join(local_dest_path, rel_path)
+            if not os.path.lexists(full_path) or os.path.isdir(full_path):
+                continue
+            self._update_run_log("Deleting {0!r}", rel_path)
+            os.unlink(full_path)
+            dir_path = os.path.dirname(full_path)
+            while dir_path != local_dest_path.rstrip("/"):
+                try:
+                    os.rmdir(dir_path)
+                except OSError as ex:
+                    if ex.errno in (errno.ENOTEMPTY, errno.EEXIST, errno.ENOENT):
+                        break
+                    raise
+                dir_path = os.path.dirname(dir_path)
+
+    def _fetch_dir_from_manifest(self, remote_source_path, local_dest_path,
+                                 local_seed_paths=()):
+        """Fetch a directory, using manifests to avoid listing the entire tree
+
+           The remote manifest is compared with the manifest saved by the
+           last successful sync, and rsync is given the list of changed
+           files rather than walking the local and remote trees. Falls back
+           to a full rsync of the directory when either manifest is missing,
+           when the sync filters can't be applied to deleted files, after an
+           incomplete manifest based sync, and every manifest_full_sync_days
+           days (so local damage is repaired).
+        """
+        exclusions = self._get_deletion_exclusions()
+        if exclusions is None:
+            self._update_run_log("Sync filters not supported with manifests")
+            return self._fetch_dir_with_rsync(remote_source_path, local_dest_path,
+                                              local_seed_paths)
+        deleted = ()
+        with shellutil.temp_dir() as manifest_dir:
+            remote_manifest_path = os.path.join(manifest_dir, "manifest")
+            self._update_run_log("Retrieving manifest {0!r}", self.manifest_name)
+            with self._indent_run_log():
+                remote_manifest = self._retrieve_manifest(remote_source_path,
+                                                          remote_manifest_path)
+                if (remote_manifest is None or
+                    self._full_sync_due(local_dest_path)):
+                    local_manifest = None
+                else:
+                    local_manifest = self._read_local_manifest(local_dest_path)
+            full_sync = local_manifest is None
+            if full_sync:
+                self._update_run_log("Fetching entire directory")
+                result, rsync_stats = self._fetch_dir_with_rsync(remote_source_path,
+                                                                 local_dest_path,
+                                                                 local_seed_paths)
+            else:
+                changed, deleted = manifest.diff_manifests(remote_manifest,
+                                                           local_manifest)
+                self._update_run_log("Manifest lists {0} changed and {1} deleted files",
+                                     len(changed), len(deleted))
+                if not changed and not deleted:
+                    self._update_run_log("{0!r} already up to date relative to {1!r}",
+                                         local_dest_path, remote_source_path)
+                    result = self._fetch_dir_complete(self.SYNC_UP_TO_DATE,
+                                                      remote_source_path,
+                                                      local_dest_path)
+                    rsync_stats = _null_sync_stats
+                else:
+                    # The manifest itself is retrieved along with the changes
+                    changed.append(self.manifest_name)
+                    files_from = os.path.join(manifest_dir, "files-from")
+                    with open(files_from, 'wb') as f:
+                        for rel_path in changed:
+                            if isinstance(rel_path, unicode):
+                                rel_path = rel_path.encode("utf-8")
+                            f.write(rel_path + "\0")
+                    result, rsync_stats = self._fetch_dir_with_rsync(remote_source_path,
+                                                                     local_dest_path,
+                                                                     local_seed_paths,
+                                                                     files_from=files_from)
+            published_path = self._get_published_path(local_dest_path)
+            if result not in (self.SYNC_COMPLETED, self.SYNC_UP_TO_DATE):
+                if not full_sync and os.path.isdir(published_path):
+                    # Check the entire tree next time, rather than repeating
+                    # the same comparison against the saved manifest
+                    self._clear_full_sync(published_path)
+            elif remote_manifest is not None:
+                if deleted:
+                    # Like --delete-after, only delete once the transfer succeeds
+                    with self._indent_run_log():
+                        self._delete_manifest_paths(published_path, deleted,
+                                                    exclusions)
+                self._save_local_manifest(remote_manifest_path, published_path)
+                if full_sync:
+                    self._record_full_sync(published_path)
+        return result, rsync_stats
+
+    def _fetch_dir_with_rsync(self, remote_source_path, local_dest_path,
+                              local_seed_paths=(), partition=None,
+                              files_from=None):
         params = self._build_fetch_dir_rsync_params(remote_source_path,
                                                     local_dest_path,
-                                                    local_seed_paths)
+                                                    local_seed_paths,
+                                                    partition,
+                                                    files_from)
         rsync_fetch_command = ["rsync"] + params
         rsync_stats = _null_sync_stats
         self._update_run_log("Downloading {0!r} -> {1!r}", remote_source_path, local_dest_path)
+        if partition is not None:
+            self._update_run_log("Limited to {0} top level directories", len(partition))
         for seed_path in local_seed_paths:
             self._update_run_log("Using {0!r} as local seed data", seed_path)
         if not self.dry_run_only:
@@ -362,15 +1287,31 @@ class BaseSyncCommand(object):
                         raise
                     self._update_run_log("  Destination directory already created by another process")
         with self._indent_run_log():
+            change_handler = functools.partial(self._record_itemized_change,
+                                               local_dest_path)
+            progress_handler = None
+            # Identifies this rsync session when combining progress reports
+            session = object()
+            if self._progress_callback is not None:
+                progress_handler = functools.partial(self._report_progress,
+                                                     local_dest_path, session)
+            parser = RsyncOutputParser(self.old_remote_daemon, change_handler,
+                                       progress_handler)
             try:
-                return_code, captured = self._run_shell_command(rsync_fetch_command)
+                try:
+                    return_code = self._run_fetch_command(rsync_fetch_command,
+                                                          parser)
+                finally:
+                    self._finish_progress(session)
+            except SyncCancelled:
+                raise
             except:
                 self._update_run_log(traceback.format_exc())
                 result_msg = "Exception while updating {0!r} from {1!r}"
             else:
                 if return_code in (0, 23):
                     with self._indent_run_log():
-                        rsync_stats = self._scrape_fetch_dir_rsync_stats(captured)
+                        rsync_stats = self._scrape_fetch_dir_rsync_stats(parser)
                         self._update_run_log("Retrieved rsync stats:")
                         with self._indent_run_log():
                             for field, value in zip(rsync_stats._fields, rsync_stats):
@@ -386,11 +1327,15 @@ class BaseSyncCommand(object):
                         result = self.SYNC_COMPLETED
                     # We give subclasses a chance to second guess the nominal result
                     # as well as taking other actions
-                    result = self._fetch_dir_complete(result, remote_source_path, local_dest_path)
+                    if partition is None:
+                        result = self._fetch_dir_complete(result, remote_source_path, local_dest_path)
                 else:
                     result_msg = "Non-zero return code (%d) updating {0!r} from {1!r}" % return_code
                     result = self.SYNC_FAILED
             self._update_run_log(result_msg, local_dest_path, remote_source_path)
+        self._log_event("fetch_finished", remote_path=remote_source_path,
+                        local_path=local_dest_path, result=result,
+                        stats=rsync_stats._asdict())
         return result, rsync_stats
 
 
@@ -401,13 +1346,217 @@ class SyncTree(BaseSyncCommand):
     def _do_transfer(self):
         remote_source_path = "rsync://{0}{1}".format(self.remote_server, self.remote_path)
         local_dest_path = self.local_path
-        return self.fetch_dir(remote_source_path, local_dest_path)
+        with self._timed_phase("transfer"):
+            if self.parallel_streams > 1:
+                return self._fetch_dir_in_streams(remote_source_path, local_dest_path)
+            return self.fetch_dir(remote_source_path, local_dest_path)
+
+    def _build_top_level_ls_rsync_params(self, remote_source_path):
+        """Construct rsync parameters to list the top level of the tree"""
+        params = ["-nl"]
+        if self.old_remote_daemon:
+            params.append("--old-d")
+        params.extend(self._build_common_rsync_params())
+        params.append(remote_source_path)
+        return params
+
+    def _list_top_level_dirs(self, remote_source_path):
+        params = self._build_top_level_ls_rsync_params(remote_source_path)
+        rsync_ls_command = ["rsync"] + params
+        self._update_run_log("Getting top level directories for {0!r}", remote_source_path)
+        dirnames = []
+        def _scrape_entry(line):
+            entry = _remote_ls_entry_pattern.match(line.rstrip("\r\n"))
+            if entry is not None and entry.group("entry_kind") == 'd':
+                dirname = entry.group("entry_details").strip()
+                if dirname != ".":
+                    dirnames.append(dirname)
+        with self._indent_run_log():
+            try:
+                return_code = self._run_shell_command(rsync_ls_command,
+                                                      _scrape_entry)
+            except SyncCancelled:
+                raise
+            except:
+                self._update_run_log(traceback.format_exc())
+                self._update_run_log("Exception while listing {0!r}", remote_source_path)
+                return []
+            if return_code != 0:
+                self._update_run_log("Non-zero return code ({0:d}) listing {1!r}", return_code, remote_source_path)
+                return []
+        return sorted(dirnames)
+
+    def _partition_dirs(self, dirnames, num_streams):
+        """Distribute the top level directories across the streams"""
+        num_streams = min(num_streams, len(dirnames))
+        return [dirnames[i::num_streams] for i in range(num_streams)]
+
+    def _merge_stream_stats(self, stream_stats, final_stats):
+        # The streams and the final pass each report the total size
+        # of what they checked, so only the final pass counts for those
+        merged = sum(stream_stats, final_stats)
+        return merged._replace(total_file_count=final_stats.total_file_count,
+                               total_bytes=final_stats.total_bytes)
+
+    def _fetch_dir_in_streams(self, remote_source_path, local_dest_path):
+        """Fetch the tree using multiple concurrent rsync sessions
+
+           Each session retrieves a subset of the top level directories
+           without deleting anything, then a final pass over the whole tree
+           picks up any remaining changes and handles deletions.
+        """
+        dirnames = self._list_top_level_dirs(remote_source_path)
+        if len(dirnames) < 2:
+            self._update_run_log("Not enough top level directories for parallel transfer")
+            return self.fetch_dir(remote_source_path, local_dest_path)
+        partitions = self._partition_dirs(dirnames, self.parallel_streams)
+        self._update_run_log("Fetching {0} top level directories in {1} parallel streams",
+                             len(dirnames), len(partitions))
+        log_level = self._run_log_state.indent_level
+        results = [(None, None)] * len(partitions)
+        workers = []
+        for index, partition in enumerate(partitions):
+            args = (results, index, log_level, self.fetch_dir,
+                    remote_source_path, local_dest_path, (), partition)
+            worker = threading.Thread(target=self._call_in_thread, args=args)
+            worker.start()
+            workers.append(worker)
+        stream_results = self._join_threads(workers, results)
+        stream_stats = []
+        for stream_result, stats in stream_results:
+            if stream_result not in (self.SYNC_COMPLETED, self.SYNC_UP_TO_DATE):
+                self._update_run_log("Parallel stream result was {0}, relying on final pass", stream_result)
+            stream_stats.append(stats)
+        self._update_run_log("Running final pass over entire tree")
+        result, final_stats = self.fetch_dir(remote_source_path, local_dest_path)
+        sync_stats = self._merge_stream_stats(stream_stats, final_stats)
+        if result in (self.SYNC_COMPLETED, self.SYNC_UP_TO_DATE):
+            if sync_stats.transferred_file_count > 0:
+                result = self.SYNC_COMPLETED
+            else:
+                result = self.SYNC_UP_TO_DATE
+        return result, sync_stats
+
+
+def _read_status(status_path):
+    """Returns the contents of a STATUS file (or None if it doesn't exist)"""
+    try:
+        with open(status_path) as f:
+            return f.read().strip()
+    except IOError as ex:
+        if ex.errno != errno.ENOENT:
+            raise
+    return None
+
+
+class LocalInventory(object):
+    """Cached listing of the local version directories in a mirror
+
+       The mirror is listed once, and the inventory is then updated as
+       versions are fetched and deleted rather than listing it again.
+       STATUS files are read when first needed and cached until the
+       corresponding version is refreshed.
+    """
+
+    def __init__(self, local_path, listing_pattern=u"*", excluded_dirs=()):
+        self.local_path = local_path
+        self.listing_pattern = listing_pattern
+        self.excluded_dirs = list(excluded_dirs)
+        self._lock = threading.Lock()
+        self._mtimes = {}
+        self._statuses = {}
+        self.load()
+
+    def _is_version_name(self, name):
+        if not fnmatch.fnmatch(name, self.listing_pattern):
+            return False
+        return not any(fnmatch.fnmatch(name, pattern)
+                           for pattern in self.excluded_dirs)
+
+    def _stat_version(self, name):
+        # Matches os.walk: symlinks to directories are listed as directories
+        try:
+            version_stat = os.stat(os.path.join(self.local_path, name))
+        except OSError:
+            return None
+        if not stat.S_ISDIR(version_stat.st_mode):
+            return None
+        return version_stat.st_mtime
+
+    def load(self):
+        """List the local path, discarding any cached details"""
+        try:
+            names = os.listdir(self.local_path)
+        except OSError as ex:
+            if ex.errno != errno.ENOENT:
+                raise
+            names = ()
+        mtimes = {}
+        for name in names:
+            if self._is_version_name(name):
+                mtime = self._stat_version(name)
+                if mtime is not None:
+                    mtimes[name] = mtime
+        with self._lock:
+            self._mtimes = mtimes
+            self._statuses = {}
+
+    def refresh(self, version_path):
+        """Update the details of a version that may have been modified"""
+        name = os.path.basename(os.path.normpath(version_path))
+        mtime = None
+        if self._is_version_name(name):
+            mtime = self._stat_version(name)
+        with self._lock:
+            self._statuses.pop(name, None)
+            if mtime is None:
+                self._mtimes.pop(name, None)
+            else:
+                self._mtimes[name] = mtime
+
+    def remove(self, version_path):
+        """Record the deletion of a version"""
+        name = os.path.basename(os.path.normpath(version_path))
+        with self._lock:
+            self._mtimes.pop(name, None)
+            self._statuses.pop(name, None)
+
+    def iter_paths(self):
+        """Yields the paths of the local versions in name order"""
+        with self._lock:
+            names = sorted(self._mtimes)
+        for name in names:
+            yield os.path.join(self.local_path, name)
+
+    def get_latest_path(self):
+        """Returns the path of the most recently modified local version"""
+        with self._lock:
+            candidates = [(mtime, os.path.join(self.local_path, name))
+                              for name, mtime in self._mtimes.iteritems()]
+        if not candidates:
+            return None
+        return max(candidates)[1]
+
+    def get_status(self, version_path):
+        """Returns the contents of a version's STATUS file (or None)"""
+        name = os.path.basename(os.path.normpath(version_path))
+        with self._lock:
+            try:
+                return self._statuses[name]
+            except KeyError:
+                pass
+        status = _read_status(os.path.join(self.local_path, name, "STATUS"))
+        with self._lock:
+            self._statuses[name] = status
+        return status
 
 
 class SyncVersionedTree(BaseSyncCommand):
     """Sync the contents of a directory containing multiple versions of a tree"""
     CONFIG_TYPE = sync_config.VersionedSyncConfig
 
+    _local_inventory = None
+
     def _build_remote_ls_rsync_params(self, remote_ls_path):
         """Construct rsync parameters to get a remote directory listing"""
         params = ["-nl"]
@@ -424,63 +1573,81 @@ class SyncVersionedTree(BaseSyncCommand):
         params.append(remote_ls_path)
         return params
 
-    def _scrape_rsync_remote_ls(self, data):
-        dir_entries = []
-        link_entries = []
-        for entry in re.finditer(_remote_ls_entry_pattern, data):
-            kind = entry.group("entry_kind")
-            details = entry.group("entry_details")
-            if kind == 'l':
-                link_entries.append(details.strip())
-            elif kind == 'd':
-                mtime = entry.group("mtime")
-                dir_entries.append((mtime, details.strip()))
-            else:
-                self._update_run_log("Unknown entry kind {0!r}", entry)
-        self._update_run_log("Identified directories {0!r}", dir_entries)
-        self._update_run_log("Identified symlinks {0!r}", link_entries)
-        return dir_entries, link_entries
+    def _scrape_rsync_remote_ls_entry(self, line, dir_entries, link_entries):
+        entry = _remote_ls_entry_pattern.match(line.rstrip("\r\n"))
+        if entry is None:
+            return
+        kind = entry.group("entry_kind")
+        details = entry.group("entry_details")
+        if kind == 'l':
+            link_entries.append(details.strip())
+        elif kind == 'd':
+            mtime = entry.group("mtime")
+            dir_entries.append((mtime, details.strip()))
+        else:
+            self._update_run_log("Unknown entry kind {0!r}", entry)
 
     def remote_ls(self, remote_ls_path):
         params = self._build_remote_ls_rsync_params(remote_ls_path)
         rsync_ls_command = ["rsync"] + params
         self._update_run_log("Getting remote listing for {0!r}", remote_ls_path)
-        dir_entries = link_entries = ()
+        listed = False
+        dir_entries = []
+        link_entries = []
+        def _scrape_entry(line):
+            self._scrape_rsync_remote_ls_entry(line, dir_entries, link_entries)
         with self._indent_run_log():
             try:
-                return_code, captured = self._run_shell_command(rsync_ls_command)
+                return_code = self._run_shell_command(rsync_ls_command,
+                                                      _scrape_entry)
+            except SyncCancelled:
+                raise
             except:
                 self._update_run_log(traceback.format_exc())
                 result_msg = "Exception while listing {0!r}"
             else:
                 if return_code == 0:
+                    listed = True
                     result_msg = "Successfully listed {0!r}"
                     with self._indent_run_log():
-                        dir_entries, link_entries = self._scrape_rsync_remote_ls(captured)
+                        self._update_run_log("Identified directories {0!r}", dir_entries)
+                        self._update_run_log("Identified symlinks {0!r}", link_entries)
                 else:
                     result_msg = "Non-zero return code ({0:d}) listing {{0!r}}".format(return_code)
             self._update_run_log(result_msg, remote_ls_path)
+        if not listed:
+            return (), ()
         return dir_entries, link_entries
 
+    def _load_local_inventory(self):
+        excluded_dirs = list(self.exclude_from_listing)
+        excluded_dirs.append(_LOCAL_METADATA_NAMES)
+        return LocalInventory(self.local_path, self.listing_pattern, excluded_dirs)
+
+    def _get_local_inventory(self):
+        # Outside a sync operation, the local path is listed every time
+        inventory = self._local_inventory
+        if inventory is None:
+            inventory = self._load_local_inventory()
+        return inventory
+
     def _iter_local_versions(self):
-        local_path = self.local_path
-        dir_info = shellutil.filtered_walk(local_path,
-                                           dir_pattern=self.listing_pattern,
-                                           excluded_dirs=self.exclude_from_listing,
-                                           depth=0).next()
-        for d in dir_info.subdirs:
-            yield os.path.join(local_path, d)
+        return self._get_local_inventory().iter_paths()
 
     def _get_initial_seed_paths(self):
         # By default, there are no initial seed paths
         return ()
 
-    def _iter_remote_versions(self, remote_dir_entries):
-        seed_paths = self._get_initial_seed_paths()
+    def _iter_remote_version_paths(self, remote_dir_entries):
         for mtime, version in sorted(remote_dir_entries):
             remote_version = self.remote_path + version
             remote_source_path = "rsync://{0}{1}/".format(self.remote_server, remote_version)
             local_dest_path = os.path.join(self.local_path, version)
+            yield remote_source_path, local_dest_path
+
+    def _iter_remote_versions(self, remote_dir_entries):
+        seed_paths = self._get_initial_seed_paths()
+        for remote_source_path, local_dest_path in self._iter_remote_version_paths(remote_dir_entries):
             yield remote_source_path, local_dest_path, seed_paths
             # If it exists, use the previous tree as the seed for the next one
             if os.path.isdir(local_dest_path):
@@ -549,7 +1716,7 @@ class SyncVersionedTree(BaseSyncCommand):
 
     def _delete_local_dirs(self, dirs_to_delete):
         local_path = self.local_path
-        deleted = 0
+        deleted = []
         with self._indent_run_log():
             for dirname in dirs_to_delete:
                 dirpath = os.path.join(local_path, dirname)
@@ -557,32 +1724,151 @@ class SyncVersionedTree(BaseSyncCommand):
                     self._update_run_log("Not deleting {0!r} (PROTECTED file found)", dirpath)
                     continue
                 self._update_run_log("Deleting {0!r} (not on remote server)", dirpath)
-                shutil.rmtree(dirpath)
-                deleted += 1
-        return deleted
+                self._delete_local_dir(dirpath)
+                deleted.append(dirpath)
+            self._forget_consolidated_dirs(deleted)
+            if self.trash_old_dirs:
+                self._reap_trash()
+        return len(deleted)
+
+    def _get_trash_path(self):
+        return os.path.join(self.local_path, trash.TRASH_NAME)
+
+    def _delete_local_dir(self, dirpath):
+        inventory = self._local_inventory
+        if inventory is not None:
+            inventory.remove(dirpath)
+        if self.trash_old_dirs:
+            try:
+                trashed_path = trash.move_to_trash(dirpath, self._get_trash_path())
+            except OSError as ex:
+                if ex.errno != errno.EXDEV:
+                    raise
+                self._update_run_log("  Trash is on a different filesystem, deleting immediately")
+            else:
+                self._update_run_log("  Moved to {0!r}", trashed_path)
+                return
+        shutil.rmtree(dirpath)
+
+    def _reap_trash(self):
+        """Start a background process to empty the trash (if necessary)"""
+        trash_path = self._get_trash_path()
+        if not trash.list_trash(trash_path):
+            return
+        self._update_run_log("Starting background deletion of {0!r}", trash_path)
+        try:
+            return_code = trash.start_reaper(trash_path, python=self.reaper_python)
+        except:
+            self._update_run_log(traceback.format_exc())
+        else:
+            if return_code == 0:
+                return
+            self._update_run_log("Reaper exited with return code {0:d}", return_code)
+        self._update_run_log("Failed to start background deletion, deleting immediately")
+        if trash.reap(trash_path) is None:
+            self._update_run_log("Trash is already being emptied by another process")
+
+    def _prepare_remote_versions(self, remote_dir_entries):
+        """Hook to gather details of all remote versions before fetching them"""
+        pass
+
+    def _get_max_parallel_fetches(self):
+        return max(self.max_parallel_fetches, 1)
+
+    def _fetch_version(self, remote_source_path, local_dest_path, local_seed_paths):
+        """Fetch a single version, returning None if it was skipped"""
+        self._update_run_log("Preparing to download {0!r} -> {1!r}", remote_source_path, local_dest_path)
+        if self._already_retrieved(local_dest_path):
+            self._update_run_log("Skipping download for {0!r} -> {1!r} (already completed)", remote_source_path, local_dest_path)
+            return None
+        if not self._should_retrieve(remote_source_path):
+            self._update_run_log("Skipping download for {0!r} -> {1!r} (source not ready)", remote_source_path, local_dest_path)
+            return None
+        fetch_path = self._get_fetch_path(local_dest_path)
+        version = os.path.basename(os.path.normpath(local_dest_path))
+        try:
+            with self._timed_phase("transfer", version):
+                return self.fetch_dir(remote_source_path, fetch_path, local_seed_paths)
+        finally:
+            inventory = self._local_inventory
+            if inventory is not None:
+                inventory.refresh(local_dest_path)
+
+    def _get_fetch_path(self, local_dest_path):
+        """Returns the path where a version should be retrieved"""
+        return local_dest_path
+
+    def _fetch_versions(self, remote_dir_entries):
+        for remote_source_path, local_dest_path, local_seed_paths in self._iter_remote_versions(remote_dir_entries):
+            fetch_result = self._fetch_version(remote_source_path, local_dest_path, local_seed_paths)
+            if fetch_result is not None:
+                yield fetch_result
+
+    def _fetch_versions_in_parallel(self, remote_dir_entries, max_fetches):
+        """Fetch up to max_fetches versions at a time
+
+           To respect the seed chain, each version is seeded from the version
+           max_fetches places earlier in the sequence, and isn't started
+           until that version has finished. With max_fetches set to 1, this
+           is the same seed chain as is used for sequential fetches.
+        """
+        self._update_run_log("Fetching up to {0} versions in parallel", max_fetches)
+        log_level = self._run_log_state.indent_level
+        initial_seed_paths = self._get_initial_seed_paths()
+        versions = list(self._iter_remote_version_paths(remote_dir_entries))
+        results = [(None, None)] * len(versions)
+        all_seed_paths = []
+        workers = []
+        for index, (remote_source_path, local_dest_path) in enumerate(versions):
+            seed_index = index - max_fetches
+            if seed_index < 0:
+                seed_paths = initial_seed_paths
+            else:
+                # Wait for the seed version to land before starting
+                workers[seed_index].join()
+                seed_dest_path = versions[seed_index][1]
+                if os.path.isdir(seed_dest_path):
+                    seed_paths = (seed_dest_path,)
+                else:
+                    seed_paths = all_seed_paths[seed_index]
+            all_seed_paths.append(seed_paths)
+            args = (results, index, log_level, self._fetch_version,
+                    remote_source_path, local_dest_path, seed_paths)
+            worker = threading.Thread(target=self._call_in_thread, args=args)
+            worker.start()
+            workers.append(worker)
+        fetch_results = self._join_threads(workers, results)
+        return [result for result in fetch_results if result is not None]
 
     def _do_transfer(self):
+        self._local_inventory = self._load_local_inventory()
+        try:
+            return self._transfer_versions()
+        finally:
+            self._local_inventory = None
+
+    def _transfer_versions(self):
         sync_stats = _null_sync_stats
         remote_pattern = os.path.join(self.remote_path, self.listing_pattern)
         remote_ls_path = "rsync://{0}{1}".format(self.remote_server, remote_pattern)
-        dir_entries, link_entries = self.remote_ls(remote_ls_path)
+        with self._timed_phase("remote_listing"):
+            dir_entries, link_entries = self.remote_ls(remote_ls_path)
         if not dir_entries:
             self._update_run_log("No relevant directories found at {0!r}", remote_ls_path)
             return self.SYNC_FAILED, sync_stats
+        self._prepare_remote_versions(dir_entries)
+        max_fetches = self._get_max_parallel_fetches()
+        if max_fetches > 1:
+            fetch_results = self._fetch_versions_in_parallel(dir_entries, max_fetches)
+        else:
+            fetch_results = self._fetch_versions(dir_entries)
         tallies = collections.defaultdict(int)
-        for remote_source_path, local_dest_path, local_seed_paths in self._iter_remote_versions(dir_entries):
-            self._update_run_log("Preparing to download {0!r} -> {1!r}", remote_source_path, local_dest_path)
-            if self._already_retrieved(local_dest_path):
-                self._update_run_log("Skipping download for {0!r} -> {1!r} (already completed)", remote_source_path, local_dest_path)
-                continue
-            if not self._should_retrieve(remote_source_path):
-                self._update_run_log("Skipping download for {0!r} -> {1!r} (source not ready)", remote_source_path, local_dest_path)
-                continue
-            dir_result, dir_stats = self.fetch_dir(remote_source_path, local_dest_path, local_seed_paths)
+        for dir_result, dir_stats in fetch_results:
             tallies[dir_result] += 1
             sync_stats += dir_stats
         if link_entries:
-            self._fix_link_entries(link_entries)
+            with self._timed_phase("fix_links"):
+                self._fix_link_entries(link_entries)
         up_to_date = tallies[self.SYNC_UP_TO_DATE]
         completed = tallies[self.SYNC_COMPLETED]
         partial = tallies[self.SYNC_PARTIAL]
@@ -592,7 +1878,8 @@ class SyncVersionedTree(BaseSyncCommand):
             if failed or partial:
                 self._update_run_log("Errors occurred, not deleting old directories in {0!r}", self.local_path)
             else:
-                deleted = self._delete_old_dirs(dir_entries)
+                with self._timed_phase("delete_old_dirs"):
+                    deleted = self._delete_old_dirs(dir_entries)
         if failed and not (partial or completed or up_to_date):
             # Absolutely nothing worked
             result = self.SYNC_FAILED
@@ -611,6 +1898,9 @@ class SyncSnapshotTree(SyncVersionedTree):
     """Sync the contents of a directory containing multiple snapshots of a tree"""
     CONFIG_TYPE = sync_config.SnapshotSyncConfig
 
+    _deferred_latest_paths = None
+    _remote_status = None
+
     def _find_latest_remote_version(self, remote_dir_entries):
         seed_paths = self._get_initial_seed_paths()
         for mtime, dir_entry in sorted(remote_dir_entries, reverse=True):
@@ -630,21 +1920,163 @@ class SyncSnapshotTree(SyncVersionedTree):
             return self._find_latest_remote_version(remote_dir_entries)
         return super(SyncSnapshotTree, self)._iter_remote_versions(remote_dir_entries)
 
+    def _get_max_parallel_fetches(self):
+        # Finding the latest version is inherently sequential
+        if self.sync_latest_only:
+            return 1
+        return super(SyncSnapshotTree, self)._get_max_parallel_fetches()
+
+    def _get_staging_path(self):
+        return os.path.join(self.local_path, _STAGING_NAME)
+
+    def _get_fetch_path(self, local_dest_path):
+        # New snapshots are built in the staging directory, so they only
+        # become visible once they are complete
+        if (not self.staged_publication or self.dry_run_only or
+                os.path.lexists(local_dest_path)):
+            return local_dest_path
+        staging_path = self._get_staging_path()
+        try:
+            os.makedirs(staging_path)
+        except OSError as ex:
+            if ex.errno != errno.EEXIST:
+                raise
+        return os.path.join(staging_path,
+                            os.path.basename(os.path.normpath(local_dest_path)))
+
+    def _get_published_path(self, local_dest_path):
+        dirname, version = os.path.split(os.path.normpath(local_dest_path))
+        if dirname != os.path.normpath(self._get_staging_path()):
+            return local_dest_path
+        return os.path.join(self.local_path, version)
+
+    def _publish_staged_version(self, staged_path):
+        """Atomically rename a complete staged snapshot into place"""
+        published_path = self._get_published_path(staged_path)
+        if published_path != staged_path:
+            self._update_run_log("Publishing {0!r} as {1!r}", staged_path, published_path)
+            os.rename(staged_path, published_path)
+        return published_path
+
+    def _remove_staging_dir(self):
+        # Incomplete snapshots are left in place to be resumed later
+        try:
+            os.rmdir(self._get_staging_path())
+        except OSError as ex:
+            if ex.errno not in (errno.ENOENT, errno.ENOTEMPTY, errno.EEXIST):
+                raise
+
+    def _do_transfer(self):
+        try:
+            return super(SyncSnapshotTree, self)._do_transfer()
+        finally:
+            if self.staged_publication:
+                self._remove_staging_dir()
+
+    def _fetch_versions_in_parallel(self, remote_dir_entries, max_fetches):
+        # Versions may finish in any order, so the latest link is only
+        # updated once all of the fetch operations are complete
+        self._deferred_latest_paths = deferred = set()
+        try:
+            fetch_results = (super(SyncSnapshotTree, self).
+                               _fetch_versions_in_parallel(remote_dir_entries,
+                                                           max_fetches))
+        finally:
+            self._deferred_latest_paths = None
+        latest_path = None
+        for __, local_dest_path in self._iter_remote_version_paths(remote_dir_entries):
+            if local_dest_path in deferred:
+                latest_path = local_dest_path
+        if latest_path is not None:
+            self._link_to_latest(latest_path)
+        return fetch_results
+
     def _already_retrieved(self, local_dest_path):
-        local_status_path = os.path.join(local_dest_path, "STATUS")
         with self._indent_run_log():
             self._update_run_log("Checking for STATUS file in {0!r}", local_dest_path)
             with self._indent_run_log():
-                if os.path.exists(local_status_path):
-                    with open(local_status_path) as f:
-                        status = f.read().strip()
-                        self._update_run_log("Current status of {0!r} is {1!r}", local_dest_path, status)
-                        return status == "FINISHED"
+                status = self._get_local_inventory().get_status(local_dest_path)
+                if status is not None:
+                    self._update_run_log("Current status of {0!r} is {1!r}", local_dest_path, status)
+                    return status == "FINISHED"
                 else:
                     self._update_run_log("No STATUS file found in {0!r}", local_dest_path)
         return False
 
+    def _build_status_probe_rsync_params(self, filter_path, local_dest_path):
+        """Construct rsync parameters to fetch the STATUS files of all versions"""
+        params = ["-r"]
+        params.extend(self._build_common_rsync_params())
+        params.append("--include-from={0}".format(filter_path))
+        params.append("--exclude=*")
+        params.append("rsync://{0}{1}".format(self.remote_server, self.remote_path))
+        params.append(local_dest_path)
+        return params
+
+    def _prepare_remote_versions(self, remote_dir_entries):
+        with self._timed_phase("status_probe"):
+            self._remote_status = self._probe_remote_status(remote_dir_entries)
+
+    def _probe_remote_status(self, remote_dir_entries):
+        """Retrieves the STATUS files for all remote versions with one rsync call
+
+           Returns a mapping from remote source paths to the contents of the
+           STATUS file (or None if there is no STATUS file). Versions that
+           couldn't be checked are omitted.
+        """
+        versions = [version for mtime, version in remote_dir_entries]
+        remote_status = {}
+        self._update_run_log("Checking for STATUS files in {0} remote directories", len(versions))
+        with shellutil.temp_dir() as tmpdir:
+          with self._indent_run_log():
+            filter_path = os.path.join(tmpdir, "status_filters")
+            with open(filter_path, 'w') as f:
+                for version in versions:
+                    pattern = "/" + _escape_rsync_pattern(version)
+                    f.write(pattern + "/\n")
+                    f.write(pattern + "/STATUS\n")
+            local_status_dir = os.path.join(tmpdir, "status")
+            params = self._build_status_probe_rsync_params(filter_path,
+                                                           local_status_dir + "/")
+            rsync_status_command = ["rsync"] + params
+            try:
+                return_code = self._run_shell_command(rsync_status_command)
+            except SyncCancelled:
+                raise
+            except:
+                self._update_run_log(traceback.format_exc())
+                self._update_run_log("Exception while checking remote STATUS files")
+                return remote_status
+            if return_code not in (0, 23):
+                self._update_run_log("Non-zero return code ({0:d}) checking remote STATUS files", return_code)
+                return remote_status
+            for remote_source_path, local_dest_path in self._iter_remote_version_paths(remote_dir_entries):
+                version = os.path.basename(local_dest_path)
+                tmp_local_status = os.path.join(local_status_dir, version, "STATUS")
+                if os.path.exists(tmp_local_status):
+                    with open(tmp_local_status) as f:
+                        remote_status[remote_source_path] = f.read().strip()
+                elif return_code == 0:
+                    remote_status[remote_source_path] = None
+            if return_code != 0:
+                self._update_run_log("Partial results ({0:d}) checking remote STATUS files", return_code)
+        return remote_status
+
     def _should_retrieve(self, remote_source_path):
+        remote_status = self._remote_status
+        if remote_status is not None and remote_source_path in remote_status:
+            status = remote_status[remote_source_path]
+            with self._indent_run_log():
+                if status is None:
+                    self._update_run_log("No STATUS file found in {0!r}", remote_source_path)
+                    return False
+                self._update_run_log("Current status of {0!r} is {1!r}", remote_source_path, status)
+                return status == "FINISHED"
+        version = os.path.basename(os.path.normpath(remote_source_path))
+        with self._timed_phase("status_probe", version):
+            return self._check_remote_status(remote_source_path)
+
+    def _check_remote_status(self, remote_source_path):
         with shellutil.temp_dir() as tmpdir:
           with self._indent_run_log():
             tmp_local_status = os.path.join(tmpdir, "STATUS")
@@ -656,7 +2088,9 @@ class SyncSnapshotTree(SyncVersionedTree):
             with self._indent_run_log():
                 rsync_status_command = ["rsync"] + params
                 try:
-                    return_code, __ = self._run_shell_command(rsync_status_command)
+                    return_code = self._run_shell_command(rsync_status_command)
+                except SyncCancelled:
+                    raise
                 except:
                     self._update_run_log(traceback.format_exc())
                     result_msg = "Exception while attempting to check status of {0!r}"
@@ -681,11 +2115,28 @@ class SyncSnapshotTree(SyncVersionedTree):
             return result
         result = self.SYNC_COMPLETED
         if not self.dry_run_only:
+            if self.manifest_name:
+                # Written first, so every finished snapshot has a manifest
+                self._write_manifest(local_dest_path)
             with open(status_path, 'w') as f:
                 f.write("FINISHED\n")
-            self._link_to_latest(local_dest_path)
+            local_dest_path = self._publish_staged_version(local_dest_path)
+            if self._deferred_latest_paths is not None:
+                self._deferred_latest_paths.add(local_dest_path)
+            else:
+                self._link_to_latest(local_dest_path)
         return result
 
+    def _write_manifest(self, local_dest_path):
+        """Describe the snapshot for sites that sync from this one"""
+        self._update_run_log("Writing manifest {0!r}", self.manifest_name)
+        version = os.path.basename(os.path.normpath(local_dest_path))
+        with self._timed_phase("manifest", version):
+            entries = manifest.update_manifest(local_dest_path, self.manifest_name,
+                                               self.exclude_from_sync)
+        with self._indent_run_log():
+            self._update_run_log("Listed {0} files", len(entries))
+
     def _get_latest_dir(self):
         # Preferred approach is to use the symbolic link to the latest version
         link_name = self.latest_link_name
@@ -695,14 +2146,7 @@ class SyncSnapshotTree(SyncVersionedTree):
                 target_path = os.path.join(link_path, os.readlink(link_path))
                 return os.path.abspath(target_path)
         # If that's not available, we rely on the local mtime
-        def _sort_key(d):
-            return os.path.getmtime(d), d
-        candidates = self._iter_local_versions()
-        try:
-            return max(candidates, key=_sort_key)
-        except ValueError:
-            pass
-        return None
+        return self._get_local_inventory().get_latest_path()
 
     def _get_initial_seed_paths(self):
         # Use the most recent local dir as the initial seed path
@@ -736,30 +2180,273 @@ class SyncSnapshotTree(SyncVersionedTree):
             if target_path is None:
                 self._update_run_log("No valid target versions in {0!r}, skipping", local_path)
                 return
-            relative_target = os.path.relpath(target_path, os.path.dirname(link_path))
-            if os.path.isdir(link_path):
-                if os.path.islink(link_path):
-                    if os.readlink(link_path) == relative_target:
-                        self._update_run_log("Link {0!r} -> {1!r} already exists", link_path, relative_target)
-                        return
-                    os.unlink(link_path)
-                else:
-                    self._update_run_log("Existing latest directory, {0!r}, is not a symbolic link, deleting it", link_path)
-                    shutil.rmtree(link_path)
+            link_dir, link_base = os.path.split(link_path)
+            relative_target = os.path.relpath(target_path, link_dir)
+            if os.path.islink(link_path):
+                if os.readlink(link_path) == relative_target:
+                    self._update_run_log("Link {0!r} -> {1!r} already exists", link_path, relative_target)
+                    return
+            elif os.path.isdir(link_path):
+                self._update_run_log("Existing latest directory, {0!r}, is not a symbolic link, deleting it", link_path)
+                shutil.rmtree(link_path)
             elif os.path.lexists(link_path):
                 self._update_run_log("Existing entry, {0!r}, is not a directory, deleting it", link_path)
                 os.unlink(link_path)
-            os.symlink(relative_target, link_path)
+            # The new link replaces the old one with a rename, so the
+            # latest link never disappears, even briefly
+            temp_link_path = os.path.join(link_dir, ".pulpdist-{0}.{1}".format(link_base, os.getpid()))
+            if os.path.lexists(temp_link_path):
+                os.unlink(temp_link_path)
+            os.symlink(relative_target, temp_link_path)
+            os.rename(temp_link_path, link_path)
             self._update_run_log("Linked {0!r} -> {1!r}", link_path, relative_target)
 
 
-class SyncSnapshotDelta(BaseSyncCommand):
-    """Create an rsync delta from a snapshot directory"""
+# Options used both when writing and when reading rsync batch files
+_BASE_DELTA_PARAMS = "-rlptDvH --delete-after --stats --itemize-changes".split()
 
-    def __init__(self):
-        raise NotImplemented("Depends on Pulp plugin details")
+class SyncSnapshotDelta(SyncSnapshotTree):
+    """Sync a snapshot tree, then create rsync deltas between the snapshots
 
-class SyncFromDelta(BaseSyncCommand):
-    """Create a new local snapshots from an upstream delta"""
-    def __init__(self):
-        raise NotImplemented("Depends on Pulp plugin details")
+       For each pair of consecutive finished snapshots, an rsync batch file
+       is written to delta_path/<version>/batch that updates the previous
+       snapshot (named in delta_path/<version>/BASE) to the given version.
+       The deltas are only computed once and may then be applied by any
+       number of downstream sites (see SyncFromDelta).
+    """
+    CONFIG_TYPE = sync_config.SnapshotDeltaSyncConfig
+
+    _remote_dir_entries = ()
+
+    def _prepare_remote_versions(self, remote_dir_entries):
+        super(SyncSnapshotDelta, self)._prepare_remote_versions(remote_dir_entries)
+        self._remote_dir_entries = remote_dir_entries
+
+    def _do_transfer(self):
+        result, sync_stats = super(SyncSnapshotDelta, self)._do_transfer()
+        if result == self.SYNC_FAILED:
+            return result, sync_stats
+        if self.dry_run_only:
+            self._update_run_log("Not generating deltas for test run")
+            return result, sync_stats
+        self._update_run_log("Generating deltas in {0!r}", self.delta_path)
+        with self._indent_run_log():
+            with self._timed_phase("delta_generation"):
+                created, failed = self._generate_deltas()
+        if failed:
+            result = self.SYNC_PARTIAL
+        elif created and result == self.SYNC_UP_TO_DATE:
+            result = self.SYNC_COMPLETED
+        return result, sync_stats
+
+    def _iter_delta_pairs(self):
+        previous = None
+        for __, local_dest_path in self._iter_remote_version_paths(self._remote_dir_entries):
+            if _read_status(os.path.join(local_dest_path, "STATUS")) != "FINISHED":
+                continue
+            if previous is not None:
+                yield previous, local_dest_path
+            previous = local_dest_path
+
+    def _generate_deltas(self):
+        created = failed = 0
+        delta_path = self.delta_path
+        if not os.path.isdir(delta_path):
+            os.makedirs(delta_path)
+        for base_path, target_path in self._iter_delta_pairs():
+            target = os.path.basename(target_path)
+            target_delta_path = os.path.join(delta_path, target)
+            status = _read_status(os.path.join(target_delta_path, "STATUS"))
+            if status == "FINISHED":
+                continue
+            if self._write_delta(base_path, target_path, target_delta_path):
+                created += 1
+            else:
+                failed += 1
+        return created, failed
+
+    def _build_write_delta_rsync_params(self, batch_path, base_path, target_path):
+        """Construct rsync parameters to write a delta between two snapshots"""
+        params = _BASE_DELTA_PARAMS[:]
+        for excluded_file in ("/STATUS", "/.STATUS"):
+            params.append("--exclude={0}".format(excluded_file))
+        params.append("--only-write-batch={0}".format(batch_path))
+        params.append(os.path.join(target_path, ""))
+        params.append(os.path.join(base_path, ""))
+        return params
+
+    def _write_delta(self, base_path, target_path, target_delta_path):
+        base = os.path.basename(base_path)
+        self._update_run_log("Writing delta {0!r} -> {1!r}", base_path, target_path)
+        # Build the delta in a temporary directory, so downstream sites
+        # never see an incomplete delta
+        tmp_delta_path = tempfile.mkdtemp(dir=self.delta_path, prefix=".tmp-")
+        try:
+            batch_path = os.path.join(tmp_delta_path, "batch")
+            params = self._build_write_delta_rsync_params(batch_path, base_path,
+                                                          target_path)
+            with self._indent_run_log():
+                try:
+                    return_code = self._run_shell_command(["rsync"] + params)
+                except SyncCancelled:
+                    raise
+                except:
+                    self._update_run_log(traceback.format_exc())
+                    self._update_run_log("Exception while writing delta for {0!r}", target_path)
+                    return False
+                if return_code != 0:
+                    self._update_run_log("Non-zero return code ({0:d}) writing delta for {1!r}", return_code, target_path)
+                    return False
+            # rsync also writes out a shell script that isn't needed here
+            batch_script = batch_path + ".sh"
+            if os.path.exists(batch_script):
+                os.unlink(batch_script)
+            with open(os.path.join(tmp_delta_path, "BASE"), 'w') as f:
+                f.write(base + "\n")
+            with open(os.path.join(tmp_delta_path, "STATUS"), 'w') as f:
+                f.write("FINISHED\n")
+            os.chmod(tmp_delta_path, 0755)
+            if os.path.lexists(target_delta_path):
+                shutil.rmtree(target_delta_path)
+            os.rename(tmp_delta_path, target_delta_path)
+        finally:
+            if os.path.exists(tmp_delta_path):
+                shutil.rmtree(tmp_delta_path)
+        self._update_run_log("Created delta {0!r}", target_delta_path)
+        return True
+
+
+class SyncFromDelta(SyncSnapshotTree):
+    """Sync a snapshot tree, using upstream deltas where possible
+
+       Before fetching a snapshot, the corresponding delta is retrieved
+       from remote_delta_path. If the snapshot it applies to has already
+       been retrieved, that snapshot is copied and the delta is applied to
+       the copy. Otherwise, or if anything goes wrong, the snapshot is
+       fetched with a normal rsync operation.
+    """
+    CONFIG_TYPE = sync_config.DeltaSyncConfig
+
+    def _can_use_deltas(self):
+        # Deltas reflect the complete upstream tree, so they can't be
+        # used if this tree is filtered differently
+        default_excludes = set(sync_config.SnapshotSyncConfig.DEFAULT_EXCLUDES)
+        return not self.sync_filters and set(self.exclude_from_sync) <= default_excludes
+
+    def fetch_dir(self, remote_source_path, local_dest_path, local_seed_paths=(),
+                  partition=None):
+        if partition is None and not self.dry_run_only and self._can_use_deltas():
+            delta_result = self._fetch_from_delta(remote_source_path, local_dest_path)
+            if delta_result is not None:
+                return delta_result
+        return super(SyncFromDelta, self).fetch_dir(remote_source_path,
+                                                    local_dest_path,
+                                                    local_seed_paths,
+                                                    partition)
+
+    def _build_fetch_delta_rsync_params(self, version, local_delta_path):
+        """Construct rsync parameters to retrieve the delta for a version"""
+        params = ["-rlptv"]
+        params.extend(self._build_common_rsync_params())
+        if self.bandwidth_limit:
+            params.append("--bwlimit={0}".format(self.bandwidth_limit))
+        remote_delta = "{0}{1}/".format(self.remote_delta_path, version)
+        params.append("rsync://{0}{1}".format(self.remote_server, remote_delta))
+        params.append(local_delta_path)
+        return params
+
+    def _build_read_delta_rsync_params(self, batch_path, local_dest_path):
+        """Construct rsync parameters to apply a delta to a local tree"""
+        params = _BASE_DELTA_PARAMS[:]
+        params.append("--read-batch={0}".format(batch_path))
+        params.append(os.path.join(local_dest_path, ""))
+        return params
+
+    def _fetch_from_delta(self, remote_source_path, local_dest_path):
+        """Returns the result of applying a delta, or None if it wasn't possible"""
+        if os.path.lexists(local_dest_path):
+            # Deltas can only be applied to an exact copy of the base
+            return None
+        version = os.path.basename(os.path.normpath(local_dest_path))
+        local_delta_path = tempfile.mkdtemp(dir=self.local_path, prefix=".pulpdist-delta-")
+        try:
+            self._update_run_log("Checking for delta for {0!r}", version)
+            with self._indent_run_log():
+                base_path = self._retrieve_delta(version, local_delta_path)
+                if base_path is None:
+                    return None
+                return self._apply_delta(remote_source_path, local_dest_path,
+                                         base_path, local_delta_path)
+        finally:
+            shutil.rmtree(local_delta_path)
+
+    def _retrieve_delta(self, version, local_delta_path):
+        """Returns the path to the local base snapshot for a retrieved delta"""
+        params = self._build_fetch_delta_rsync_params(version, local_delta_path + "/")
+        try:
+            return_code = self._run_shell_command(["rsync"] + params)
+        except SyncCancelled:
+            raise
+        except:
+            self._update_run_log(traceback.format_exc())
+            self._update_run_log("Exception while retrieving delta for {0!r}", version)
+            return None
+        if return_code != 0:
+            self._update_run_log("No delta retrieved for {0!r} ({1:d})", version, return_code)
+            return None
+        if _read_status(os.path.join(local_delta_path, "STATUS")) != "FINISHED":
+            self._update_run_log("Delta for {0!r} is not complete", version)
+            return None
+        base = _read_status(os.path.join(local_delta_path, "BASE"))
+        if not base or os.sep in base or base in (os.curdir, os.pardir):
+            self._update_run_log("Delta for {0!r} has an invalid BASE file", version)
+            return None
+        base_path = os.path.join(self.local_path, base)
+        if _read_status(os.path.join(base_path, "STATUS")) != "FINISHED":
+            self._update_run_log("Base snapshot {0!r} not available locally", base_path)
+            return None
+        return base_path
+
+    def _apply_delta(self, remote_source_path, local_dest_path, base_path, local_delta_path):
+        self._update_run_log("Applying delta to copy of {0!r}", base_path)
+        # The base tree is copied rather than cloned with hard links, as
+        # rsync applies mode and mtime changes to unchanged files in place,
+        # which would also modify the published base snapshot
+        clone_command = ["cp", "-a", "--reflink=auto",
+                         os.path.normpath(base_path),
+                         os.path.normpath(local_dest_path)]
+        batch_path = os.path.join(local_delta_path, "batch")
+        params = self._build_read_delta_rsync_params(batch_path, local_dest_path)
+        change_handler = functools.partial(self._record_itemized_change,
+                                           local_dest_path)
+        parser = RsyncOutputParser(itemized_change_handler=change_handler)
+        try:
+            if self._run_shell_command(clone_command) != 0:
+                raise RuntimeError("Failed to copy {0!r}".format(base_path))
+            for status_file in ("STATUS", ".STATUS"):
+                status_path = os.path.join(local_dest_path, status_file)
+                if os.path.lexists(status_path):
+                    os.unlink(status_path)
+            return_code = self._run_shell_command(["rsync"] + params,
+                                                  parser.feed)
+            if return_code != 0:
+                raise RuntimeError("Non-zero return code ({0:d}) applying delta".format(return_code))
+        except:
+            exc_info = sys.exc_info()
+            self._update_run_log(traceback.format_exc())
+            self._update_run_log("Failed to apply delta to {0!r}, removing it", local_dest_path)
+            if os.path.lexists(local_dest_path):
+                shutil.rmtree(local_dest_path)
+            if isinstance(exc_info[1], SyncCancelled):
+                raise exc_info[0], exc_info[1], exc_info[2]
+            return None
+        try:
+            rsync_stats = parser.get_stats()
+        except ValueError:
+            # Some versions of rsync don't report stats when reading a batch
+            transferred = parser.change_counts[">f"]
+            rsync_stats = _null_sync_stats._replace(transferred_file_count=transferred)
+        result = self._fetch_dir_complete(self.SYNC_COMPLETED, remote_source_path,
+                                          local_dest_path)
+        self._update_run_log("Successfully updated {0!r} from delta", local_dest_path)
+        return result, rsync_stats
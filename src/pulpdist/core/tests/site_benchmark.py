@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2012 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+"""Benchmarks for loading and querying large site configurations
+
+Synthetic sites are generated with the requested number of mirrors (and a
+proportional number of trees, sources and servers), then the main SiteConfig
+operations are timed. Each site size is benchmarked in a separate process,
+so the peak memory usage reported for each size is independent of the others.
+
+Results are written to a JSON file, and may be compared with the results
+from another revision to pick up regressions::
+
+    $ python -m pulpdist.core.tests.site_benchmark --mirrors 1000 10000 \\
+          --output new.json --compare old.json
+"""
+
+import argparse
+import json
+import multiprocessing
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from .. import site_config, util
+
+DEFAULT_MIRROR_COUNTS = (1000, 10000)
+DEFAULT_OUTPUT = "site_benchmark.json"
+
+# Timings shorter than this (in seconds) are too noisy to compare
+_MIN_COMPARED_SECONDS = 0.05
+
+# Number of IDs used in each dimension of the filtered queries
+_NUM_FILTER_IDS = 100
+
+_SYNC_TYPES = ("simple", "versioned", "snapshot")
+
+
+def make_site_config(num_mirrors, num_trees=None, num_sources=None,
+                     num_servers=None, num_sites=3):
+    """Returns a valid site config with the given number of mirrors
+
+       By default, each tree is mirrored at two sites, each source provides
+       50 trees and each server provides 5 sources.
+    """
+    if num_trees is None:
+        num_trees = max(1, num_mirrors // 2)
+    if num_sources is None:
+        num_sources = max(1, num_trees // 50)
+    if num_servers is None:
+        num_servers = max(1, num_sources // 5)
+    servers = [{
+        u"server_id": u"server_{0}".format(i),
+        u"name": u"Benchmark server {0}".format(i),
+        u"dns": u"server{0}.example.com".format(i),
+    } for i in range(num_servers)]
+    sources = [{
+        u"source_id": u"source_{0}".format(i),
+        u"server_id": u"server_{0}".format(i % num_servers),
+        u"name": u"Benchmark source {0}".format(i),
+        u"remote_path": u"data/source_{0}".format(i),
+        u"listing_suffix": u"*",
+    } for i in range(num_sources)]
+    trees = []
+    for i in range(num_trees):
+        sync_type = _SYNC_TYPES[i % len(_SYNC_TYPES)]
+        tree = {
+            u"tree_id": u"tree_{0}".format(i),
+            u"source_id": u"source_{0}".format(i % num_sources),
+            u"name": u"Benchmark tree {0}".format(i),
+            u"tree_path": u"tree_{0}".format(i),
+            u"sync_type": sync_type,
+            u"sync_hours": i % 24,
+            u"exclude_from_sync": [u"*.tmp"],
+        }
+        if sync_type == u"versioned":
+            tree[u"listing_pattern"] = u"v*"
+        elif sync_type == u"snapshot":
+            tree[u"listing_prefix"] = u"snap"
+            tree[u"latest_link"] = u"latest"
+        trees.append(tree)
+    site_ids = [u"default"] + [u"site_{0}".format(i) for i in range(1, num_sites)]
+    sites = [{
+        u"site_id": site_id,
+        u"name": u"Benchmark site {0}".format(site_id),
+        u"storage_prefix": u"/var/www/pub/{0}".format(site_id),
+        u"exclude_from_sync": [u"*.iso"],
+    } for site_id in site_ids]
+    sites[0][u"server_prefixes"] = dict(
+        (server[u"server_id"], server[u"server_id"]) for server in servers[:10])
+    mirrors = [{
+        u"mirror_id": u"mirror_{0}".format(i),
+        u"tree_id": u"tree_{0}".format(i % num_trees),
+        u"site_id": site_ids[i % num_sites],
+        u"enabled": True,
+        u"notes": {u"benchmark": i},
+    } for i in range(num_mirrors)]
+    return {
+        u"REMOTE_SERVERS": servers,
+        u"REMOTE_SOURCES": sources,
+        u"REMOTE_TREES": trees,
+        u"SITE_SETTINGS": sites,
+        u"LOCAL_MIRRORS": mirrors,
+        u"RAW_REPOS": [],
+    }
+
+def _copy_config(config):
+    return json.loads(json.dumps(config))
+
+def _peak_rss_kib():
+    # Linux reports ru_maxrss in KiB
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def run_benchmark(num_mirrors):
+    """Times the SiteConfig operations for a synthetic site
+
+       Returns a dict with the site entry "counts", the "timings" (in
+       seconds) and the "peak_rss_kib" of the process.
+    """
+    initial_rss = _peak_rss_kib()
+    config = make_site_config(num_mirrors)
+    counts = dict((section.lower(), len(entries))
+                       for section, entries in config.items())
+    timings = {}
+    def _timed(name, func, *args, **kwds):
+        start = time.time()
+        result = func(*args, **kwds)
+        timings[name] = time.time() - start
+        return result
+    # Full validation, then its main steps individually
+    site = site_config.SiteConfig(_copy_config(config))
+    _timed("validate", site.validate)
+    steps = site_config.SiteConfig(_copy_config(config))
+    _timed("validate_spec", steps._validate_spec)
+    _timed("populate_db", steps._populate_db)
+    _timed("convert_mirrors", site._convert_mirrors)
+    # Queries against the populated DB
+    mirror_ids = [mirror[u"mirror_id"] for mirror in
+                      config[u"LOCAL_MIRRORS"][::-1][:_NUM_FILTER_IDS]]
+    tree_ids = [tree[u"tree_id"] for tree in
+                    config[u"REMOTE_TREES"][:_NUM_FILTER_IDS]]
+    _timed("query_repos", lambda: list(site.query_repos()))
+    _timed("query_repos_filtered",
+           lambda: list(site.query_repos(mirrors=mirror_ids, trees=tree_ids)))
+    _timed("get_repo_configs", site.get_repo_configs)
+    # Revalidation after modifying a single mirror
+    modified = _copy_config(config)
+    modified[u"LOCAL_MIRRORS"][0][u"enabled"] = False
+    incremental = site_config.SiteConfig(modified, previous=site)
+    _timed("validate_incremental", incremental.validate)
+    # Opening a previously cached site DB
+    cache_dir = tempfile.mkdtemp()
+    try:
+        cached = site_config.SiteConfig(_copy_config(config), cache_dir=cache_dir)
+        _timed("validate_to_cache", cached.validate)
+        cached = site_config.SiteConfig(_copy_config(config), cache_dir=cache_dir)
+        _timed("validate_from_cache", cached.validate)
+    finally:
+        shutil.rmtree(cache_dir)
+    peak_rss = _peak_rss_kib()
+    return {
+        u"counts": counts,
+        u"timings": timings,
+        u"peak_rss_kib": peak_rss,
+        u"rss_growth_kib": peak_rss - initial_rss,
+    }
+
+def _get_revision():
+    try:
+        proc = subprocess.Popen(["git", "describe", "--always", "--dirty"],
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+    except OSError:
+        return None
+    output = proc.communicate()[0].strip()
+    if proc.returncode != 0:
+        return None
+    return output
+
+def run_benchmarks(mirror_counts, report=None):
+    """Benchmarks each site size in a fresh process"""
+    sizes = {}
+    for num_mirrors in mirror_counts:
+        if report is not None:
+            report("Benchmarking site with {0} mirrors".format(num_mirrors))
+        pool = multiprocessing.Pool(1)
+        try:
+            sizes[str(num_mirrors)] = pool.apply(run_benchmark, (num_mirrors,))
+        finally:
+            pool.close()
+            pool.join()
+    return {
+        u"pulpdist_version": util.__version__,
+        u"revision": _get_revision(),
+        u"python": platform.python_version(),
+        u"created": datetime.utcnow().isoformat(),
+        u"sizes": sizes,
+    }
+
+def compare_results(new, old, threshold=0.2):
+    """Compares two sets of benchmark results
+
+       Returns a list of (size, metric, old_value, new_value) tuples for
+       the timings and peak memory usage that increased by more than the
+       given fraction. Timings too short to measure reliably are ignored.
+    """
+    regressions = []
+    for size, new_entry in sorted(new[u"sizes"].items(), key=lambda item: int(item[0])):
+        old_entry = old[u"sizes"].get(size)
+        if old_entry is None:
+            continue
+        metrics = []
+        for name, seconds in sorted(new_entry[u"timings"].items()):
+            old_seconds = old_entry[u"timings"].get(name)
+            if old_seconds is None:
+                continue
+            if max(old_seconds, seconds) < _MIN_COMPARED_SECONDS:
+                continue
+            metrics.append((name, old_seconds, seconds))
+        metrics.append((u"peak_rss_kib", old_entry[u"peak_rss_kib"],
+                        new_entry[u"peak_rss_kib"]))
+        for name, old_value, new_value in metrics:
+            if new_value > old_value * (1 + threshold):
+                regressions.append((size, name, old_value, new_value))
+    return regressions
+
+def _format_results(results):
+    lines = []
+    for size, entry in sorted(results[u"sizes"].items(), key=lambda item: int(item[0])):
+        lines.append("{0} mirrors (peak RSS {1} KiB):".format(size, entry[u"peak_rss_kib"]))
+        for name, seconds in sorted(entry[u"timings"].items()):
+            lines.append("  {0}: {1:.3f}s".format(name, seconds))
+    return "\n".join(lines)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark SiteConfig with large sites")
+    parser.add_argument("--mirrors", metavar="NUM", type=int, nargs="+",
+                        default=list(DEFAULT_MIRROR_COUNTS),
+                        help="site sizes to benchmark (Default: %(default)s)")
+    parser.add_argument("--output", metavar="FILE", default=DEFAULT_OUTPUT,
+                        help="JSON file for the results (Default: %(default)s)")
+    parser.add_argument("--compare", metavar="FILE",
+                        help="earlier results to check for regressions")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="fractional increase reported as a regression "
+                             "(Default: %(default)s)")
+    args = parser.parse_args(argv)
+    def _report(msg):
+        print(msg)
+        sys.stdout.flush()
+    results = run_benchmarks(args.mirrors, _report)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print(_format_results(results))
+    print("Results written to {0}".format(args.output))
+    if args.compare is None:
+        return 0
+    with open(args.compare) as f:
+        old_results = json.load(f)
+    regressions = compare_results(results, old_results, args.threshold)
+    if not regressions:
+        print("No regressions relative to {0}".format(args.compare))
+        return 0
+    print("Regressions relative to {0}:".format(args.compare))
+    for size, name, old_value, new_value in regressions:
+        print("  {0} mirrors, {1}: {2:.3f} -> {3:.3f}".format(size, name,
+                                                          old_value, new_value))
+    return 1
+
+if __name__ == "__main__":
+    sys.exit(main())
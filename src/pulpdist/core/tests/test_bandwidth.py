@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2012 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+"""Test suite for the shared bandwidth budget"""
+
+import os.path
+import shutil
+import stat
+import tempfile
+
+from .compat import unittest
+from .. import bandwidth
+
+class TestBandwidthGovernor(unittest.TestCase):
+
+    def setUp(self):
+        self.registry_dir = registry_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, registry_dir)
+        self.governor = bandwidth.BandwidthGovernor(1000, registry_dir)
+
+    def test_invalid_budget(self):
+        self.assertRaises(ValueError, bandwidth.BandwidthGovernor, 0)
+
+    def test_shares(self):
+        governor = self.governor
+        self.assertEqual(governor.count_active_leases(), 0)
+        with governor.lease() as first:
+            self.assertEqual(first.share(), 1000)
+            with governor.lease() as second:
+                self.assertEqual(governor.count_active_leases(), 2)
+                self.assertEqual(first.share(), 500)
+                self.assertEqual(second.share(), 500)
+                with governor.lease():
+                    self.assertEqual(first.share(), 333)
+            self.assertEqual(first.share(), 1000)
+        self.assertEqual(os.listdir(self.registry_dir), [])
+
+    def test_minimum_share(self):
+        governor = bandwidth.BandwidthGovernor(1, self.registry_dir)
+        with governor.lease() as first:
+            with governor.lease():
+                self.assertEqual(first.share(), bandwidth.MIN_SHARE)
+
+    def test_stale_leases(self):
+        # Leases for processes that no longer exist are discarded
+        stale_path = os.path.join(self.registry_dir, "999999999.stale")
+        open(stale_path, 'w').close()
+        with open(os.path.join(self.registry_dir, "not-a-lease"), 'w'):
+            pass
+        with self.governor.lease() as lease:
+            self.assertEqual(lease.share(), 1000)
+        self.assertFalse(os.path.exists(stale_path))
+
+    def test_missing_registry(self):
+        registry_dir = os.path.join(self.registry_dir, "missing")
+        governor = bandwidth.BandwidthGovernor(1000, registry_dir)
+        self.assertEqual(governor.count_active_leases(), 0)
+        with governor.lease() as lease:
+            self.assertEqual(lease.share(), 1000)
+        self.assertEqual(stat.S_IMODE(os.stat(registry_dir).st_mode), 0755)
+
+    def test_shared_registry_rejected(self):
+        os.chmod(self.registry_dir, 01777)
+        with self.assertRaises(OSError):
+            with self.governor.lease():
+                pass
+        self.assertEqual(os.listdir(self.registry_dir), [])
+
+    def test_default_registry(self):
+        governor = bandwidth.BandwidthGovernor(1000)
+        self.assertFalse(governor.registry_dir.startswith(tempfile.gettempdir()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2012 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+"""Test suite for incremental hard link consolidation"""
+
+import shutil
+import tempfile
+import os.path
+
+from .compat import unittest
+from .. import hardlink_index
+
+_path = os.path.join
+
+class TestHardlinkIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.root = root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        for subdir in u"v1 v2".split():
+            os.makedirs(_path(root, subdir))
+        self.index = hardlink_index.HardlinkIndex(root)
+        self.index.open()
+        self.addCleanup(self.index.close)
+
+    def make_file(self, rel_path, contents="Hello world!", mtime=1000000000):
+        full_path = _path(self.root, rel_path)
+        with open(full_path, 'w') as f:
+            f.write(contents)
+        os.utime(full_path, (mtime, mtime))
+        return full_path
+
+    def test_full_scan(self):
+        first = self.make_file(u"v1/data.txt")
+        second = self.make_file(u"v2/data.txt")
+        other = self.make_file(u"v2/other.txt", "Different")
+        self.make_file(u".pulpdist-ignored", "Hello world!")
+        self.assertTrue(self.index.needs_full_scan())
+        stats = self.index.consolidate_all()
+        self.assertEqual(stats, (3, 1, len("Hello world!")))
+        self.assertFalse(self.index.needs_full_scan())
+        self.assertTrue(os.path.samefile(first, second))
+        self.assertFalse(os.path.samefile(first, other))
+        self.assertEqual(os.stat(first).st_mtime, 1000000000)
+
+    def test_incremental(self):
+        first = self.make_file(u"v1/data.txt")
+        self.index.consolidate_all()
+        second = self.make_file(u"v2/data.txt")
+        stats = self.index.consolidate([second])
+        self.assertEqual(stats.linked_files, 1)
+        self.assertTrue(os.path.samefile(first, second))
+        # Already linked files are left alone
+        stats = self.index.consolidate([second])
+        self.assertEqual(stats.linked_files, 0)
+
+    def test_metadata_mismatch(self):
+        first = self.make_file(u"v1/data.txt")
+        self.index.consolidate_all()
+        second = self.make_file(u"v2/data.txt", mtime=1000000001)
+        third = self.make_file(u"v2/data2.txt")
+        os.chmod(third, 0600)
+        stats = self.index.consolidate([second, third])
+        self.assertEqual(stats, (2, 0, 0))
+        self.assertFalse(os.path.samefile(first, second))
+        self.assertFalse(os.path.samefile(first, third))
+
+    def test_stale_entries(self):
+        first = self.make_file(u"v1/data.txt")
+        self.index.consolidate_all()
+        os.unlink(first)
+        second = self.make_file(u"v2/data.txt")
+        third = self.make_file(u"v2/data2.txt")
+        stats = self.index.consolidate([second, third])
+        self.assertEqual(stats.linked_files, 1)
+        self.assertTrue(os.path.samefile(second, third))
+
+    def test_forget(self):
+        self.make_file(u"v1/data.txt")
+        self.make_file(u"v2/data.txt", "Different")
+        self.index.consolidate_all()
+        self.index.forget(_path(self.root, u"v1"))
+        rows = self.index._db.execute("SELECT path FROM files").fetchall()
+        self.assertEqual(rows, [(_path(self.root, "v2", "data.txt"),)])
+
+    def test_shared_index(self):
+        other_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, other_root)
+        first = self.make_file(u"v1/data.txt")
+        self.index.consolidate_all()
+        second = _path(other_root, u"data.txt")
+        shutil.copy2(first, second)
+        index_path = self.index.index_path
+        other_index = hardlink_index.HardlinkIndex(other_root, index_path)
+        with other_index.opened():
+            self.assertTrue(other_index.needs_full_scan())
+            stats = other_index.consolidate_all()
+            self.assertFalse(other_index.needs_full_scan())
+        self.assertEqual(stats.linked_files, 1)
+        self.assertTrue(os.path.samefile(first, second))
+
+    def patch_module(self, name, value):
+        self.addCleanup(setattr, hardlink_index, name,
+                        getattr(hardlink_index, name))
+        setattr(hardlink_index, name, value)
+
+    def test_hashing_deferred(self):
+        hashed = []
+        file_digest = hardlink_index.file_digest
+        def _file_digest(path):
+            hashed.append(path)
+            return file_digest(path)
+        self.patch_module("file_digest", _file_digest)
+        first = self.make_file(u"v1/data.txt")
+        unique = self.make_file(u"v1/unique.txt", "Unique")
+        self.index.consolidate_all()
+        # Files are only hashed when another file has the same size
+        self.assertEqual(hashed, [])
+        digests = dict(self.index._db.execute("SELECT path, digest FROM files"))
+        self.assertEqual(set(digests.values()), set([None]))
+        second = self.make_file(u"v2/data.txt")
+        stats = self.index.consolidate([second])
+        self.assertEqual(stats.linked_files, 1)
+        self.assertTrue(os.path.samefile(first, second))
+        self.assertEqual(sorted(hashed), sorted([first, second]))
+        del hashed[:]
+        other = self.make_file(u"v2/other.txt", "Uniqu3")
+        stats = self.index.consolidate([other])
+        self.assertEqual(stats.linked_files, 0)
+        self.assertEqual(sorted(hashed), sorted([other, unique]))
+        # Calculated digests are kept for later comparisons
+        del hashed[:]
+        another = self.make_file(u"v2/another.txt", "Uniqu4")
+        self.index.consolidate([another])
+        self.assertEqual(hashed, [another])
+
+    def test_concurrent_consolidation(self):
+        # Another mirror sharing the index can update it while this
+        # mirror is hashing a large file
+        other_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, other_root)
+        small = self.make_file(u"v1/small.txt")
+        # Files are only hashed if they may be duplicates
+        large = self.make_file(u"v1/large.bin", "x" * 100)
+        duplicate = self.make_file(u"v2/large.bin", "x" * 100)
+        other_file = _path(other_root, u"other.txt")
+        shutil.copy2(small, other_file)
+        self.patch_module("_MAX_LOCKED_HASH_BYTES", 50)
+        self.patch_module("_LOCK_TIMEOUT_SECONDS", 0.1)
+        other_index = hardlink_index.HardlinkIndex(other_root, self.index.index_path)
+        other_index.open()
+        self.addCleanup(other_index.close)
+        other_results = []
+        file_digest = hardlink_index.file_digest
+        def _file_digest(path):
+            if path == duplicate and not other_results:
+                other_results.append(other_index.consolidate([other_file]))
+            return file_digest(path)
+        self.patch_module("file_digest", _file_digest)
+        stats = self.index.consolidate([small, large, duplicate])
+        self.assertEqual(stats.checked_files, 3)
+        self.assertTrue(os.path.samefile(large, duplicate))
+        other_stats, = other_results
+        self.assertEqual(other_stats.linked_files, 1)
+        self.assertTrue(os.path.samefile(small, other_file))
+
+if __name__ == '__main__':
+    unittest.main()
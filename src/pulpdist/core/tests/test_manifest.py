@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2012 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+"""Test suite for tree manifests"""
+
+import gzip
+import os.path
+import shutil
+import sys
+import tempfile
+from cStringIO import StringIO
+
+from .compat import unittest
+from .. import manifest
+from ..hardlink_index import file_digest
+
+_Entry = manifest.ManifestEntry
+
+class TestManifest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir_path = dir_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, dir_path)
+        self.manifest_path = os.path.join(dir_path, "MANIFEST.gz")
+
+    def write_raw(self, *lines):
+        f = gzip.open(self.manifest_path, 'wb')
+        try:
+            for line in lines:
+                f.write(line + "\n")
+        finally:
+            f.close()
+
+    def test_round_trip(self):
+        entries = [
+            _Entry(u"subdir/data.txt", 10, 1000, "abc"),
+            _Entry(u"odd\tname\n.txt", 0, 2000, "def"),
+            _Entry(u"caf\xe9.txt", 5, 3000, "ghi"),
+        ]
+        manifest.write_manifest(self.manifest_path, entries)
+        self.assertEqual(os.listdir(self.dir_path), ["MANIFEST.gz"])
+        loaded = manifest.read_manifest(self.manifest_path)
+        self.assertEqual(loaded, dict((entry.path, entry) for entry in entries))
+
+    def test_not_a_manifest(self):
+        with open(self.manifest_path, 'w') as f:
+            f.write("Not a manifest\n")
+        self.assertRaises(manifest.ManifestError,
+                          manifest.read_manifest, self.manifest_path)
+        self.write_raw("# some other format")
+        self.assertRaises(manifest.ManifestError,
+                          manifest.read_manifest, self.manifest_path)
+
+    def test_malformed_entry(self):
+        self.write_raw(manifest.MANIFEST_HEADER, "data.txt\t10\tabc")
+        self.assertRaises(manifest.ManifestError,
+                          manifest.read_manifest, self.manifest_path)
+
+    def test_invalid_paths(self):
+        for path in ("/etc/passwd", "../outside", "a/../../b", "a//b", ""):
+            self.write_raw(manifest.MANIFEST_HEADER,
+                           "{0}\t10\t1000\tabc".format(path))
+            self.assertRaises(manifest.ManifestError,
+                              manifest.read_manifest, self.manifest_path)
+
+    def test_diff(self):
+        old = {
+            u"same": _Entry(u"same", 1, 1000, "a"),
+            u"modified": _Entry(u"modified", 1, 1000, "b"),
+            u"touched": _Entry(u"touched", 1, 1000, "c"),
+            u"deleted": _Entry(u"deleted", 1, 1000, "d"),
+        }
+        new = dict(old)
+        del new[u"deleted"]
+        new[u"modified"] = _Entry(u"modified", 1, 1000, "changed")
+        new[u"touched"] = _Entry(u"touched", 1, 2000, "c")
+        new[u"added"] = _Entry(u"added", 1, 1000, "e")
+        changed, deleted = manifest.diff_manifests(new, old)
+        self.assertEqual(changed, [u"added", u"modified", u"touched"])
+        self.assertEqual(deleted, [u"deleted"])
+
+def _write_file(file_path, contents, mtime=1000):
+    dir_path = os.path.dirname(file_path)
+    if not os.path.isdir(dir_path):
+        os.makedirs(dir_path)
+    with open(file_path, 'w') as f:
+        f.write(contents)
+    os.utime(file_path, (mtime, mtime))
+
+class TestBuildManifest(unittest.TestCase):
+
+    def setUp(self):
+        self.tree_path = tree_path = tempfile.mkdtemp().decode("utf-8")
+        self.addCleanup(shutil.rmtree, tree_path)
+        _write_file(os.path.join(tree_path, "data.txt"), "data")
+        _write_file(os.path.join(tree_path, "subdir", "nested.txt"), "nested")
+        _write_file(os.path.join(tree_path, "skipped.txt"), "skipped")
+        _write_file(os.path.join(tree_path, "skipdir", "data.txt"), "skipped")
+        _write_file(os.path.join(tree_path, ".pulpdist-protected.json"), "{}")
+        os.symlink("subdir", os.path.join(tree_path, "link"))
+
+    def _path(self, *parts):
+        return os.path.join(self.tree_path, *parts)
+
+    def test_build(self):
+        entries = manifest.build_manifest(self.tree_path, excluded=["skip*"])
+        self.assertEqual([entry.path for entry in entries],
+                         [u"data.txt", u"link", u"subdir/nested.txt"])
+        data_entry = entries[0]
+        self.assertEqual(data_entry.size, 4)
+        self.assertEqual(data_entry.mtime, 1000)
+        self.assertEqual(data_entry.digest, file_digest(self._path("data.txt")))
+        self.assertEqual(entries[1].size, len("subdir"))
+        self.assertTrue(entries[1].digest.startswith("link:"))
+
+    def test_anchored_exclusions(self):
+        excluded = ["/skipdir/", "subdir/nested.txt", "/skipped.txt"]
+        entries = manifest.build_manifest(self.tree_path, excluded=excluded)
+        self.assertEqual([entry.path for entry in entries],
+                         [u"data.txt", u"link"])
+
+    def test_incremental(self):
+        previous = dict((entry.path, entry) for entry in
+                          manifest.build_manifest(self.tree_path))
+        for path in (u"data.txt", u"subdir/nested.txt"):
+            previous[path] = previous[path]._replace(digest="cached")
+        _write_file(self._path("subdir", "nested.txt"), "changed", 2000)
+        entries = manifest.build_manifest(self.tree_path, previous)
+        digests = dict((entry.path, entry.digest) for entry in entries)
+        # Only the modified file is hashed again
+        self.assertEqual(digests[u"data.txt"], "cached")
+        self.assertEqual(digests[u"subdir/nested.txt"],
+                         file_digest(self._path("subdir", "nested.txt")))
+
+    def test_parallel_hashing(self):
+        for i in range(manifest._MIN_PARALLEL_FILES):
+            _write_file(self._path("many", "{0}.txt".format(i)), str(i))
+        serial = manifest.build_manifest(self.tree_path, jobs=1)
+        threads = manifest.build_manifest(self.tree_path, jobs=4)
+        self.assertEqual(threads, serial)
+        processes = manifest.build_manifest(self.tree_path, jobs=4,
+                                            processes=True)
+        self.assertEqual(processes, serial)
+
+    def test_threaded_hashing_error(self):
+        paths = [self._path("many", "{0}.txt".format(i))
+                    for i in range(manifest._MIN_PARALLEL_FILES)]
+        for path in paths:
+            _write_file(path, "data")
+        # Missing files are skipped, while other errors are reraised
+        os.unlink(paths[0])
+        self.assertRaises(IOError, manifest._hash_files,
+                          paths + [self._path("many")], 4)
+        digests = manifest._hash_files(paths, 4)
+        self.assertEqual(digests[0], None)
+        self.assertEqual(digests[1:], [file_digest(path) for path in paths[1:]])
+
+    def test_update_manifest(self):
+        entries = manifest.update_manifest(self.tree_path, excluded=["skip*"])
+        manifest_path = self._path(manifest.DEFAULT_MANIFEST_NAME)
+        loaded = manifest.read_manifest(manifest_path)
+        self.assertEqual(sorted(loaded.values()), entries)
+        # The manifest doesn't list itself when it is updated
+        self.assertEqual(manifest.update_manifest(self.tree_path, excluded=["skip*"]),
+                         entries)
+
+    def test_main(self):
+        output = StringIO()
+        orig_stdout = sys.stdout
+        sys.stdout = output
+        try:
+            manifest.main([self.tree_path, "--name", "files.gz",
+                           "--exclude", "skip*", "--jobs", "1"])
+        finally:
+            sys.stdout = orig_stdout
+        entries = manifest.read_manifest(self._path("files.gz"))
+        self.assertEqual(len(entries), 3)
+        self.assertIn("Wrote 3 entries", output.getvalue())
+
+if __name__ == '__main__':
+    unittest.main()
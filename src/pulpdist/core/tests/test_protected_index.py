@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2012 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+"""Test suite for the index of PROTECTED directories"""
+
+import shutil
+import tempfile
+import os.path
+import json
+
+from .compat import unittest
+from .. import protected_index, shellutil
+
+_path = os.path.join
+
+class TestProtectedIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.root = root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        # Treat all directories as old enough to be cached
+        self._racy_seconds = protected_index._RACY_MTIME_SECONDS
+        protected_index._RACY_MTIME_SECONDS = -60
+        self.addCleanup(self._restore_racy_seconds)
+        for subdir in u"v1/a/b v1/c v2/d".split():
+            os.makedirs(_path(root, subdir))
+        os.symlink(u"c", _path(root, u"v1", u"linked"))
+        self.protect(u"v1", u"a", u"b")
+        self.protect(u"v1", u"c")
+        self.protect(u"v2")
+
+    def _restore_racy_seconds(self):
+        protected_index._RACY_MTIME_SECONDS = self._racy_seconds
+
+    def protect(self, *parts):
+        with open(_path(self.root, *(parts + (u"PROTECTED",))), 'w'):
+            pass
+
+    def walk_protected(self, top):
+        # Reference implementation based on a full tree walk
+        protected = []
+        for dir_info in shellutil.filtered_walk(top, file_pattern='PROTECTED'):
+            if dir_info.files:
+                protected.append(os.path.relpath(dir_info.path, top))
+        return sorted(protected)
+
+    def check_protected(self, index, *parts):
+        top = _path(self.root, *parts)
+        actual = sorted(index.find_protected(top))
+        self.assertEqual(actual, self.walk_protected(top))
+        return actual
+
+    def test_find_protected(self):
+        index = protected_index.ProtectedIndex(self.root)
+        self.assertEqual(self.check_protected(index, u"v1"), [u"a/b", u"c"])
+        self.assertEqual(self.check_protected(index, u"v2"), [u"."])
+        self.assertEqual(self.check_protected(index), [u"v1/a/b", u"v1/c", u"v2"])
+        self.assertEqual(index.find_protected(_path(self.root, u"missing")), [])
+        self.assertRaises(ValueError, index.find_protected, tempfile.gettempdir())
+
+    def test_saved_index(self):
+        index = protected_index.ProtectedIndex(self.root)
+        self.check_protected(index)
+        index.save()
+        index_path = _path(self.root, protected_index.INDEX_NAME)
+        with open(index_path) as f:
+            self.assertIn(u"v1/a/b", json.load(f)["dirs"])
+        # Cached entries are reused when directories are unchanged
+        # (saving the index modifies the root directory itself)
+        index = protected_index.ProtectedIndex(self.root)
+        index._list_dir = None
+        self.check_protected(index, u"v1")
+        self.check_protected(index, u"v2")
+
+    def test_invalidation(self):
+        index = protected_index.ProtectedIndex(self.root)
+        self.check_protected(index)
+        index.save()
+        index = protected_index.ProtectedIndex(self.root)
+        os.unlink(_path(self.root, u"v1", u"c", u"PROTECTED"))
+        os.makedirs(_path(self.root, u"v1", u"c", u"new"))
+        self.protect(u"v1", u"c", u"new")
+        shutil.rmtree(_path(self.root, u"v2"))
+        self.assertEqual(self.check_protected(index), [u"v1/a/b", u"v1/c/new"])
+        index.save()
+        index = protected_index.ProtectedIndex(self.root)
+        self.assertNotIn(u"v2", index._entries)
+        self.assertEqual(self.check_protected(index), [u"v1/a/b", u"v1/c/new"])
+
+    def test_racy_mtimes_not_cached(self):
+        protected_index._RACY_MTIME_SECONDS = 60
+        index = protected_index.ProtectedIndex(self.root)
+        self.check_protected(index)
+        for entry in index._entries.values():
+            self.assertIsNone(entry["signature"])
+
+    def test_corrupt_index(self):
+        index_path = _path(self.root, protected_index.INDEX_NAME)
+        with open(index_path, 'w') as f:
+            f.write("Not JSON")
+        index = protected_index.ProtectedIndex(self.root)
+        self.check_protected(index)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2012 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+"""Test suite for buffered sync logs"""
+
+import gzip
+import json
+import os.path
+import shutil
+import tempfile
+
+from .compat import unittest
+from .. import run_log
+
+class TestRunLog(unittest.TestCase):
+
+    def setUp(self):
+        self.dir_path = dir_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, dir_path)
+        self.log_path = os.path.join(dir_path, "sync.log")
+        self.event_path = os.path.join(dir_path, "sync.events.jsonl")
+
+    def test_plain(self):
+        with run_log.RunLog(self.log_path) as log:
+            log.write("first\n")
+            log.write(u"caf\xe9\n")
+            self.assertFalse(log.events_enabled)
+            log.write_event("ignored")
+        with open(self.log_path) as f:
+            self.assertEqual(f.read(), "first\ncaf\xc3\xa9\n")
+        self.assertFalse(os.path.exists(self.event_path))
+
+    def test_compressed(self):
+        with run_log.RunLog(self.log_path, compress=True) as log:
+            log.write("compressed\n")
+            log.flush()
+        f = gzip.open(self.log_path)
+        try:
+            self.assertEqual(f.read(), "compressed\n")
+        finally:
+            f.close()
+
+    def test_events(self):
+        with run_log.RunLog(self.log_path, event_path=self.event_path) as log:
+            self.assertTrue(log.events_enabled)
+            log.write_event("started", tree_name=u"tree")
+            log.write_event("finished", result="SYNC_COMPLETED")
+        with open(self.event_path) as f:
+            events = [json.loads(line) for line in f]
+        self.assertEqual([event["event"] for event in events],
+                         ["started", "finished"])
+        self.assertEqual(events[0]["tree_name"], u"tree")
+        self.assertEqual(events[1]["result"], "SYNC_COMPLETED")
+        self.assertIn("time", events[0])
+
+
+class TestCappedOutput(unittest.TestCase):
+
+    def capture(self, num_lines, max_lines):
+        logged = []
+        output = run_log.CappedOutput(logged.append, max_lines)
+        for i in range(num_lines):
+            output.add(str(i))
+        return logged, output.finish()
+
+    def test_uncapped(self):
+        logged, omitted = self.capture(10, 0)
+        self.assertEqual(logged, [str(i) for i in range(10)])
+        self.assertEqual(omitted, 0)
+
+    def test_under_limit(self):
+        logged, omitted = self.capture(4, 5)
+        self.assertEqual(logged, ["0", "1", "2", "3"])
+        self.assertEqual(omitted, 0)
+
+    def test_head_and_tail(self):
+        logged, omitted = self.capture(10, 5)
+        expected_msg = run_log.OMITTED_OUTPUT_MESSAGE.format(5)
+        self.assertEqual(logged, ["0", "1", "2", expected_msg, "8", "9"])
+        self.assertEqual(omitted, 5)
+
+    def test_head_only(self):
+        logged, omitted = self.capture(10, 1)
+        expected_msg = run_log.OMITTED_OUTPUT_MESSAGE.format(9)
+        self.assertEqual(logged, ["0", expected_msg])
+        self.assertEqual(omitted, 9)
+
+    def test_collapse_progress(self):
+        collapse = run_log.collapse_progress
+        self.assertEqual(collapse("data.txt\n"), "data.txt\n")
+        self.assertEqual(collapse("  10%\r  50%\r  100%\r\n"), "  100%\n")
+        self.assertEqual(collapse("  10%\r  100% (xfer#1)\n"), "  100% (xfer#1)\n")
+
+if __name__ == '__main__':
+    unittest.main()
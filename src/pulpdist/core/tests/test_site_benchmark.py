@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2012 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+"""Test suite for the large site benchmarks"""
+
+from .compat import unittest
+from . import site_benchmark
+from .. import site_config
+
+class TestSiteBenchmark(unittest.TestCase):
+
+    def test_generated_site(self):
+        config = site_benchmark.make_site_config(30, num_trees=10)
+        site = site_config.SiteConfig(config)
+        site.validate()
+        self.assertEqual(len(site.get_repo_configs()), 30)
+        repos = site.query_repos()
+        self.assertEqual(len(set(repo.tree_id for repo in repos)), 10)
+        self.assertEqual(len(set(repo.site_id for repo in repos)), 3)
+
+    def test_run_benchmark(self):
+        result = site_benchmark.run_benchmark(20)
+        self.assertEqual(result["counts"]["local_mirrors"], 20)
+        self.assertEqual(result["counts"]["remote_trees"], 10)
+        for name in ("validate", "populate_db", "convert_mirrors",
+                     "query_repos", "get_repo_configs"):
+            self.assertIn(name, result["timings"])
+        self.assertGreater(result["peak_rss_kib"], 0)
+
+    def test_compare_results(self):
+        def _results(validate, query, peak_rss):
+            timings = {"validate": validate, "query_repos": query}
+            entry = {"timings": timings, "peak_rss_kib": peak_rss}
+            return {"sizes": {"1000": entry}}
+        old = _results(1.0, 0.01, 1000)
+        self.assertEqual(site_benchmark.compare_results(old, old), [])
+        # Short timings are too noisy to be reported
+        new = _results(1.1, 0.04, 1000)
+        self.assertEqual(site_benchmark.compare_results(new, old), [])
+        new = _results(1.5, 0.01, 1500)
+        self.assertEqual(site_benchmark.compare_results(new, old),
+                         [("1000", "validate", 1.0, 1.5),
+                          ("1000", "peak_rss_kib", 1000, 1500)])
+        self.assertEqual(site_benchmark.compare_results(new, old, 0.6), [])
+        # Sizes that weren't previously benchmarked are skipped
+        new["sizes"]["2000"] = new["sizes"].pop("1000")
+        self.assertEqual(site_benchmark.compare_results(new, old), [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -14,6 +14,9 @@
 """Basic test suite for site configuration"""
 
 import json
+import os
+import shutil
+import tempfile
 
 from . import test_sync_trees
 from .. import site_config, site_sql, validation, sync_trees, mirror_config
@@ -194,6 +197,21 @@ class TestSiteConfig(unittest.TestCase):
         self.assertSpecValid(site)
         self.assertInvalid(site)
 
+    def test_duplicate_id_reported(self):
+        # Entries are loaded in bulk, but errors still identify the entry
+        example = json.loads(TEST_CONFIG)
+        servers = example["REMOTE_SERVERS"]
+        duplicate = servers[0].copy()
+        duplicate["name"] = "Duplicate server"
+        servers.append(duplicate)
+        site = site_config.SiteConfig(example)
+        with self.assertRaises(validation.ValidationError) as details:
+            site.validate()
+        msg = str(details.exception)
+        self.assertIn("remote_servers.server_id", msg)
+        self.assertIn("Duplicate server", msg)
+        self.assertNotIn(servers[0]["name"], msg)
+
     def test_duplicate_site_id(self):
         self._check_duplicate_id("SITE_SETTINGS")
 
@@ -271,6 +289,30 @@ class TestSiteConfig(unittest.TestCase):
         importer = repos[0]["importer_config"]
         self.assertTrue(importer["sync_latest_only"])
 
+    def test_dedupe_index(self):
+        config = json.loads(TEST_CONFIG)
+        index_path = u"/var/lib/pulpdist/dedupe.sqlite"
+        config["SITE_SETTINGS"][0]["dedupe_index"] = index_path
+        site = site_config.SiteConfig(config)
+        for repo in site.get_repo_configs(mirrors=ALL_MIRRORS):
+            importer = repo["importer_config"]
+            self.assertEqual(importer["dedupe_index_path"], index_path)
+
+    def test_no_dedupe_index(self):
+        config = json.loads(TEST_CONFIG)
+        site = site_config.SiteConfig(config)
+        for repo in site.get_repo_configs(mirrors=ALL_MIRRORS):
+            importer = repo["importer_config"]
+            self.assertNotIn("dedupe_index_path", importer)
+
+    def test_bandwidth_budget(self):
+        config = json.loads(TEST_CONFIG)
+        config["SITE_SETTINGS"][0]["bandwidth_budget"] = 10000
+        site = site_config.SiteConfig(config)
+        for repo in site.get_repo_configs(mirrors=ALL_MIRRORS):
+            importer = repo["importer_config"]
+            self.assertEqual(importer["bandwidth_budget"], 10000)
+
 
 class TestQueryMirrors(unittest.TestCase):
 
@@ -292,6 +334,13 @@ class TestQueryMirrors(unittest.TestCase):
         mirrors = self._get_mirrors(trees=DEFAULT_TREES)
         self.assertEqual(mirrors, DEFAULT_MIRRORS)
 
+    def test_query_large_filter_set(self):
+        # Stays within the 999 parameter limit of older SQLite versions
+        missing = [u"missing_{0}".format(i) for i in range(400)]
+        mirrors = self._get_mirrors(mirrors=missing + DEFAULT_MIRRORS,
+                                    trees=missing)
+        self.assertEqual(mirrors, DEFAULT_MIRRORS)
+
     def test_query_by_source_id(self):
         mirrors = self._get_mirrors(sources=[DEFAULT_SOURCE])
         self.assertEqual(mirrors, DEFAULT_MIRRORS)
@@ -309,6 +358,32 @@ class TestQueryMirrors(unittest.TestCase):
         self.assertEqual(mirrors, ALL_MIRRORS)
 
 
+class TestSiteSchema(unittest.TestCase):
+
+    def setUp(self):
+        self.site = site = site_config.SiteConfig(json.loads(TEST_CONFIG))
+        self.session = site._get_db_session()
+
+    def test_filter_indexes(self):
+        inspector = site_sql.sqla.inspect(self.session.get_bind())
+        def _indexed(table):
+            return set(column for index in inspector.get_indexes(table)
+                                  for column in index["column_names"])
+        self.assertEqual(_indexed("pulp_repositories"),
+                         set("mirror_id site_id tree_id source_id server_id".split()))
+        self.assertEqual(_indexed("local_mirrors"), set(["tree_id", "site_id"]))
+        self.assertEqual(_indexed("remote_trees"), set(["source_id"]))
+        self.assertEqual(_indexed("remote_sources"), set(["server_id"]))
+
+    def test_json_columns(self):
+        raw = self.session.execute("SELECT sync_filters, notes FROM local_mirrors "
+                                   "WHERE mirror_id = 'simple_sync'").fetchone()
+        self.assertEqual(json.loads(raw[0]), ["exclude_irrelevant/"])
+        self.assertEqual(json.loads(raw[1])["basic"], "note")
+        mirror = self.site.query_mirrors(mirrors=["simple_sync"]).one()
+        self.assertEqual(mirror.sync_filters, ["exclude_irrelevant/"])
+
+
 class TestQueryRepos(TestQueryMirrors):
     def _get_mirrors(self, *args, **kwds):
         return sorted(r.mirror_id for r in self.site.query_repos(*args, **kwds))
@@ -350,6 +425,152 @@ class TestConversion(unittest.TestCase):
             self.assertEqual(repo, expected[repo_id])
 
 
+class TestIncrementalValidation(unittest.TestCase):
+
+    def setUp(self):
+        self.previous = site_config.SiteConfig(json.loads(TEST_CONFIG))
+        self.previous.validate()
+        self.config = json.loads(TEST_CONFIG)
+
+    def _revalidate(self):
+        site = site_config.SiteConfig(self.config, self.previous)
+        site.validate()
+        # The result must match a full validation of the new config
+        full = site_config.SiteConfig(json.loads(json.dumps(self.config)))
+        self.assertEqual(sorted(site.get_repo_configs()),
+                         sorted(full.get_repo_configs()))
+        return site
+
+    def test_full_validation(self):
+        self.assertEqual(self.previous.changed_repo_ids, set(ALL_REPOS))
+
+    def test_unchanged(self):
+        site = self._revalidate()
+        self.assertEqual(site.changed_repo_ids, set())
+
+    def test_mirror_changed(self):
+        self.config["LOCAL_MIRRORS"][0]["enabled"] = True
+        site = self._revalidate()
+        self.assertEqual(site.changed_repo_ids, set(["simple_sync__default"]))
+
+    def test_only_affected_mirrors_converted(self):
+        self.config["LOCAL_MIRRORS"][1]["enabled"] = True
+        site = site_config.SiteConfig(self.config, self.previous)
+        converted = []
+        convert_mirror = site._convert_mirror
+        def _convert_mirror(mirror):
+            converted.append(mirror.mirror_id)
+            return convert_mirror(mirror)
+        site._convert_mirror = _convert_mirror
+        site.validate()
+        self.assertEqual(converted, ["versioned_sync"])
+
+    def test_server_changed(self):
+        self.config["REMOTE_SERVERS"][0]["dns"] = "example.com"
+        site = self._revalidate()
+        self.assertEqual(site.changed_repo_ids,
+                         set(["simple_sync__default", "snapshot_sync__default"]))
+
+    def test_default_site_changed(self):
+        self.config["SITE_SETTINGS"][0]["dedupe_index"] = "/var/lib/dedupe"
+        site = self._revalidate()
+        self.assertEqual(site.changed_repo_ids,
+                         set(["simple_sync__default", "snapshot_sync__default",
+                              "versioned_sync__other"]))
+
+    def test_cosmetic_change(self):
+        # Entries may change without affecting the generated repo configs
+        self.config["REMOTE_SERVERS"][1]["name"] = "Renamed server"
+        site = self._revalidate()
+        self.assertEqual(site.changed_repo_ids, set())
+
+    def test_added_and_removed(self):
+        mirrors = self.config["LOCAL_MIRRORS"]
+        removed = mirrors.pop(0)
+        added = dict(removed, site_id="other")
+        mirrors.append(added)
+        self.config["RAW_REPOS"][0]["display_name"] = "Modified"
+        site = self._revalidate()
+        self.assertEqual(site.changed_repo_ids,
+                         set(["simple_sync__default", "simple_sync__other",
+                              "raw_sync"]))
+
+    def test_invalid_entry(self):
+        self.config["LOCAL_MIRRORS"][1]["mirror_path"] = u"bad path"
+        site = site_config.SiteConfig(self.config, self.previous)
+        with self.assertRaises(validation.ValidationError) as details:
+            site.validate()
+        full = site_config.SiteConfig(json.loads(json.dumps(self.config)))
+        with self.assertRaises(validation.ValidationError) as full_details:
+            full.validate()
+        self.assertEqual(str(details.exception), str(full_details.exception))
+
+    def test_removed_dependency(self):
+        del self.config["REMOTE_TREES"][0]
+        site = site_config.SiteConfig(self.config, self.previous)
+        self.assertRaises(validation.ValidationError, site.validate)
+
+
+class TestSiteDBCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+
+    def _make_site(self, config=None):
+        if config is None:
+            config = json.loads(TEST_CONFIG)
+        return site_config.SiteConfig(config, cache_dir=self.cache_dir)
+
+    def _cached_dbs(self):
+        return sorted(os.listdir(self.cache_dir))
+
+    def test_cached_db(self):
+        site = self._make_site()
+        site.validate()
+        expected = sorted(site.get_repo_configs())
+        cached_name = "site-{0}.sqlite".format(site.get_cache_key())
+        self.assertEqual(self._cached_dbs(), [cached_name])
+        cached = self._make_site()
+        def _fail():
+            self.fail("Cached site config validated again")
+        cached._validate_spec = cached._populate_db = _fail
+        cached.validate()
+        self.assertEqual(sorted(cached.get_repo_configs()), expected)
+        self.assertEqual(cached.changed_repo_ids, set(ALL_REPOS))
+        mirrors = sorted(m.mirror_id for m in cached.query_mirrors(sites=["other"]))
+        self.assertEqual(mirrors, ["versioned_sync"])
+
+    def test_cache_key(self):
+        site = self._make_site()
+        modified = json.loads(TEST_CONFIG)
+        modified["LOCAL_MIRRORS"][0]["enabled"] = True
+        self.assertEqual(site.get_cache_key(), self._make_site().get_cache_key())
+        self.assertNotEqual(site.get_cache_key(),
+                            self._make_site(modified).get_cache_key())
+
+    def test_invalid_config_not_cached(self):
+        config = json.loads(TEST_CONFIG)
+        config["LOCAL_MIRRORS"][0]["tree_id"] = "missing"
+        site = self._make_site(config)
+        self.assertRaises(validation.ValidationError, site.validate)
+        self.assertEqual(self._cached_dbs(), [])
+
+    def test_cache_pruned(self):
+        self.addCleanup(setattr, site_config, "_MAX_CACHED_DBS",
+                        site_config._MAX_CACHED_DBS)
+        site_config._MAX_CACHED_DBS = 1
+        self._make_site().validate()
+        for name in self._cached_dbs():
+            os.utime(os.path.join(self.cache_dir, name), (1000, 1000))
+        modified = json.loads(TEST_CONFIG)
+        modified["LOCAL_MIRRORS"][0]["enabled"] = True
+        site = self._make_site(modified)
+        site.validate()
+        cached_name = "site-{0}.sqlite".format(site.get_cache_key())
+        self.assertEqual(self._cached_dbs(), [cached_name])
+
+
 class TestDataTransfer(test_sync_trees.BaseTestCase):
 
     def setUp(self):
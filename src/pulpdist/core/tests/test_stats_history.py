@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2012 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+"""Test suite for the sync statistics history"""
+
+import os.path
+import shutil
+import sqlite3
+import tempfile
+from datetime import datetime, timedelta
+
+from .compat import unittest
+from .. import stats_history
+from ..sync_trees import SyncStats
+
+_DAY = timedelta(days=1)
+_NOW = datetime(2012, 6, 15, 12, 30)
+
+def _make_stats(**kwds):
+    stats = SyncStats(*([0]*len(SyncStats._fields)))
+    return stats._replace(**kwds)
+
+class TestSyncStatsHistory(unittest.TestCase):
+
+    def setUp(self):
+        self.dir_path = dir_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, dir_path)
+        db_path = os.path.join(dir_path, "history", "stats.sqlite")
+        self.history = stats_history.SyncStatsHistory(db_path)
+        self.history.open()
+        self.addCleanup(self.history.close)
+
+    def record(self, repo_id, start, seconds, total_bytes=0,
+               result="SYNC_COMPLETED", server_id="server", site_id="site"):
+        stats = _make_stats(total_bytes=total_bytes, transferred_bytes=10,
+                            received_bytes=20)
+        self.history.record(repo_id, result, start,
+                            start + timedelta(seconds=seconds), stats,
+                            server_id, site_id)
+
+    def test_rollups(self):
+        self.record("repo", _NOW, 10, 100)
+        self.record("repo", _NOW + timedelta(minutes=5), 30, 300,
+                    result="SYNC_FAILED")
+        self.record("repo", _NOW + timedelta(hours=2), 20, 200)
+        self.record("other", _NOW, 5, 50, server_id="other_server")
+        hourly = list(self.history.iter_rollups("hour", "repo", keys=["repo"]))
+        self.assertEqual([rollup.runs for rollup in hourly], [2, 1])
+        first = hourly[0]
+        self.assertEqual(first.failures, 1)
+        self.assertEqual(first.successes, 1)
+        # Failed runs don't contribute to the duration and size totals
+        self.assertEqual(first.total_duration, 10)
+        self.assertEqual(first.max_duration, 10)
+        self.assertEqual(first.total_tree_bytes, 100)
+        self.assertEqual(first.transferred_bytes, 20)
+        self.assertEqual(first.received_bytes, 40)
+        daily = list(self.history.iter_rollups("day", "repo"))
+        self.assertEqual([(rollup.key, rollup.runs) for rollup in daily],
+                         [("other", 1), ("repo", 3)])
+        by_server = list(self.history.iter_rollups("day", "server"))
+        self.assertEqual([(rollup.key, rollup.runs) for rollup in by_server],
+                         [("other_server", 1), ("server", 3)])
+        by_site = list(self.history.iter_rollups("day", "site"))
+        self.assertEqual([(rollup.key, rollup.runs) for rollup in by_site],
+                         [("site", 4)])
+
+    def test_disabled_runs_ignored(self):
+        self.record("repo", _NOW, 0, result="SYNC_DISABLED")
+        self.assertEqual(list(self.history.iter_rollups("day", "repo")), [])
+        count = self.history._db.execute("SELECT COUNT(*) FROM sync_runs").fetchone()[0]
+        self.assertEqual(count, 0)
+
+    def test_missing_labels(self):
+        self.record("raw_repo", _NOW, 10, server_id=None, site_id=None)
+        self.assertEqual(len(list(self.history.iter_rollups("day", "repo"))), 1)
+        self.assertEqual(list(self.history.iter_rollups("day", "server")), [])
+
+    def test_invalid_rollups(self):
+        self.assertRaises(ValueError, list,
+                          self.history.iter_rollups("week", "repo"))
+        self.assertRaises(ValueError, list,
+                          self.history.iter_rollups("day", "mirror"))
+        self.assertRaises(ValueError, self.history.get_trends, "week")
+
+    def test_trends(self):
+        for days_ago in range(6):
+            start = _NOW - days_ago * _DAY
+            # "slower" takes longer and grows over the most recent 3 days
+            recent = days_ago < 3
+            self.record("slower", start, 20 if recent else 10,
+                        200 if recent else 100)
+            self.record("steady", start, 10, 100)
+        # Too old to be included
+        self.record("steady", _NOW - 10 * _DAY, 1000, 1000)
+        # Only recent runs, so there's nothing to compare
+        self.record("new", _NOW, 10, 100)
+        now = stats_history._timestamp(_NOW)
+        trends = self.history.get_trends("day", "repo", 3, now=now)
+        self.assertEqual([trend.key for trend in trends],
+                         ["slower", "steady", "new"])
+        slower, steady, new = trends
+        self.assertEqual(slower.runs, 6)
+        self.assertEqual(slower.avg_duration, 20)
+        self.assertAlmostEqual(slower.duration_change, 1.0)
+        self.assertAlmostEqual(slower.tree_bytes_change, 1.0)
+        self.assertEqual(steady.runs, 6)
+        self.assertAlmostEqual(steady.duration_change, 0.0)
+        self.assertEqual(new.duration_change, None)
+        self.assertEqual(new.avg_tree_bytes, 100)
+        # Trends can be limited to particular keys
+        trends = self.history.get_trends("day", "repo", 3, ["new"], now=now)
+        self.assertEqual([trend.key for trend in trends], ["new"])
+
+    def test_trends_ignore_failures(self):
+        for days_ago in range(6):
+            start = _NOW - days_ago * _DAY
+            self.record("repo", start, 10, 100)
+            if days_ago < 3:
+                # Recent failures end early, without any stats
+                self.record("repo", start + timedelta(hours=1), 1,
+                            result="SYNC_FAILED")
+        now = stats_history._timestamp(_NOW)
+        trend, = self.history.get_trends("day", "repo", 3, now=now)
+        self.assertEqual(trend.runs, 9)
+        self.assertEqual(trend.failures, 3)
+        self.assertEqual(trend.avg_duration, 10)
+        self.assertEqual(trend.avg_tree_bytes, 100)
+        self.assertAlmostEqual(trend.duration_change, 0.0)
+        self.assertAlmostEqual(trend.tree_bytes_change, 0.0)
+
+    def test_failures_only(self):
+        self.record("repo", _NOW, 1, result="SYNC_FAILED")
+        now = stats_history._timestamp(_NOW)
+        trend, = self.history.get_trends("day", "repo", 3, now=now)
+        self.assertEqual(trend.failures, 1)
+        self.assertEqual(trend.avg_duration, None)
+        self.assertEqual(trend.duration_change, None)
+
+
+class TestSchemaUpgrade(unittest.TestCase):
+
+    def setUp(self):
+        self.dir_path = dir_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, dir_path)
+        self.db_path = os.path.join(dir_path, "stats.sqlite")
+
+    def test_upgrade(self):
+        # Original schema, missing the last SyncStats field and the
+        # successful run counts in the rollups
+        stats_columns = ", ".join("{0} REAL".format(field)
+                                  for field in SyncStats._fields[:-1])
+        db = sqlite3.connect(self.db_path)
+        db.executescript("""
+            CREATE TABLE sync_runs (repo_id TEXT, server_id TEXT, site_id TEXT,
+                result TEXT, start_time REAL, finish_time REAL, duration REAL,
+                {0});
+            CREATE TABLE rollups (period TEXT, bucket INTEGER, scope TEXT,
+                key TEXT, runs INTEGER, failures INTEGER, total_duration REAL,
+                max_duration REAL, total_tree_bytes REAL,
+                transferred_bytes REAL, received_bytes REAL,
+                PRIMARY KEY (period, bucket, scope, key));
+        """.format(stats_columns))
+        start = stats_history._timestamp(_NOW)
+        placeholders = ",".join("?" * (6 + len(SyncStats._fields)))
+        for result, duration, total_bytes in (("SYNC_COMPLETED", 10, 100),
+                                              ("SYNC_FAILED", 30, 0),
+                                              ("SYNC_DISABLED", 0, 0)):
+            stats = [0] * (len(SyncStats._fields) - 1)
+            stats[SyncStats._fields.index("total_bytes")] = total_bytes
+            db.execute("INSERT INTO sync_runs VALUES ({0})".format(placeholders),
+                       ["repo", "server", None, result, start,
+                        start + duration, duration] + stats)
+        db.commit()
+        db.close()
+        history = stats_history.SyncStatsHistory(self.db_path)
+        with history.opened():
+            history.record("repo", "SYNC_COMPLETED", _NOW,
+                           _NOW + timedelta(seconds=20), _make_stats(total_bytes=200))
+            daily, = history.iter_rollups("day", "repo")
+            self.assertEqual(daily.runs, 3)
+            self.assertEqual(daily.failures, 1)
+            self.assertEqual(daily.successes, 2)
+            self.assertEqual(daily.total_duration, 30)
+            self.assertEqual(daily.max_duration, 20)
+            self.assertEqual(daily.total_tree_bytes, 300)
+            by_server, = history.iter_rollups("hour", "server")
+            self.assertEqual(by_server.runs, 2)
+            self.assertEqual(list(history.iter_rollups("day", "site")), [])
+        # Reopening doesn't rebuild the rollups again
+        with history.opened():
+            daily, = history.iter_rollups("day", "repo")
+            self.assertEqual(daily.runs, 3)
+
+if __name__ == '__main__':
+    unittest.main()
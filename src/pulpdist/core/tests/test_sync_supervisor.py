@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2012 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+"""Test suite for running sync operations concurrently"""
+
+import threading
+from cStringIO import StringIO
+
+from .compat import unittest
+from .. import sync_supervisor, sync_trees
+
+class _FakeCommand(object):
+    # Records the number of commands running at once instead of running rsync
+    def __init__(self, tracker, result="SYNC_COMPLETED", error=None):
+        self.tracker = tracker
+        self.result = result
+        self.error = error
+        self.cancel_event = threading.Event()
+
+    def run_sync(self):
+        tracker = self.tracker
+        with tracker.lock:
+            tracker.running += 1
+            tracker.max_running = max(tracker.max_running, tracker.running)
+        try:
+            tracker.release.wait(5)
+            if self.cancel_event.is_set():
+                raise sync_trees.SyncCancelled("Cancelled")
+            if self.error is not None:
+                raise self.error
+            return self.result, None, None, None
+        finally:
+            with tracker.lock:
+                tracker.running -= 1
+
+    def cancel(self):
+        self.cancel_event.set()
+        self.tracker.release.set()
+
+class _Tracker(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.running = 0
+        self.max_running = 0
+        self.release = threading.Event()
+
+class TestSyncSupervisor(unittest.TestCase):
+
+    def setUp(self):
+        self.tracker = _Tracker()
+        self.log = StringIO()
+
+    def make_supervisor(self, max_concurrent_syncs, num_commands):
+        supervisor = sync_supervisor.SyncSupervisor(max_concurrent_syncs,
+                                                    self.log)
+        for index in range(num_commands):
+            supervisor.add("tree{0}".format(index), _FakeCommand(self.tracker))
+        return supervisor
+
+    def run_in_thread(self, supervisor):
+        results = {}
+        def _run():
+            results.update(supervisor.run())
+        runner = threading.Thread(target=_run)
+        runner.start()
+        self.addCleanup(runner.join)
+        self.addCleanup(self.tracker.release.set)
+        return runner, results
+
+    def wait_for_running(self, count):
+        for __ in range(500):
+            with self.tracker.lock:
+                if self.tracker.running >= count:
+                    return
+            threading.Event().wait(0.01)
+        self.fail("Commands failed to start")
+
+    def test_bounded_concurrency(self):
+        supervisor = self.make_supervisor(3, 10)
+        runner, results = self.run_in_thread(supervisor)
+        self.wait_for_running(3)
+        self.tracker.release.set()
+        runner.join()
+        self.assertEqual(self.tracker.max_running, 3)
+        self.assertEqual(len(results), 10)
+        for name, result in results.items():
+            self.assertEqual(result.sync_info[0], "SYNC_COMPLETED")
+            self.assertIsNone(result.exc_info)
+            self.assertIn("Finished sync {0!r}".format(name), self.log.getvalue())
+
+    def test_exceptions(self):
+        supervisor = self.make_supervisor(2, 1)
+        supervisor.add("broken", _FakeCommand(self.tracker,
+                                              error=RuntimeError("Broken")))
+        self.tracker.release.set()
+        results = supervisor.run()
+        self.assertEqual(results["tree0"].sync_info[0], "SYNC_COMPLETED")
+        broken = results["broken"]
+        self.assertIsNone(broken.sync_info)
+        self.assertIs(broken.exc_info[0], RuntimeError)
+        self.assertIn("Failed sync 'broken'", self.log.getvalue())
+
+    def test_cancel_all(self):
+        supervisor = self.make_supervisor(2, 5)
+        runner, results = self.run_in_thread(supervisor)
+        self.wait_for_running(2)
+        supervisor.cancel()
+        runner.join()
+        self.assertEqual(len(results), 5)
+        for result in results.values():
+            self.assertIs(result.exc_info[0], sync_trees.SyncCancelled)
+        self.assertEqual(self.log.getvalue().count("Skipping cancelled"), 3)
+
+    def test_cancel_one(self):
+        supervisor = self.make_supervisor(2, 2)
+        runner, results = self.run_in_thread(supervisor)
+        self.wait_for_running(2)
+        supervisor.cancel("tree1")
+        runner.join()
+        self.assertEqual(results["tree0"].sync_info[0], "SYNC_COMPLETED")
+        self.assertIs(results["tree1"].exc_info[0], sync_trees.SyncCancelled)
+        self.assertRaises(KeyError, supervisor.cancel, "unknown")
+
+    def test_invalid_use(self):
+        self.assertRaises(ValueError, sync_supervisor.SyncSupervisor, 0)
+        supervisor = self.make_supervisor(1, 1)
+        self.assertRaises(ValueError, supervisor.add, "tree0", None)
+        self.tracker.release.set()
+        supervisor.run()
+        self.assertRaises(RuntimeError, supervisor.run)
+        self.assertRaises(RuntimeError, supervisor.add, "other", None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -13,14 +13,19 @@
 # http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
 """Basic test suite for sync transfer operations"""
 
+import json
 import shutil
 import os.path
+import tempfile
+import threading
+import time
 from tempfile import NamedTemporaryFile
 from cStringIO import StringIO
 from datetime import datetime, timedelta
 
-from .. import sync_trees, util
+from .. import sync_trees, util, manifest, run_log
 from . example_trees import TreeTestCase
+from .compat import unittest
 
 _path = os.path.join
 
@@ -63,6 +68,32 @@ class TestSyncTree(BaseTestCase):
         self.check_sync_details(task.run_sync(), "SYNC_UP_TO_DATE", stats)
         self.check_versioned_layout(local_path)
 
+    def test_sync_parallel_streams(self):
+        local_path = self.local_path
+        params = self.params
+        params.update(self.CONFIG_TREE_SYNC)
+        params["parallel_streams"] = 2
+        task = sync_trees.SyncTree(params)
+        stats = dict(self.EXPECTED_TREE_STATS)
+        self.check_sync_details(task.run_sync(), "SYNC_COMPLETED", stats)
+        self.check_tree_layout(local_path)
+        stats.update(self.EXPECTED_REPEAT_STATS)
+        self.check_sync_details(task.run_sync(), "SYNC_UP_TO_DATE", stats)
+        self.check_tree_layout(local_path)
+
+    def test_sync_versioned_parallel(self):
+        local_path = self.local_path
+        params = self.params
+        params.update(self.CONFIG_VERSIONED_SYNC)
+        params["max_parallel_fetches"] = 2
+        task = sync_trees.SyncVersionedTree(params)
+        stats = dict(self.EXPECTED_VERSIONED_STATS)
+        self.check_sync_details(task.run_sync(), "SYNC_COMPLETED", stats)
+        self.check_versioned_layout(local_path)
+        stats.update(self.EXPECTED_REPEAT_STATS)
+        self.check_sync_details(task.run_sync(), "SYNC_UP_TO_DATE", stats)
+        self.check_versioned_layout(local_path)
+
     def test_sync_snapshot(self):
         local_path = self.local_path
         params = self.params
@@ -104,6 +135,10 @@ class TestSyncTree(BaseTestCase):
     def test_sync_latest_link(self):
         self.check_sync_latest_link()
 
+    def test_sync_latest_link_parallel(self):
+        self.params["max_parallel_fetches"] = 3
+        self.check_sync_latest_link()
+
     def test_sync_latest_link_existing_file(self):
         # BZ#807913 - make sure this works even if the name is already taken
         __, link_path = self.latest_link_info()
@@ -525,6 +560,1384 @@ class TestLinkValidation(TreeTestCase):
         self.assertIn("does not exist, ignoring symlink", symlink_data)
 
 
+_SAMPLE_RSYNC_OUTPUT = """\
+receiving incremental file list
+cd+++++++++ subdir/
+>f+++++++++ subdir/data.txt
+\r          13 100%   12.70kB/s    0:00:00\r          13 100%   12.70kB/s    0:00:00 (xfer#1, to-check=1/4)
+>f.st...... data2.txt
+.d..t...... ./
+*deleting   stale.txt
+rsync: send_files failed to open "/unreadable.txt" (in test_data): Permission denied (13)
+
+Number of files: 4
+Number of files transferred: 2
+Total file size: 1.50K bytes
+Total transferred file size: 26 bytes
+Literal data: 26 bytes
+Matched data: 0 bytes
+File list size: 120
+File list generation time: 0.001 seconds
+File list transfer time: 0.000 seconds
+Total bytes sent: 68
+Total bytes received: 1.23K
+
+sent 68 bytes  received 1.23K bytes  2.60K bytes/sec
+total size is 1.50K  speedup is 1.15
+rsync error: some files/attrs were not transferred (see previous errors) (code 23)
+"""
+
+# Captured from "rsync --progress" (rsync starts each update with a carriage
+# return and only ends the final update for each file with a newline)
+_SAMPLE_PROGRESS_SEGMENTS = [
+    ">f+++++++++ subdir/data.txt\n",
+    "\r        1024  50%  512.00kB/s    0:00:01  ",
+    "\r        2048 100%    1.00MB/s    0:00:00 (xfer#1, to-check=3/5)\n",
+    ">f.st...... data2.txt\n",
+    "\r          10   1%   10.00kB/s    0:00:10  ",
+    "\r         1.50K  20%   10.00kB/s    0:00:10  ",
+    "\r       1,000 100%   10.00kB/s    0:00:00 (xfr#2, to-chk=0/5)\n",
+]
+_SAMPLE_PROGRESS_OUTPUT = "".join(_SAMPLE_PROGRESS_SEGMENTS)
+
+class TestRsyncOutputParser(unittest.TestCase):
+
+    def feed_sample(self, parser, repeat=1):
+        for __ in range(repeat):
+            for line in _SAMPLE_RSYNC_OUTPUT.splitlines(True):
+                parser.feed(line)
+
+    def test_stats(self):
+        parser = sync_trees.RsyncOutputParser()
+        self.feed_sample(parser)
+        stats = parser.get_stats()
+        self.assertEqual(stats.total_file_count, 4)
+        self.assertEqual(stats.transferred_file_count, 2)
+        self.assertEqual(stats.total_bytes, 1536)
+        self.assertEqual(stats.received_bytes, int(1.23 * 1024))
+        self.assertEqual(stats.transfer_bps, int(2.60 * 1024))
+        self.assertEqual(stats.listing_creation_seconds, 0.001)
+        self.assertEqual(stats, sync_trees.SyncStats.from_rsync_output(_SAMPLE_RSYNC_OUTPUT))
+
+    def test_multiple_stats_blocks(self):
+        parser = sync_trees.RsyncOutputParser()
+        self.feed_sample(parser, 2)
+        stats = parser.get_stats()
+        self.assertEqual(stats.total_file_count, 8)
+        self.assertEqual(stats.transferred_file_count, 4)
+
+    def test_old_daemon_stats(self):
+        old_output = "\n".join(line for line in _SAMPLE_RSYNC_OUTPUT.splitlines()
+                                    if "list generation" not in line and
+                                       "list transfer" not in line)
+        parser = sync_trees.RsyncOutputParser(old_daemon=True)
+        self.feed_sample(parser)
+        self.assertRaises(ValueError, parser.get_stats)
+        stats = sync_trees.SyncStats.from_rsync_output(old_output, old_daemon=True)
+        self.assertEqual(stats.total_file_count, 4)
+        self.assertEqual(stats.listing_creation_seconds, 0)
+
+    def test_incomplete_stats(self):
+        parser = sync_trees.RsyncOutputParser()
+        for line in _SAMPLE_RSYNC_OUTPUT.splitlines()[:14]:
+            parser.feed(line)
+        self.assertRaises(ValueError, parser.get_stats)
+
+    def test_itemized_changes(self):
+        changes = []
+        parser = sync_trees.RsyncOutputParser(itemized_change_handler=changes.append)
+        self.feed_sample(parser)
+        expected = [
+            sync_trees.ItemizedChange("c", "d", "+++++++++", "subdir/"),
+            sync_trees.ItemizedChange(">", "f", "+++++++++", "subdir/data.txt"),
+            sync_trees.ItemizedChange(">", "f", ".st......", "data2.txt"),
+            sync_trees.ItemizedChange(".", "d", "..t......", "./"),
+            sync_trees.ItemizedChange("*", "", "deleting", "stale.txt"),
+        ]
+        self.assertEqual(changes, expected)
+        self.assertEqual(parser.change_counts[">f"], 2)
+        self.assertEqual(parser.change_counts["*"], 1)
+
+    def test_errors(self):
+        parser = sync_trees.RsyncOutputParser()
+        self.feed_sample(parser, parser.MAX_ERRORS)
+        self.assertEqual(parser.error_count, 2 * parser.MAX_ERRORS)
+        self.assertEqual(len(parser.errors), parser.MAX_ERRORS)
+        self.assertTrue(parser.errors[-1].startswith("rsync error:"))
+
+    def test_progress(self):
+        events = []
+        parser = sync_trees.RsyncOutputParser(progress_handler=events.append)
+        times = iter([0, 0.5, 1.0, 1.5, 3.0, 4.0])
+        parser._time = lambda: next(times)
+        for segment in _SAMPLE_PROGRESS_SEGMENTS:
+            parser.feed(segment)
+        ProgressEvent = sync_trees.ProgressEvent
+        # Each update is reported as soon as it is fed in
+        self.assertEqual(events[0],
+                         ProgressEvent("subdir/data.txt", 1024, 512 * 1024, None))
+        expected = [
+            ProgressEvent("subdir/data.txt", 1024, 512 * 1024, None),
+            ProgressEvent("data2.txt", 2058, 10 * 1024, 3),
+            ProgressEvent("data2.txt", 3048, 10 * 1024, 0),
+        ]
+        self.assertEqual(events, expected)
+        # Progress updates aren't treated as errors or changes
+        self.assertEqual(parser.change_counts[">f"], 2)
+        self.assertEqual(parser.error_count, 0)
+
+    def test_progress_ignored_without_handler(self):
+        parser = sync_trees.RsyncOutputParser()
+        parser.feed("\r        1024  50%  512.00kB/s    0:00:01  ")
+        self.assertEqual(parser.error_count, 0)
+
+
+class TestProgressReporting(unittest.TestCase):
+
+    def setUp(self):
+        self.local_path = local_path = tempfile.mkdtemp().decode("utf-8")
+        self.addCleanup(shutil.rmtree, local_path)
+        params = dict(TreeTestCase.CONFIG_TREE_SYNC)
+        params["local_path"] = local_path + u'/'
+        self.params = params
+
+    def test_output_segments(self):
+        task = sync_trees.SyncTree(self.params, StringIO())
+        read_fd, write_fd = os.pipe()
+        with os.fdopen(write_fd, 'w') as f:
+            f.write("first\n\r  10%  \r  100%\nlast")
+        with os.fdopen(read_fd) as f:
+            segments = list(task._iter_shell_output(f))
+        self.assertEqual(segments, ["first\n", "\r  10%  ", "\r  100%\n", "last"])
+
+    def test_progress_not_delayed(self):
+        task = sync_trees.SyncTree(self.params, StringIO())
+        events = []
+        parser = sync_trees.RsyncOutputParser(progress_handler=events.append)
+        read_fd, write_fd = os.pipe()
+        reader = os.fdopen(read_fd)
+        self.addCleanup(reader.close)
+        segments = task._iter_shell_output(reader)
+        # The first update is reported before rsync writes the next one
+        with os.fdopen(write_fd, 'w') as f:
+            f.write("".join(_SAMPLE_PROGRESS_SEGMENTS[:2]))
+            f.flush()
+            parser.feed(next(segments))
+            parser.feed(next(segments))
+            self.assertEqual(events, [sync_trees.ProgressEvent(
+                                        "subdir/data.txt", 1024, 512 * 1024, None)])
+            f.write("".join(_SAMPLE_PROGRESS_SEGMENTS[2:]))
+        self.assertEqual(list(segments), _SAMPLE_PROGRESS_SEGMENTS[2:])
+
+    def test_report_progress(self):
+        events = []
+        task = sync_trees.SyncTree(self.params, StringIO(), events.append)
+        event = sync_trees.ProgressEvent(u"data.txt", 10, 5, None)
+        task._report_progress(self.local_path, "session", event)
+        expected_path = os.path.join(self.local_path, u"data.txt").encode("utf-8")
+        self.assertEqual(events, [event._replace(current_file=expected_path)])
+
+    def test_concurrent_sessions(self):
+        events = []
+        active = []
+        def callback(event):
+            active.append(event)
+            self.assertEqual(len(active), 1)
+            time.sleep(0.01)
+            events.append(active.pop())
+        task = sync_trees.SyncTree(self.params, StringIO(), callback)
+        ProgressEvent = sync_trees.ProgressEvent
+        task._report_progress(self.local_path, "first", ProgressEvent(None, 10, 5, 3))
+        task._report_progress(self.local_path, "second", ProgressEvent(None, 20, 7, None))
+        self.assertEqual(events[-1], ProgressEvent(None, 30, 12, 3))
+        task._report_progress(self.local_path, "second", ProgressEvent(None, 25, 1, 2))
+        self.assertEqual(events[-1], ProgressEvent(None, 35, 6, 5))
+        # Completed sessions only contribute to the bytes transferred
+        task._finish_progress("first")
+        task._report_progress(self.local_path, "third", ProgressEvent(None, 5, 4, 1))
+        self.assertEqual(events[-1], ProgressEvent(None, 40, 5, 3))
+        # Reports from concurrent sessions are passed on one at a time
+        threads = [threading.Thread(target=task._report_progress,
+                                    args=(self.local_path, session,
+                                          ProgressEvent(None, 1, 1, None)))
+                      for session in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(events), 9)
+
+    def test_broken_callback(self):
+        calls = []
+        def broken_callback(event):
+            calls.append(event)
+            raise RuntimeError("Broken callback")
+        log = StringIO()
+        task = sync_trees.SyncTree(self.params, log, broken_callback)
+        event = sync_trees.ProgressEvent(None, 10, 5, None)
+        task._report_progress(self.local_path, "session", event)
+        task._report_progress(self.local_path, "session", event)
+        self.assertEqual(calls, [event])
+        self.assertIn("Disabling progress reporting", log.getvalue())
+
+
+class TestCancellation(unittest.TestCase):
+
+    def setUp(self):
+        self.local_path = local_path = tempfile.mkdtemp().decode("utf-8")
+        self.addCleanup(shutil.rmtree, local_path)
+        params = dict(TreeTestCase.CONFIG_TREE_SYNC)
+        params["local_path"] = local_path + u'/'
+        self.task = sync_trees.SyncTree(params, StringIO())
+
+    def test_cancel_running_command(self):
+        task = self.task
+        errors = []
+        def _run():
+            try:
+                task._run_shell_command(["sleep", "60"])
+            except sync_trees.SyncCancelled:
+                errors.append(sync_trees.SyncCancelled)
+        runner = threading.Thread(target=_run)
+        runner.start()
+        for __ in range(500):
+            if task._active_procs:
+                break
+            threading.Event().wait(0.01)
+        task.cancel()
+        runner.join(10)
+        self.assertFalse(runner.is_alive())
+        self.assertEqual(errors, [sync_trees.SyncCancelled])
+        self.assertFalse(task._active_procs)
+
+    def test_cancel_before_sync(self):
+        task = self.task
+        self.assertFalse(task.cancelled)
+        task.cancel()
+        self.assertTrue(task.cancelled)
+        self.assertRaises(sync_trees.SyncCancelled, task.run_sync)
+
+
+class _TrashTrackingTree(sync_trees.SyncVersionedTree):
+    # Records requests to empty the trash instead of starting a reaper
+    reap_requests = 0
+
+    def _reap_trash(self):
+        self.reap_requests += 1
+
+class TestTrashOldDirs(unittest.TestCase):
+
+    def setUp(self):
+        self.local_path = local_path = tempfile.mkdtemp().decode("utf-8")
+        self.addCleanup(shutil.rmtree, local_path)
+        for version in (u"v1", u"v2"):
+            os.makedirs(_path(local_path, version, u"subdir"))
+        params = dict(TreeTestCase.CONFIG_VERSIONED_SYNC)
+        params["local_path"] = local_path + u'/'
+        params["listing_pattern"] = u"*"
+        params["trash_old_dirs"] = True
+        self.params = params
+
+    def test_trash_old_dirs(self):
+        task = _TrashTrackingTree(self.params, StringIO())
+        self.assertEqual(task._delete_local_dirs([u"v1"]), 1)
+        self.assertEqual(task.reap_requests, 1)
+        trash_path = _path(self.local_path, sync_trees.trash.TRASH_NAME)
+        trashed = sync_trees.trash.list_trash(trash_path)
+        self.assertEqual(len(trashed), 1)
+        self.assertTrue(os.path.isdir(_path(trashed[0], u"v1", u"subdir")))
+        # The trash is never treated as a local version
+        local_versions = [os.path.basename(d) for d in task._iter_local_versions()]
+        self.assertEqual(local_versions, [u"v2"])
+
+    def test_reaper_not_started(self):
+        self.params["reaper_python"] = _path(self.local_path, u"missing")
+        task = sync_trees.SyncVersionedTree(self.params, StringIO())
+        self.assertEqual(task._delete_local_dirs([u"v1"]), 1)
+        # The trash is emptied immediately instead
+        trash_path = _path(self.local_path, sync_trees.trash.TRASH_NAME)
+        self.assertEqual(sync_trees.trash.list_trash(trash_path), [])
+        self.assertFalse(os.path.exists(_path(self.local_path, u"v1")))
+
+    def test_delete_immediately(self):
+        self.params["trash_old_dirs"] = False
+        task = _TrashTrackingTree(self.params, StringIO())
+        self.assertEqual(task._delete_local_dirs([u"v1"]), 1)
+        self.assertEqual(task.reap_requests, 0)
+        self.assertEqual(os.listdir(self.local_path), [u"v2"])
+
+
+class TestLocalInventory(unittest.TestCase):
+
+    def setUp(self):
+        self.local_path = local_path = tempfile.mkdtemp().decode("utf-8")
+        self.addCleanup(shutil.rmtree, local_path)
+        for mtime, version in enumerate(u"v2 v1 v3 excluded".split()):
+            version_path = _path(local_path, version)
+            _write_status(version_path, "FINISHED" if version != u"v3" else "STARTED")
+            os.utime(version_path, (mtime, mtime))
+        os.mkdir(_path(local_path, u".pulpdist-staging"))
+        with open(_path(local_path, u"v4"), 'w') as f:
+            f.write("Not a directory")
+        os.symlink(u"v1", _path(local_path, u"vlink"))
+        self.inventory = sync_trees.LocalInventory(local_path, u"v*",
+                                                   [u"excl*", u".pulpdist-*"])
+
+    def version_names(self):
+        return [os.path.basename(p) for p in self.inventory.iter_paths()]
+
+    def test_listing(self):
+        self.assertEqual(self.version_names(), [u"v1", u"v2", u"v3", u"vlink"])
+        self.assertEqual(self.inventory.get_latest_path(), _path(self.local_path, u"v3"))
+
+    def test_cached_details(self):
+        inventory = self.inventory
+        v3_path = _path(self.local_path, u"v3")
+        self.assertEqual(inventory.get_status(v3_path), "STARTED")
+        _write_status(v3_path, "FINISHED")
+        os.utime(v3_path, (100, 100))
+        os.mkdir(_path(self.local_path, u"v5"))
+        self.assertEqual(inventory.get_status(v3_path), "STARTED")
+        self.assertEqual(self.version_names(), [u"v1", u"v2", u"v3", u"vlink"])
+        inventory.refresh(v3_path)
+        self.assertEqual(inventory.get_status(v3_path), "FINISHED")
+        self.assertEqual(inventory.get_latest_path(), v3_path)
+        inventory.refresh(_path(self.local_path, u"v5"))
+        self.assertEqual(self.version_names(), [u"v1", u"v2", u"v3", u"v5", u"vlink"])
+        self.assertIsNone(inventory.get_status(_path(self.local_path, u"v5")))
+
+    def test_removal(self):
+        inventory = self.inventory
+        inventory.remove(_path(self.local_path, u"vlink"))
+        inventory.remove(_path(self.local_path, u"v3"))
+        self.assertEqual(self.version_names(), [u"v1", u"v2"])
+        # The symlink has the same mtime as v1, but sorts later
+        inventory.refresh(_path(self.local_path, u"vlink"))
+        self.assertEqual(inventory.get_latest_path(), _path(self.local_path, u"vlink"))
+        inventory.remove(_path(self.local_path, u"vlink"))
+        self.assertEqual(inventory.get_latest_path(), _path(self.local_path, u"v1"))
+        shutil.rmtree(_path(self.local_path, u"v1"))
+        inventory.refresh(_path(self.local_path, u"v1"))
+        self.assertEqual(self.version_names(), [u"v2"])
+
+    def test_missing_local_path(self):
+        inventory = sync_trees.LocalInventory(_path(self.local_path, u"missing"))
+        self.assertEqual(list(inventory.iter_paths()), [])
+        self.assertIsNone(inventory.get_latest_path())
+
+
+class _FakeProcess(object):
+    def __init__(self):
+        self.terminated = threading.Event()
+
+    def terminate(self):
+        self.terminated.set()
+
+class _FakeGovernedTree(sync_trees.SyncTree):
+    # Simulates another transfer starting during the first rsync command
+    BANDWIDTH_REBALANCE_INTERVAL = 0.01
+
+    def _get_bandwidth_governor(self):
+        return sync_trees.bandwidth.BandwidthGovernor(self.bandwidth_budget,
+                                                      self.registry_dir)
+
+    rebalance_timeout = 5
+    start_other_transfer = True
+
+    def _run_shell_command(self, cmd, output_handler=None, proc_handler=None):
+        self.commands.append(cmd)
+        if len(self.commands) == 1 and self.start_other_transfer:
+            proc = _FakeProcess()
+            with self._get_bandwidth_governor().lease():
+                proc_handler(proc)
+                proc.terminated.wait(self.rebalance_timeout)
+            if proc.terminated.is_set():
+                output_handler(">f+++++++++ done.txt\n")
+                output_handler("\r        2048 100%    1.00MB/s    0:00:00 (xfr#1, to-chk=5/7)\n")
+                output_handler(">f+++++++++ partial.txt\n")
+                output_handler("\r         512  50%  512.00kB/s    0:00:01  ")
+                return 20
+        for line in _SAMPLE_RSYNC_OUTPUT.splitlines(True):
+            output_handler(line)
+        return 0
+
+class TestBandwidthBudget(unittest.TestCase):
+
+    def setUp(self):
+        self.local_path = local_path = tempfile.mkdtemp().decode("utf-8")
+        self.addCleanup(shutil.rmtree, local_path)
+        self.registry_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.registry_dir)
+        params = dict(TreeTestCase.CONFIG_TREE_SYNC)
+        params["local_path"] = local_path + u'/'
+        params["bandwidth_budget"] = 1000
+        self.params = params
+
+    def make_task(self):
+        task = _FakeGovernedTree(self.params, StringIO())
+        task.registry_dir = self.registry_dir
+        task.commands = []
+        return task
+
+    def bandwidth_limits(self, task):
+        return [[arg for arg in cmd if arg.startswith("--bwlimit=")]
+                    for cmd in task.commands]
+
+    def test_rebalance(self):
+        task = self.make_task()
+        result, stats = task.fetch_dir(u"rsync://localhost/src/", self.local_path)
+        self.assertEqual(result, task.SYNC_COMPLETED)
+        self.assertEqual(self.bandwidth_limits(task),
+                         [["--bwlimit=1000"], ["--bwlimit=1000"]])
+        # Files transferred before the restart are still counted, but not
+        # the partially transferred file (which is resumed by the restart)
+        self.assertEqual(stats.transferred_file_count, 4)
+        sample_stats = sync_trees.SyncStats.from_rsync_output(_SAMPLE_RSYNC_OUTPUT)
+        self.assertEqual(stats.transferred_bytes,
+                         sample_stats.transferred_bytes + 2048)
+        self.assertEqual(stats.received_bytes, sample_stats.received_bytes)
+        self.assertEqual(os.listdir(self.registry_dir), [])
+
+    def test_static_limit(self):
+        # Changes to the share above the static limit are ignored
+        self.params["bandwidth_limit"] = 300
+        task = self.make_task()
+        task.rebalance_timeout = 0.1
+        result, stats = task.fetch_dir(u"rsync://localhost/src/", self.local_path)
+        self.assertEqual(result, task.SYNC_COMPLETED)
+        self.assertEqual(self.bandwidth_limits(task), [["--bwlimit=300"]])
+        self.assertEqual(stats.transferred_file_count, 2)
+
+    def test_unusable_registry(self):
+        # Registry problems fall back to the static limit
+        os.chmod(self.registry_dir, 0777)
+        self.params["bandwidth_limit"] = 300
+        log = StringIO()
+        task = _FakeGovernedTree(self.params, log)
+        task.registry_dir = self.registry_dir
+        task.commands = []
+        task.start_other_transfer = False
+        result, stats = task.fetch_dir(u"rsync://localhost/src/", self.local_path)
+        self.assertEqual(result, task.SYNC_COMPLETED)
+        self.assertEqual(self.bandwidth_limits(task), [["--bwlimit=300"]])
+        self.assertIn("Unable to share bandwidth budget", log.getvalue())
+        self.assertEqual(os.listdir(self.registry_dir), [])
+
+
+class _RecordingVersionedTree(sync_trees.SyncVersionedTree):
+    # Records the seed paths used for each version instead of running rsync
+    def __init__(self, *args, **kwds):
+        super(_RecordingVersionedTree, self).__init__(*args, **kwds)
+        self.fetched = {}
+        self.lock = threading.Lock()
+
+    def _fetch_version(self, remote_source_path, local_dest_path, local_seed_paths):
+        if os.path.basename(local_dest_path) == u"skipped":
+            return None
+        os.mkdir(local_dest_path)
+        with self.lock:
+            self.fetched[local_dest_path] = local_seed_paths
+        return "SYNC_COMPLETED", sync_trees._null_sync_stats
+
+class TestParallelFetchSeeding(unittest.TestCase):
+    VERSIONS = u"v1 v2 skipped v4 v5".split()
+
+    def setUp(self):
+        self.local_path = local_path = tempfile.mkdtemp().decode("utf-8")
+        self.addCleanup(shutil.rmtree, local_path)
+        params = dict(TreeTestCase.CONFIG_VERSIONED_SYNC)
+        params["local_path"] = local_path + u'/'
+        self.params = params
+        self.dir_entries = [(index, version) for index, version
+                                             in enumerate(self.VERSIONS)]
+
+    def check_seeds(self, max_fetches, expected_seeds):
+        task = _RecordingVersionedTree(self.params, StringIO())
+        results = task._fetch_versions_in_parallel(self.dir_entries, max_fetches)
+        self.assertEqual(len(results), len(expected_seeds))
+        actual_seeds = {}
+        for dest_path, seed_paths in task.fetched.items():
+            seeds = [os.path.basename(p) for p in seed_paths]
+            actual_seeds[os.path.basename(dest_path)] = seeds
+        self.assertEqual(actual_seeds, expected_seeds)
+
+    def test_sequential_seed_chain(self):
+        # A single fetch at a time matches the sequential seed chain
+        expected_seeds = dict(v1=[], v2=[u"v1"], v4=[u"v2"], v5=[u"v4"])
+        self.check_seeds(1, expected_seeds)
+
+    def test_parallel_seed_chain(self):
+        # Skipped versions pass their own seeds along the chain
+        expected_seeds = dict(v1=[], v2=[], v4=[u"v2"], v5=[u"v1"])
+        self.check_seeds(2, expected_seeds)
+
+    def test_worker_exception(self):
+        class BrokenTree(_RecordingVersionedTree):
+            def _fetch_version(self, *args):
+                raise RuntimeError("Broken fetch")
+        task = BrokenTree(self.params, StringIO())
+        with self.assertRaises(RuntimeError):
+            task._fetch_versions_in_parallel(self.dir_entries, 2)
+
+
+class _FakeClock(object):
+    def __init__(self, step):
+        self.now = 0.0
+        self.step = step
+
+    def __call__(self):
+        self.now += self.step
+        return self.now
+
+class TestPhaseTimer(unittest.TestCase):
+
+    def make_timer(self, step=1.0):
+        timer = sync_trees.PhaseTimer()
+        timer._time = _FakeClock(step)
+        return timer
+
+    def test_phases(self):
+        timer = self.make_timer()
+        with timer.timed("listing"):
+            pass
+        for version in (u"v2", u"v1"):
+            with timer.timed("transfer", version):
+                pass
+        timer.add("transfer", 0.5, u"v1")
+        self.assertEqual(list(timer.iter_phases()), [
+            ("listing", 1.0, []),
+            ("transfer", 2.5, [(u"v1", 1.5), (u"v2", 1.0)]),
+        ])
+        self.assertEqual(timer.as_dict(), {
+            "phases": {"listing": 1.0, "transfer": 2.5},
+            "versions": {u"v1": {"transfer": 1.5}, u"v2": {"transfer": 1.0}},
+        })
+
+    def test_exception(self):
+        timer = self.make_timer()
+        with self.assertRaises(RuntimeError):
+            with timer.timed("transfer"):
+                raise RuntimeError("Failed transfer")
+        self.assertEqual(timer.as_dict()["phases"], {"transfer": 1.0})
+
+class _TimedVersionedTree(sync_trees.SyncVersionedTree):
+    # Lists and "fetches" versions without running rsync
+    def remote_ls(self, remote_ls_path):
+        return [(u"2012/01/01 00:00:00", u"v1"), (u"2012/01/02 00:00:00", u"v2")], []
+
+    def fetch_dir(self, remote_source_path, local_dest_path, local_seed_paths=(),
+                  partition=None):
+        os.mkdir(local_dest_path)
+        return self.SYNC_COMPLETED, sync_trees._null_sync_stats
+
+class TestPhaseTimings(unittest.TestCase):
+
+    def setUp(self):
+        self.local_path = local_path = tempfile.mkdtemp().decode("utf-8")
+        self.addCleanup(shutil.rmtree, local_path)
+        params = dict(TreeTestCase.CONFIG_VERSIONED_SYNC)
+        params["local_path"] = local_path + u'/'
+        params["listing_pattern"] = u"*"
+        params["delete_old_dirs"] = True
+        self.params = params
+
+    def test_versioned_sync_phases(self):
+        log = StringIO()
+        task = _TimedVersionedTree(self.params, log)
+        result = task.run_sync()[0]
+        self.assertEqual(result, task.SYNC_COMPLETED)
+        timings = task.phase_timings.as_dict()
+        self.assertEqual(sorted(timings["phases"]),
+                         ["delete_old_dirs", "remote_listing", "transfer"])
+        self.assertEqual(sorted(timings["versions"]), [u"v1", u"v2"])
+        self.assertEqual(sorted(timings["versions"][u"v1"]), ["transfer"])
+        log_output = log.getvalue()
+        self.assertIn("Phase timings:", log_output)
+        self.assertIn("remote_listing: ", log_output)
+        self.assertIn("v2: ", log_output)
+
+    def test_timings_reset_for_each_run(self):
+        task = _TimedVersionedTree(self.params, StringIO())
+        task.phase_timings.add("stale", 1.0)
+        task.run_sync()
+        self.assertNotIn("stale", task.phase_timings.as_dict()["phases"])
+
+
+class TestRunLogSink(unittest.TestCase):
+
+    def setUp(self):
+        self.local_path = local_path = tempfile.mkdtemp().decode("utf-8")
+        self.addCleanup(shutil.rmtree, local_path)
+        params = dict(TreeTestCase.CONFIG_VERSIONED_SYNC)
+        params["local_path"] = local_path + u'/'
+        params["listing_pattern"] = u"*"
+        self.params = params
+        self.log_dir = log_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, log_dir)
+        self.log_path = os.path.join(log_dir, "sync.log")
+        self.event_path = os.path.join(log_dir, "sync.events.jsonl")
+
+    def read_events(self):
+        with open(self.event_path) as f:
+            return [json.loads(line) for line in f]
+
+    def test_capped_command_output(self):
+        log = run_log.RunLog(self.log_path, max_output_lines=4,
+                             event_path=self.event_path)
+        task = _TimedVersionedTree(self.params, log)
+        self.assertEqual(task._run_shell_command(["seq", "1", "10"]), 0)
+        log.close()
+        with open(self.log_path) as f:
+            output_lines = f.read().splitlines()
+        omitted_msg = run_log.OMITTED_OUTPUT_MESSAGE.format(6)
+        start = output_lines.index("1")
+        self.assertEqual(output_lines[start:start+5],
+                         ["1", "2", omitted_msg, "9", "10"])
+        events = self.read_events()
+        self.assertEqual([event["event"] for event in events],
+                         ["command_started", "command_finished"])
+        finished = events[1]
+        self.assertEqual(finished["return_code"], 0)
+        self.assertEqual(finished["output_lines"], 10)
+        self.assertEqual(finished["omitted_lines"], 6)
+
+    def test_sync_events(self):
+        log = run_log.RunLog(self.log_path, event_path=self.event_path)
+        task = _TimedVersionedTree(self.params, log)
+        task.run_sync()
+        log.close()
+        events = self.read_events()
+        self.assertEqual(events[0]["event"], "sync_started")
+        self.assertEqual(events[0]["tree_name"], self.params["tree_name"])
+        finished = events[-1]
+        self.assertEqual(finished["event"], "sync_finished")
+        self.assertEqual(finished["result"], task.SYNC_COMPLETED)
+        self.assertIn("transfer", finished["phase_timings"]["phases"])
+        self.assertIn("transferred_file_count", finished["stats"])
+
+    def test_plain_log_unchanged(self):
+        log = StringIO()
+        task = _TimedVersionedTree(self.params, log)
+        task._run_shell_command(["printf", "10%%\\r100%%\\n"])
+        self.assertIn("10%\r100%", log.getvalue())
+
+
+def _make_stats(**kwds):
+    return sync_trees._null_sync_stats._replace(**kwds)
+
+class _FakeStreamsTree(sync_trees.SyncTree):
+    # Records the fetch operations instead of running rsync
+    STREAM_STATS = _make_stats(total_file_count=10, total_bytes=100,
+                               transferred_file_count=2, transferred_bytes=20)
+    FINAL_STATS = _make_stats(total_file_count=30, total_bytes=300,
+                              transferred_file_count=1, transferred_bytes=10)
+
+    def _list_top_level_dirs(self, remote_source_path):
+        return u"a b c d e".split()
+
+    def fetch_dir(self, remote_source_path, local_dest_path,
+                  local_seed_paths=(), partition=None):
+        with self.lock:
+            self.partitions.append(partition)
+        if partition is None:
+            return self.SYNC_UP_TO_DATE, self.FINAL_STATS
+        return self.SYNC_COMPLETED, self.STREAM_STATS
+
+class TestParallelStreams(unittest.TestCase):
+
+    def setUp(self):
+        self.local_path = local_path = tempfile.mkdtemp().decode("utf-8")
+        self.addCleanup(shutil.rmtree, local_path)
+        params = dict(TreeTestCase.CONFIG_TREE_SYNC)
+        params["local_path"] = local_path + u'/'
+        params["parallel_streams"] = 2
+        self.params = params
+
+    def test_partition_params(self):
+        task = sync_trees.SyncTree(self.params)
+        params = task._build_fetch_dir_rsync_params(u"rsync://localhost/src/",
+                                                    self.local_path,
+                                                    partition=[u"a", u"b*"])
+        self.assertNotIn("--delete-after", params)
+        stream_filters = ["--include=/a/", "--include=/a/**",
+                          "--include=/b\\*/", "--include=/b\\*/**",
+                          "--exclude=/*"]
+        first_filter = params.index(stream_filters[0])
+        self.assertEqual(params[first_filter:first_filter+5], stream_filters)
+        # Stream filters come after the configured filters
+        for excluded in self.params["exclude_from_sync"]:
+            self.assertLess(params.index("--exclude=" + excluded), first_filter)
+        params = task._build_fetch_dir_rsync_params(u"rsync://localhost/src/",
+                                                    self.local_path)
+        self.assertIn("--delete-after", params)
+        self.assertNotIn("--exclude=/*", params)
+
+    def test_streams(self):
+        task = _FakeStreamsTree(self.params, StringIO())
+        task.partitions = []
+        task.lock = threading.Lock()
+        remote_source_path = u"rsync://localhost/src/"
+        result, stats = task._fetch_dir_in_streams(remote_source_path,
+                                                   self.local_path)
+        # Final pass always runs last, after all the streams
+        self.assertIsNone(task.partitions[-1])
+        self.assertEqual(sorted(task.partitions[:-1]),
+                         [[u"a", u"c", u"e"], [u"b", u"d"]])
+        self.assertEqual(result, "SYNC_COMPLETED")
+        self.assertEqual(stats.total_file_count, 30)
+        self.assertEqual(stats.total_bytes, 300)
+        self.assertEqual(stats.transferred_file_count, 5)
+        self.assertEqual(stats.transferred_bytes, 50)
+
+
+class _FakeStatusProbeTree(sync_trees.SyncSnapshotTree):
+    # Populates the STATUS probe destination instead of running rsync
+    REMOTE_STATUS = {
+        u"finished": "FINISHED",
+        u"in_progress": "STARTED",
+        u"[odd]*name?": "FINISHED",
+    }
+    return_code = 0
+
+    def _run_shell_command(self, cmd, output_handler=None):
+        self.commands.append(cmd)
+        if not any(arg.startswith("--include-from=") for arg in cmd):
+            # Individual STATUS file checks find nothing
+            return self.return_code
+        dest_dir = cmd[-1]
+        for version, status in self.REMOTE_STATUS.items():
+            version_dir = os.path.join(dest_dir, version)
+            os.makedirs(version_dir)
+            with open(os.path.join(version_dir, "STATUS"), 'w') as f:
+                f.write(status + "\n")
+        return self.return_code
+
+class TestStatusProbe(unittest.TestCase):
+    VERSIONS = u"finished in_progress missing [odd]*name?".split()
+
+    def setUp(self):
+        self.local_path = local_path = tempfile.mkdtemp().decode("utf-8")
+        self.addCleanup(shutil.rmtree, local_path)
+        params = dict(TreeTestCase.CONFIG_SNAPSHOT_SYNC)
+        params["local_path"] = local_path + u'/'
+        self.task = task = _FakeStatusProbeTree(params, StringIO())
+        task.commands = []
+        self.dir_entries = [(index, version) for index, version
+                                             in enumerate(self.VERSIONS)]
+
+    def remote_source_path(self, version):
+        task = self.task
+        return "rsync://{0}{1}{2}/".format(task.remote_server,
+                                           task.remote_path, version)
+
+    def test_escape_rsync_pattern(self):
+        self.assertEqual(sync_trees._escape_rsync_pattern(u"plain-name"),
+                         u"plain-name")
+        self.assertEqual(sync_trees._escape_rsync_pattern(u"[odd]*name?\\"),
+                         u"\\[odd]\\*name\\?\\\\")
+
+    def test_batched_probe(self):
+        task = self.task
+        task._prepare_remote_versions(self.dir_entries)
+        self.assertEqual(len(task.commands), 1)
+        expected = dict(finished=True, in_progress=False, missing=False)
+        expected[u"[odd]*name?"] = True
+        for version, should_retrieve in expected.items():
+            remote_source_path = self.remote_source_path(version)
+            self.assertEqual(task._should_retrieve(remote_source_path),
+                             should_retrieve, version)
+        # All answers come from the batched probe
+        self.assertEqual(len(task.commands), 1)
+
+    def test_partial_probe(self):
+        # Missing STATUS files are checked individually after a partial probe
+        task = self.task
+        task.return_code = 23
+        task._prepare_remote_versions(self.dir_entries)
+        self.assertTrue(task._should_retrieve(self.remote_source_path(u"finished")))
+        self.assertEqual(len(task.commands), 1)
+        task._should_retrieve(self.remote_source_path(u"missing"))
+        self.assertEqual(len(task.commands), 2)
+
+    def test_failed_probe(self):
+        task = self.task
+        task.return_code = 1
+        task._prepare_remote_versions(self.dir_entries)
+        task._should_retrieve(self.remote_source_path(u"finished"))
+        self.assertEqual(len(task.commands), 2)
+
+
+def _write_status(dir_path, status="FINISHED"):
+    if not os.path.isdir(dir_path):
+        os.makedirs(dir_path)
+    with open(os.path.join(dir_path, "STATUS"), 'w') as f:
+        f.write(status + "\n")
+
+def _read_file(*parts):
+    with open(os.path.join(*parts)) as f:
+        return f.read().strip()
+
+class _FakeFetchTree(sync_trees.SyncSnapshotTree):
+    # Creates the destination directory instead of running rsync
+    def _run_shell_command(self, cmd, output_handler=None):
+        self.commands.append(cmd)
+        dest_dir = cmd[-1]
+        # The published version must not exist while it is being built
+        self.visible_during_fetch.append(
+            os.path.exists(self._get_published_path(dest_dir)))
+        if not os.path.isdir(dest_dir):
+            os.makedirs(dest_dir)
+        with open(os.path.join(dest_dir, "data.txt"), 'w') as f:
+            f.write(dest_dir)
+        output = _SAMPLE_RSYNC_OUTPUT.replace("subdir/data.txt", "data.txt")
+        for line in output.splitlines(True):
+            output_handler(line)
+        return 0
+
+class TestStagedPublication(unittest.TestCase):
+
+    def setUp(self):
+        self.local_path = local_path = tempfile.mkdtemp().decode("utf-8")
+        self.addCleanup(shutil.rmtree, local_path)
+        params = dict(TreeTestCase.CONFIG_SNAPSHOT_SYNC)
+        params["local_path"] = local_path + u'/'
+        params["latest_link_name"] = u"latest"
+        params["staged_publication"] = True
+        self.params = params
+
+    def make_task(self):
+        task = _FakeFetchTree(self.params, StringIO())
+        task.commands = []
+        task.visible_during_fetch = []
+        task._remote_status = {}
+        task._transferred_paths = []
+        return task
+
+    def fetch_version(self, task, version, seed_paths=()):
+        remote_source_path = "rsync://localhost/snapshots/{0}/".format(version)
+        task._remote_status[remote_source_path] = "FINISHED"
+        local_dest_path = _path(self.local_path, version)
+        return task._fetch_version(remote_source_path, local_dest_path, seed_paths)
+
+    def test_staged_publication(self):
+        task = self.make_task()
+        result, __ = self.fetch_version(task, u"v1")
+        self.assertEqual(result, task.SYNC_COMPLETED)
+        v1_path = _path(self.local_path, u"v1")
+        self.assertEqual(_read_file(v1_path, "STATUS"), "FINISHED")
+        self.assertEqual(os.readlink(_path(self.local_path, u"latest")), u"v1")
+        fetch_cmd = task.commands[0]
+        self.assertEqual(task.visible_during_fetch, [False])
+        self.assertEqual(fetch_cmd[-1], _path(self.local_path, sync_trees._STAGING_NAME, u"v1"))
+        self.assertNotIn("--delay-updates", fetch_cmd)
+        # Transferred files are recorded at their published location
+        self.assertEqual(task._transferred_paths, [_path(v1_path, "data.txt"), _path(v1_path, "data2.txt")])
+        # The next version is seeded from the published one
+        self.fetch_version(task, u"v2", (v1_path,))
+        self.assertIn("--link-dest=" + v1_path, task.commands[1])
+        self.assertEqual(os.readlink(_path(self.local_path, u"latest")), u"v2")
+        task._remove_staging_dir()
+        self.assertEqual(sorted(os.listdir(self.local_path)), [u"latest", u"v1", u"v2"])
+
+    def test_existing_version_updated_in_place(self):
+        os.mkdir(_path(self.local_path, u"v1"))
+        task = self.make_task()
+        self.fetch_version(task, u"v1")
+        self.assertEqual(task.commands[0][-1], _path(self.local_path, u"v1"))
+        self.assertIn("--delay-updates", task.commands[0])
+
+    def test_unstaged(self):
+        self.params["staged_publication"] = False
+        task = self.make_task()
+        self.fetch_version(task, u"v1")
+        self.assertEqual(task.visible_during_fetch, [True])
+        self.assertEqual(task.commands[0][-1], _path(self.local_path, u"v1"))
+
+    def test_incomplete_staged_version(self):
+        task = self.make_task()
+        task._fetch_dir_complete = lambda result, *args: task.SYNC_PARTIAL
+        self.fetch_version(task, u"v1")
+        self.assertFalse(os.path.exists(_path(self.local_path, u"v1")))
+        task._remove_staging_dir()
+        # Left in place to be resumed by the next sync
+        staging_path = _path(self.local_path, sync_trees._STAGING_NAME)
+        self.assertEqual(os.listdir(staging_path), [u"v1"])
+
+    def test_manifest_written(self):
+        self.params["manifest_name"] = u"MANIFEST.gz"
+        task = self.make_task()
+        self.fetch_version(task, u"v1")
+        v1_path = _path(self.local_path, u"v1")
+        entries = manifest.read_manifest(_path(v1_path, "MANIFEST.gz"))
+        # STATUS is excluded from the sync, so it isn't listed either
+        self.assertEqual(sorted(entries), [u"data.txt"])
+        self.assertEqual(_read_file(v1_path, "STATUS"), "FINISHED")
+
+    def test_latest_link_replaced(self):
+        task = self.make_task()
+        for version in (u"v1", u"v2"):
+            os.mkdir(_path(self.local_path, version))
+        link_path = _path(self.local_path, u"latest")
+        os.symlink(u"v1", link_path)
+        task._link_to_latest(_path(self.local_path, u"v2"))
+        self.assertEqual(os.readlink(link_path), u"v2")
+        self.assertEqual(sorted(os.listdir(self.local_path)), [u"latest", u"v1", u"v2"])
+
+
+def _write_manifest(tree_path, manifest_name):
+    entries = []
+    for dir_path, __, names in os.walk(tree_path):
+        for name in names:
+            file_path = _path(dir_path, name)
+            rel_path = os.path.relpath(file_path, tree_path)
+            if rel_path == manifest_name:
+                continue
+            info = os.stat(file_path)
+            entries.append(manifest.ManifestEntry(rel_path, info.st_size,
+                                                  int(info.st_mtime),
+                                                  _read_file(file_path)))
+    manifest.write_manifest(_path(tree_path, manifest_name), entries)
+
+def _write_file(file_path, contents, mtime=None):
+    dir_path = os.path.dirname(file_path)
+    if not os.path.isdir(dir_path):
+        os.makedirs(dir_path)
+    with open(file_path, 'w') as f:
+        f.write(contents + "\n")
+    if mtime is not None:
+        os.utime(file_path, (mtime, mtime))
+
+class _FakeManifestTree(sync_trees.SyncTree):
+    # Copies files from a local directory instead of running rsync
+    fail_transfer = False
+
+    def _run_shell_command(self, cmd, output_handler=None, proc_handler=None):
+        self.commands.append(cmd)
+        source, dest = cmd[-2:]
+        source = source.replace(u"rsync://localhost", self.remote_path_root, 1)
+        if cmd[1] == "-t":
+            if not os.path.exists(source):
+                return 23
+            shutil.copy2(source, dest)
+            return 0
+        files_from = [arg.partition("=")[2] for arg in cmd
+                                if arg.startswith("--files-from=")]
+        if files_from:
+            with open(files_from[0]) as f:
+                rel_paths = f.read().split("\0")[:-1]
+            if self.fail_transfer:
+                rel_paths = []
+        else:
+            rel_paths = [os.path.relpath(_path(dir_path, name), source)
+                            for dir_path, __, names in os.walk(source)
+                                for name in names]
+        for rel_path in rel_paths:
+            dest_path = _path(dest, rel_path)
+            if not os.path.isdir(os.path.dirname(dest_path)):
+                os.makedirs(os.path.dirname(dest_path))
+            shutil.copy2(_path(source, rel_path), dest_path)
+        for line in _SAMPLE_RSYNC_OUTPUT.splitlines(True):
+            output_handler(line)
+        return 23 if self.fail_transfer else 0
+
+class TestManifestTransfer(unittest.TestCase):
+
+    def setUp(self):
+        self.local_path = local_path = tempfile.mkdtemp().decode("utf-8")
+        self.addCleanup(shutil.rmtree, local_path)
+        self.remote_path_root = remote_path_root = tempfile.mkdtemp().decode("utf-8")
+        self.addCleanup(shutil.rmtree, remote_path_root)
+        self.remote_tree = remote_tree = _path(remote_path_root, u"src")
+        _write_file(_path(remote_tree, "a.txt"), "a", 1000)
+        _write_file(_path(remote_tree, "subdir", "b.txt"), "b", 1000)
+        _write_manifest(remote_tree, "MANIFEST.gz")
+        params = dict(TreeTestCase.CONFIG_TREE_SYNC)
+        params["local_path"] = local_path + u'/'
+        params["manifest_name"] = u"MANIFEST.gz"
+        self.params = params
+
+    def make_task(self):
+        task = _FakeManifestTree(self.params, StringIO())
+        task.remote_path_root = self.remote_path_root
+        task.commands = []
+        return task
+
+    def fetch(self, task):
+        return task.fetch_dir(u"rsync://localhost/src/", self.local_path)
+
+    def local_manifest(self):
+        local_manifest_path = _path(self.local_path, sync_trees._LOCAL_MANIFEST_NAME)
+        return manifest.read_manifest(local_manifest_path)
+
+    def remote_manifest(self):
+        return manifest.read_manifest(_path(self.remote_tree, "MANIFEST.gz"))
+
+    def fetch_commands(self, task):
+        return [cmd for cmd in task.commands if cmd[1] != "-t"]
+
+    def test_initial_fetch(self):
+        task = self.make_task()
+        result, __ = self.fetch(task)
+        self.assertEqual(result, task.SYNC_COMPLETED)
+        fetch_cmd, = self.fetch_commands(task)
+        self.assertIn("--delete-after", fetch_cmd)
+        self.assertFalse([arg for arg in fetch_cmd if arg.startswith("--files-from")])
+        self.assertEqual(_read_file(self.local_path, "subdir", "b.txt"), "b")
+        self.assertEqual(self.local_manifest(), self.remote_manifest())
+
+    def test_incremental_fetch(self):
+        self.fetch(self.make_task())
+        _write_file(_path(self.remote_tree, "a.txt"), "changed", 2000)
+        _write_file(_path(self.remote_tree, "c.txt"), "c", 1000)
+        os.unlink(_path(self.remote_tree, "subdir", "b.txt"))
+        os.rmdir(_path(self.remote_tree, "subdir"))
+        _write_manifest(self.remote_tree, "MANIFEST.gz")
+        task = self.make_task()
+        result, __ = self.fetch(task)
+        self.assertEqual(result, task.SYNC_COMPLETED)
+        fetch_cmd, = self.fetch_commands(task)
+        self.assertNotIn("--delete-after", fetch_cmd)
+        self.assertIn("--from0", fetch_cmd)
+        # Directories replaced by files upstream are removed by rsync
+        self.assertIn("--force", fetch_cmd)
+        self.assertEqual(_read_file(self.local_path, "a.txt"), "changed")
+        self.assertEqual(_read_file(self.local_path, "c.txt"), "c")
+        # Deleted files are removed along with any emptied directories
+        self.assertFalse(os.path.exists(_path(self.local_path, "subdir")))
+        self.assertEqual(self.local_manifest(), self.remote_manifest())
+
+    def test_up_to_date(self):
+        self.fetch(self.make_task())
+        task = self.make_task()
+        result, stats = self.fetch(task)
+        self.assertEqual(result, task.SYNC_UP_TO_DATE)
+        self.assertEqual(self.fetch_commands(task), [])
+        self.assertEqual(stats.transferred_file_count, 0)
+
+    def test_protected_files_not_deleted(self):
+        self.fetch(self.make_task())
+        _write_file(_path(self.local_path, "subdir", "PROTECTED"), "")
+        os.unlink(_path(self.remote_tree, "subdir", "b.txt"))
+        _write_manifest(self.remote_tree, "MANIFEST.gz")
+        self.fetch(self.make_task())
+        self.assertEqual(_read_file(self.local_path, "subdir", "b.txt"), "b")
+
+    def test_protected_root_not_deleted(self):
+        self.fetch(self.make_task())
+        _write_file(_path(self.local_path, "PROTECTED"), "")
+        os.unlink(_path(self.remote_tree, "a.txt"))
+        _write_manifest(self.remote_tree, "MANIFEST.gz")
+        self.fetch(self.make_task())
+        self.assertEqual(_read_file(self.local_path, "a.txt"), "a")
+
+    def test_excluded_files_not_deleted(self):
+        excluded = [_path("a_skip.txt"), _path("irrelevant", "c.txt")]
+        for rel_path in excluded:
+            _write_file(_path(self.remote_tree, rel_path), "excluded", 1000)
+        _write_manifest(self.remote_tree, "MANIFEST.gz")
+        self.fetch(self.make_task())
+        for rel_path in excluded:
+            os.unlink(_path(self.remote_tree, rel_path))
+        os.unlink(_path(self.remote_tree, "a.txt"))
+        _write_manifest(self.remote_tree, "MANIFEST.gz")
+        self.fetch(self.make_task())
+        for rel_path in excluded:
+            self.assertEqual(_read_file(self.local_path, rel_path), "excluded")
+        self.assertFalse(os.path.exists(_path(self.local_path, "a.txt")))
+
+    def test_failed_transfer_deletes_nothing(self):
+        self.fetch(self.make_task())
+        os.unlink(_path(self.remote_tree, "a.txt"))
+        _write_file(_path(self.remote_tree, "c.txt"), "c", 1000)
+        _write_manifest(self.remote_tree, "MANIFEST.gz")
+        task = self.make_task()
+        task.fail_transfer = True
+        result, __ = self.fetch(task)
+        self.assertNotEqual(result, task.SYNC_COMPLETED)
+        self.assertEqual(_read_file(self.local_path, "a.txt"), "a")
+        # The next sync checks the entire tree rather than retrying the diff
+        task = self.make_task()
+        self.assertEqual(self.fetch(task)[0], task.SYNC_COMPLETED)
+        fetch_cmd, = self.fetch_commands(task)
+        self.assertIn("--delete-after", fetch_cmd)
+        self.assertEqual(_read_file(self.local_path, "c.txt"), "c")
+        task = self.make_task()
+        self.assertEqual(self.fetch(task)[0], task.SYNC_UP_TO_DATE)
+        self.assertEqual(self.fetch_commands(task), [])
+
+    def test_periodic_full_sync(self):
+        self.fetch(self.make_task())
+        # Local damage isn't visible in the manifests
+        os.unlink(_path(self.local_path, "a.txt"))
+        task = self.make_task()
+        self.assertEqual(self.fetch(task)[0], task.SYNC_UP_TO_DATE)
+        marker_path = _path(self.local_path, sync_trees._LOCAL_FULL_SYNC_NAME)
+        last_full_sync = time.time() - 8 * 24 * 60 * 60
+        os.utime(marker_path, (last_full_sync, last_full_sync))
+        self.params["manifest_full_sync_days"] = 0
+        task = self.make_task()
+        self.assertEqual(self.fetch(task)[0], task.SYNC_UP_TO_DATE)
+        del self.params["manifest_full_sync_days"]
+        task = self.make_task()
+        self.assertEqual(self.fetch(task)[0], task.SYNC_COMPLETED)
+        self.assertIn("--delete-after", self.fetch_commands(task)[0])
+        self.assertEqual(_read_file(self.local_path, "a.txt"), "a")
+        self.assertGreater(os.path.getmtime(marker_path), last_full_sync)
+
+    def test_unsupported_sync_filters(self):
+        self.fetch(self.make_task())
+        self.params["sync_filters"] = [u"dir-merge_.rsync-filter"]
+        task = self.make_task()
+        self.fetch(task)
+        fetch_cmd, = self.fetch_commands(task)
+        self.assertIn("--delete-after", fetch_cmd)
+        self.assertFalse([arg for arg in fetch_cmd if arg.startswith("--files-from")])
+
+    def test_missing_remote_manifest(self):
+        os.unlink(_path(self.remote_tree, "MANIFEST.gz"))
+        task = self.make_task()
+        result, __ = self.fetch(task)
+        self.assertEqual(result, task.SYNC_COMPLETED)
+        self.assertIn("--delete-after", self.fetch_commands(task)[0])
+        local_manifest_path = _path(self.local_path, sync_trees._LOCAL_MANIFEST_NAME)
+        self.assertFalse(os.path.exists(local_manifest_path))
+
+    def test_invalid_local_manifest(self):
+        self.fetch(self.make_task())
+        local_manifest_path = _path(self.local_path, sync_trees._LOCAL_MANIFEST_NAME)
+        _write_file(local_manifest_path, "Not a manifest")
+        task = self.make_task()
+        self.fetch(task)
+        self.assertIn("--delete-after", self.fetch_commands(task)[0])
+        self.assertEqual(self.local_manifest(), self.remote_manifest())
+
+
+class _FakeDeltaWriter(sync_trees.SyncSnapshotDelta):
+    # Writes placeholder batch files instead of running rsync
+    def _run_shell_command(self, cmd, output_handler=None):
+        self.commands.append(cmd)
+        for arg in cmd:
+            if arg.startswith("--only-write-batch="):
+                batch_path = arg.partition("=")[2]
+                for path in (batch_path, batch_path + ".sh"):
+                    with open(path, 'w') as f:
+                        f.write(cmd[-2] + "\n")
+        return 0
+
+class TestDeltaGeneration(unittest.TestCase):
+
+    def setUp(self):
+        self.local_path = local_path = tempfile.mkdtemp().decode("utf-8")
+        self.addCleanup(shutil.rmtree, local_path)
+        params = dict(TreeTestCase.CONFIG_SNAPSHOT_SYNC)
+        params["local_path"] = local_path + u'/'
+        self.delta_path = params["delta_path"] = _path(local_path, u"deltas")
+        self.task = task = _FakeDeltaWriter(params, StringIO())
+        task.commands = []
+        versions = u"v1 v2 v3 v4".split()
+        for version in versions:
+            status = "STARTED" if version == u"v3" else "FINISHED"
+            _write_status(_path(local_path, version), status)
+        task._remote_dir_entries = list(enumerate(versions))
+
+    def test_generate_deltas(self):
+        task = self.task
+        self.assertEqual(task._generate_deltas(), (2, 0))
+        expected_bases = dict(v2=u"v1", v4=u"v2")
+        self.assertEqual(sorted(os.listdir(self.delta_path)), sorted(expected_bases))
+        for target, base in expected_bases.items():
+            target_delta_path = _path(self.delta_path, target)
+            self.assertEqual(_read_file(target_delta_path, "BASE"), base)
+            self.assertEqual(_read_file(target_delta_path, "STATUS"), "FINISHED")
+            self.assertEqual(_read_file(target_delta_path, "batch"),
+                             _path(self.local_path, target, u""))
+            self.assertFalse(os.path.exists(_path(target_delta_path, "batch.sh")))
+        # Completed deltas are not regenerated
+        del task.commands[:]
+        self.assertEqual(task._generate_deltas(), (0, 0))
+        self.assertEqual(task.commands, [])
+
+    def test_failed_delta(self):
+        task = self.task
+        task._run_shell_command = lambda cmd, output_handler=None: 1
+        self.assertEqual(task._generate_deltas(), (0, 2))
+        self.assertEqual(os.listdir(self.delta_path), [])
+
+
+class _FakeDeltaReader(sync_trees.SyncFromDelta):
+    # Simulates retrieving and applying deltas instead of running rsync
+    delta_base = u"v1"
+
+    def _run_shell_command(self, cmd, output_handler=None):
+        self.commands.append(cmd)
+        if cmd[0] == "cp":
+            return super(_FakeDeltaReader, self)._run_shell_command(cmd, output_handler)
+        if any(self.remote_delta_path in arg for arg in cmd):
+            if self.delta_base is None:
+                return 23
+            dest_dir = cmd[-1]
+            _write_status(dest_dir)
+            with open(_path(dest_dir, "BASE"), 'w') as f:
+                f.write(self.delta_base + "\n")
+            with open(_path(dest_dir, "batch"), 'w') as f:
+                pass
+            return 0
+        if any(arg.startswith("--read-batch=") for arg in cmd):
+            dest_dir = cmd[-1]
+            with open(_path(dest_dir, "new.txt"), 'w') as f:
+                f.write("New file\n")
+            output_handler(">f+++++++++ new.txt\n")
+            return 0
+        # Full rsync fetch fails
+        return 1
+
+class TestDeltaApplication(unittest.TestCase):
+
+    def setUp(self):
+        self.local_path = local_path = tempfile.mkdtemp().decode("utf-8")
+        self.addCleanup(shutil.rmtree, local_path)
+        params = dict(TreeTestCase.CONFIG_SNAPSHOT_SYNC)
+        del params["exclude_from_sync"]
+        del params["sync_filters"]
+        params["local_path"] = local_path + u'/'
+        params["remote_delta_path"] = u"/deltas/"
+        self.params = params
+        self.base_path = base_path = _path(local_path, u"v1")
+        _write_status(base_path)
+        with open(_path(base_path, "data.txt"), 'w') as f:
+            f.write("Hello world!\n")
+
+    def make_task(self, params=None):
+        if params is None:
+            params = self.params
+        task = _FakeDeltaReader(params, StringIO())
+        task.commands = []
+        return task
+
+    def fetch(self, task):
+        local_dest_path = _path(self.local_path, u"v2")
+        remote_source_path = u"rsync://localhost/test_data/snapshot/v2/"
+        result, stats = task.fetch_dir(remote_source_path, local_dest_path)
+        return local_dest_path, result, stats
+
+    def test_apply_delta(self):
+        task = self.make_task()
+        local_dest_path, result, stats = self.fetch(task)
+        self.assertEqual(result, "SYNC_COMPLETED")
+        self.assertEqual(stats.transferred_file_count, 1)
+        self.assertEqual(_read_file(local_dest_path, "STATUS"), "FINISHED")
+        self.assertEqual(_read_file(local_dest_path, "new.txt"), "New file")
+        self.assertEqual(_read_file(local_dest_path, "data.txt"), "Hello world!")
+        # Base snapshot is unaffected
+        for name in ("data.txt", "STATUS"):
+            self.assertFalse(os.path.samefile(_path(local_dest_path, name),
+                                              _path(self.base_path, name)))
+        self.assertFalse(os.path.exists(_path(self.base_path, "new.txt")))
+        # The temporary delta directory is cleaned up
+        self.assertEqual(sorted(os.listdir(self.local_path)), [u"v1", u"v2"])
+
+    def check_fallback(self, task):
+        local_dest_path, result, stats = self.fetch(task)
+        self.assertEqual(result, "SYNC_FAILED")
+        self.assertIn("rsync", task.commands[-1])
+        self.assertFalse(any(arg.startswith("--read-batch=")
+                                for arg in task.commands[-1]))
+        self.assertFalse(os.path.exists(_path(local_dest_path, "STATUS")))
+
+    def test_missing_delta(self):
+        task = self.make_task()
+        task.delta_base = None
+        self.check_fallback(task)
+
+    def test_missing_base(self):
+        task = self.make_task()
+        task.delta_base = u"v0"
+        self.check_fallback(task)
+
+    def test_filtered_tree(self):
+        params = dict(self.params)
+        params["exclude_from_sync"] = [u"*.iso"]
+        task = self.make_task(params)
+        self.check_fallback(task)
+        self.assertEqual(len(task.commands), 1)
+
+
+class _LocalDeltaReader(sync_trees.SyncFromDelta):
+    # Retrieves deltas from a local directory, but applies them with rsync
+    local_delta_source = None
+
+    def _run_shell_command(self, cmd, output_handler=None):
+        if any(self.remote_delta_path in arg for arg in cmd):
+            dest_dir = cmd[-1]
+            for name in os.listdir(self.local_delta_source):
+                shutil.copy2(_path(self.local_delta_source, name), dest_dir)
+            return 0
+        return super(_LocalDeltaReader, self)._run_shell_command(cmd, output_handler)
+
+class TestDeltaApplicationWithRsync(unittest.TestCase):
+
+    def setUp(self):
+        self.local_path = local_path = tempfile.mkdtemp().decode("utf-8")
+        self.addCleanup(shutil.rmtree, local_path)
+        self.upstream_path = upstream_path = tempfile.mkdtemp().decode("utf-8")
+        self.addCleanup(shutil.rmtree, upstream_path)
+        params = dict(TreeTestCase.CONFIG_SNAPSHOT_SYNC)
+        del params["exclude_from_sync"]
+        del params["sync_filters"]
+        params["local_path"] = local_path + u'/'
+        params["remote_delta_path"] = u"/deltas/"
+        self.params = params
+        # The base snapshot, with a copy used to write the delta upstream
+        self.base_path = base_path = _path(local_path, u"v1")
+        _write_status(base_path)
+        _write_file(_path(base_path, "unchanged.txt"), "Unchanged", 1000000000)
+        _write_file(_path(base_path, "metadata.txt"), "Same content", 1000000000)
+        _write_file(_path(base_path, "modified.txt"), "Old content", 1000000000)
+        for name in os.listdir(base_path):
+            os.chmod(_path(base_path, name), 0644)
+        upstream_base_path = _path(upstream_path, u"v1")
+        shutil.copytree(base_path, upstream_base_path)
+        # The new snapshot only changes the metadata of one of the files
+        target_path = _path(upstream_path, u"v2")
+        shutil.copytree(base_path, target_path)
+        metadata_path = _path(target_path, "metadata.txt")
+        os.chmod(metadata_path, 0600)
+        os.utime(metadata_path, (1200000000, 1200000000))
+        _write_file(_path(target_path, "modified.txt"), "New content", 1200000000)
+        delta_path = _path(upstream_path, u"deltas")
+        os.mkdir(delta_path)
+        writer_params = dict(TreeTestCase.CONFIG_SNAPSHOT_SYNC)
+        writer_params["local_path"] = upstream_path + u'/'
+        writer_params["delta_path"] = delta_path
+        writer = sync_trees.SyncSnapshotDelta(writer_params, StringIO())
+        self.local_delta_source = _path(delta_path, u"v2")
+        self.assertTrue(writer._write_delta(upstream_base_path, target_path,
+                                            self.local_delta_source))
+
+    def base_file_details(self):
+        details = {}
+        for name in os.listdir(self.base_path):
+            info = os.stat(_path(self.base_path, name))
+            details[name] = (info.st_mode, info.st_mtime, info.st_ino)
+        return details
+
+    def test_base_metadata_unchanged(self):
+        before = self.base_file_details()
+        task = _LocalDeltaReader(self.params, StringIO())
+        task.local_delta_source = self.local_delta_source
+        local_dest_path = _path(self.local_path, u"v2")
+        remote_source_path = u"rsync://localhost/test_data/snapshot/v2/"
+        result, stats = task.fetch_dir(remote_source_path, local_dest_path)
+        self.assertEqual(result, "SYNC_COMPLETED")
+        self.assertEqual(self.base_file_details(), before)
+        self.assertEqual(_read_file(self.base_path, "modified.txt"), "Old content")
+        # The changes are applied to the new snapshot
+        self.assertEqual(_read_file(local_dest_path, "modified.txt"), "New content")
+        info = os.stat(_path(local_dest_path, "metadata.txt"))
+        self.assertEqual(info.st_mode & 0777, 0600)
+        self.assertEqual(info.st_mtime, 1200000000)
+
+
 if __name__ == '__main__':
     import unittest
     unittest.main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2012 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+"""Test suite for deferred deletion of directory trees"""
+
+import fcntl
+import os.path
+import shutil
+import sys
+import tempfile
+import threading
+
+from .compat import unittest
+from .. import trash
+
+_path = os.path.join
+
+class TestTrash(unittest.TestCase):
+
+    def setUp(self):
+        self.root = root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        self.trash_dir = _path(root, trash.TRASH_NAME)
+        for version in u"v1 v2 v3".split():
+            self.make_tree(version)
+
+    def make_tree(self, version):
+        for subdir in (u"a", u"b/c"):
+            dir_path = _path(self.root, version, subdir)
+            os.makedirs(dir_path)
+            with open(_path(dir_path, u"data.txt"), 'w') as f:
+                f.write(version)
+
+    def trash_versions(self, *versions):
+        trashed = []
+        for version in versions:
+            trashed.append(trash.move_to_trash(_path(self.root, version),
+                                               self.trash_dir))
+        return trashed
+
+    def test_move_to_trash(self):
+        trashed = self.trash_versions(u"v1", u"v2")
+        self.make_tree(u"v1")
+        trashed += self.trash_versions(u"v1")
+        self.assertEqual(sorted(os.listdir(self.root)),
+                         [trash.TRASH_NAME, u"v3"])
+        self.assertEqual(len(set(trashed)), 3)
+        for trashed_path in trashed:
+            self.assertTrue(os.path.isfile(_path(trashed_path, u"b/c/data.txt")))
+        self.assertEqual(len(trash.list_trash(self.trash_dir)), 3)
+
+    def test_missing_trash(self):
+        self.assertEqual(trash.list_trash(self.trash_dir), [])
+        self.assertEqual(trash.reap(self.trash_dir), 0)
+
+    def test_reap(self):
+        self.trash_versions(u"v1", u"v2", u"v3")
+        self.assertEqual(trash.reap(self.trash_dir, 2), 3)
+        self.assertEqual(trash.list_trash(self.trash_dir), [])
+        # The lock file is left in place
+        self.assertEqual(os.listdir(self.trash_dir), [trash._LOCK_NAME])
+
+    def test_single_reaper(self):
+        self.trash_versions(u"v1")
+        lock_path = _path(self.trash_dir, trash._LOCK_NAME)
+        with open(lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            self.assertIsNone(trash.reap(self.trash_dir))
+        self.assertEqual(trash.reap(self.trash_dir), 1)
+
+    def test_start_reaper(self):
+        self.trash_versions(u"v1", u"v2")
+        self.assertEqual(trash.start_reaper(self.trash_dir), 0)
+        for __ in range(500):
+            if not trash.list_trash(self.trash_dir):
+                break
+            threading.Event().wait(0.01)
+        self.assertEqual(trash.list_trash(self.trash_dir), [])
+        self.assertTrue(os.path.isdir(_path(self.root, u"v3")))
+
+    def test_missing_python(self):
+        self.trash_versions(u"v1")
+        missing = _path(self.root, u"missing", u"python")
+        self.assertEqual(trash.find_python(missing), None)
+        self.assertRaises(OSError, trash.start_reaper, self.trash_dir,
+                          python=missing)
+        self.assertEqual(len(trash.list_trash(self.trash_dir)), 1)
+
+    def test_embedded_interpreter(self):
+        # Under mod_wsgi, sys.executable is the web server (or empty)
+        python = trash.find_python()
+        self.assertTrue(os.path.basename(python).startswith("python"))
+        self.assertEqual(trash.find_python(sys.executable), sys.executable)
+        orig_executable = sys.executable
+        try:
+            for executable in ("/usr/sbin/httpd", ""):
+                sys.executable = executable
+                found = trash.find_python()
+                self.assertTrue(found.startswith(sys.prefix))
+                self.assertTrue(os.path.basename(found).startswith("python"))
+        finally:
+            sys.executable = orig_executable
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -190,6 +190,9 @@ class TestValidation(unittest.TestCase):
 class ExampleConfig(validation.ValidatedConfig):
     _SPEC = TEST_SPEC
 
+class ExtendedConfig(ExampleConfig):
+    _SPEC = dict(TEST_SPEC, extra=validation.check_text())
+
 EXAMPLE_DATA = {
     "string": "",
     "number": 1,
@@ -210,6 +213,14 @@ class TestValidatedConfig(unittest.TestCase):
         example = ExampleConfig.from_json(json.dumps(data))
         self.assertEqual(example.config, data)
 
+    def test_cached_validator(self):
+        self.assertIs(ExampleConfig.check(), ExampleConfig.check())
+        self.assertIsNot(ExtendedConfig.check(), ExampleConfig.check())
+        data = dict(EXAMPLE_DATA, extra="")
+        ExtendedConfig.ensure_validated(data)
+        self.assertRaises(validation.ValidationError,
+                          ExampleConfig.ensure_validated, data)
+
 
 if __name__ == '__main__':
     unittest.main()
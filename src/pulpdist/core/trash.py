@@ -0,0 +1,221 @@
+#
+# Copyright (C) 2012 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+"""Deferred deletion of large directory trees
+
+Directories are renamed into a trash directory on the same filesystem, which
+is fast regardless of the size of the tree. A detached reaper process then
+deletes the contents of the trash directory at low CPU and I/O priority,
+removing several entries in parallel.
+
+Only one reaper runs for each trash directory at a time. Anything left
+behind by an interrupted reaper is deleted the next time a reaper starts.
+
+When running inside another program (such as httpd with mod_wsgi),
+sys.executable doesn't refer to a Python interpreter, so the reaper is run
+with the interpreter installed alongside the running Python (or with an
+explicitly configured interpreter).
+"""
+
+import argparse
+import errno
+import fcntl
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+from distutils.spawn import find_executable
+
+TRASH_NAME = ".pulpdist-trash"
+
+DEFAULT_REAPER_JOBS = 4
+
+# Trash entries never start with a dot, so the lock file isn't reaped
+_LOCK_NAME = ".reaper.lock"
+_ENTRY_PREFIX = "trash-"
+
+# The directory containing the pulpdist package, so the reaper
+# can be run even if pulpdist isn't installed
+_PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(
+                                os.path.abspath(__file__))))
+
+
+def move_to_trash(path, trash_dir):
+    """Atomically move path into trash_dir, returning its new location
+
+       Raises OSError (with errno set to EXDEV) if the trash directory is
+       on a different filesystem.
+    """
+    if not os.path.isdir(trash_dir):
+        try:
+            os.makedirs(trash_dir)
+        except OSError as ex:
+            if ex.errno != errno.EEXIST:
+                raise
+    # Each trashed directory is wrapped in a unique entry, so reusing
+    # a name can't collide with an entry that hasn't been reaped yet
+    entry = tempfile.mkdtemp(dir=trash_dir, prefix=_ENTRY_PREFIX)
+    trashed_path = os.path.join(entry, os.path.basename(os.path.normpath(path)))
+    try:
+        os.rename(path, trashed_path)
+    except:
+        os.rmdir(entry)
+        raise
+    return trashed_path
+
+def list_trash(trash_dir):
+    """Returns the paths of the entries waiting to be reaped"""
+    try:
+        names = os.listdir(trash_dir)
+    except OSError as ex:
+        if ex.errno != errno.ENOENT:
+            raise
+        return []
+    return sorted(os.path.join(trash_dir, name) for name in names
+                                                 if not name.startswith("."))
+
+def find_python(python=None):
+    """Returns the path to the interpreter used to run the reaper
+
+       If python is given, it is used if it exists. Otherwise, sys.executable
+       is used if it is a Python interpreter, falling back to the interpreter
+       for the running version of Python in sys.prefix.
+       Returns None if no interpreter is found.
+    """
+    if python:
+        candidates = [python]
+    else:
+        candidates = []
+        if os.path.basename(sys.executable or "").startswith("python"):
+            candidates.append(sys.executable)
+        bin_dir = os.path.join(sys.prefix, "bin")
+        version_name = "python{0}.{1}".format(*sys.version_info[:2])
+        candidates.append(os.path.join(bin_dir, version_name))
+        candidates.append(os.path.join(bin_dir, "python"))
+    for candidate in candidates:
+        if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+            return candidate
+    return None
+
+def start_reaper(trash_dir, max_jobs=DEFAULT_REAPER_JOBS, python=None):
+    """Start a detached process to empty the trash directory
+
+       python: the interpreter used to run the reaper (see find_python)
+
+       Returns the exit status of the process that starts the reaper,
+       without waiting for the contents to be deleted. Raises OSError if
+       no interpreter is found or the process can't be started.
+    """
+    interpreter = find_python(python)
+    if interpreter is None:
+        msg = "No Python interpreter found to run the reaper"
+        if python:
+            msg = "Python interpreter {0!r} not found".format(python)
+        raise OSError(errno.ENOENT, msg)
+    cmd = [interpreter, "-m", "pulpdist.core.trash", "--detach",
+           "--jobs", str(max_jobs), os.path.abspath(trash_dir)]
+    ionice = find_executable("ionice")
+    if ionice is not None:
+        cmd = [ionice, "-c3"] + cmd
+    env = os.environ.copy()
+    python_path = env.get("PYTHONPATH")
+    if python_path:
+        env["PYTHONPATH"] = os.pathsep.join((_PACKAGE_ROOT, python_path))
+    else:
+        env["PYTHONPATH"] = _PACKAGE_ROOT
+    with open(os.devnull, 'r+') as devnull:
+        # The reaper detaches itself, so this only waits for the fork
+        proc = subprocess.Popen(cmd, stdin=devnull, stdout=devnull,
+                                stderr=devnull, close_fds=True,
+                                cwd="/", env=env)
+        return proc.wait()
+
+def reap(trash_dir, max_jobs=DEFAULT_REAPER_JOBS):
+    """Delete the contents of the trash directory
+
+       Returns the number of entries deleted, or None if another
+       reaper is already emptying the trash directory.
+    """
+    reaped = 0
+    attempted = set()
+    while True:
+        entries = [entry for entry in list_trash(trash_dir)
+                           if entry not in attempted]
+        if not entries:
+            return reaped
+        # The lock is released before checking for new entries again,
+        # so a reaper started after that check isn't locked out
+        lock_path = os.path.join(trash_dir, _LOCK_NAME)
+        with open(lock_path, 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError as ex:
+                if ex.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                return None
+            # Entries may have been added since the last check
+            entries = [entry for entry in list_trash(trash_dir)
+                               if entry not in attempted]
+            attempted.update(entries)
+            reaped += _delete_entries(entries, max_jobs)
+
+def _delete_entries(entries, max_jobs):
+    pending = list(reversed(entries))
+    lock = threading.Lock()
+    deleted = [0]
+    def _worker():
+        while True:
+            with lock:
+                if not pending:
+                    return
+                entry = pending.pop()
+            shutil.rmtree(entry, ignore_errors=True)
+            if not os.path.lexists(entry):
+                with lock:
+                    deleted[0] += 1
+    workers = []
+    for __ in range(min(max_jobs, len(entries))):
+        worker = threading.Thread(target=_worker)
+        worker.start()
+        workers.append(worker)
+    for worker in workers:
+        worker.join()
+    return deleted[0]
+
+def _detach():
+    # Double fork so the reaper is never left as a zombie of the sync process
+    if os.fork() > 0:
+        os._exit(0)
+    os.setsid()
+    if os.fork() > 0:
+        os._exit(0)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Empty a PulpDist trash directory")
+    parser.add_argument("trash_dir", metavar="TRASH_DIR",
+                        help="trash directory to empty")
+    parser.add_argument("--jobs", type=int, default=DEFAULT_REAPER_JOBS,
+                        help="number of entries to delete in parallel")
+    parser.add_argument("--detach", action="store_true",
+                        help="run in the background")
+    args = parser.parse_args(argv)
+    if args.detach:
+        _detach()
+    try:
+        os.nice(19)
+    except OSError:
+        pass
+    reap(args.trash_dir, max(args.jobs, 1))
+
+if __name__ == "__main__":
+    main()
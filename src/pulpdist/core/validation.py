@@ -48,13 +48,14 @@ def check_regex(pattern, expected=None, allow_none=False):
     if expected is None:
         expected = "text matching {0!r}".format(pattern)
     err_msg = "Expected {0} for {{0}}, got {{1!r}}".format(expected)
+    # We use Unicode storage, but stick with the ASCII rules
+    # for pattern matching on whitespace etc.
+    match = re.compile(pattern).match
     def validator(value, setting='setting'):
         if allow_none and value is None:
             return
         _validate_text(value, setting)
-        # We use Unicode storage, but stick with the ASCII rules
-        # for pattern matching on whitespace etc.
-        if re.match(pattern, value) is None:
+        if match(value) is None:
             fail_validation(err_msg, setting, value)
     return validator
 
@@ -132,7 +133,18 @@ def check_mapping_items(key_validator, value_validator, allow_none=False):
             value_validator(v, field)
     return validator
 
+def _compile_checker(checker):
+    # Nested specs are resolved once, when the mapping validator is built
+    if hasattr(checker, "check"):
+        return checker.check()
+    if isinstance(checker, list):
+        return check_sequence(checker[0].check())
+    return checker
+
 def check_mapping(spec, allow_none=False, allow_extra=False):
+    checkers = dict((key, _compile_checker(checker))
+                        for key, checker in spec.items())
+    expected = frozenset(spec)
     def validator(value, setting='setting'):
         if allow_none and value is None:
             return
@@ -144,7 +156,6 @@ def check_mapping(spec, allow_none=False, allow_extra=False):
                                 setting, type(value))
         # Check for missing and extra attributes
         provided = set(value)
-        expected = set(spec)
         missing = expected - provided
         if missing:
             fail_validation("{0!r} missing from {1}, got {2!r}",
@@ -156,14 +167,11 @@ def check_mapping(spec, allow_none=False, allow_extra=False):
                                 sorted(extra), setting, value)
         # Check the validation of the individual items
         for key, value in value_items:
-            if allow_extra and key not in spec:
+            checker = checkers.get(key)
+            if checker is None:
+                # Only possible when extra items are allowed
                 continue
             value_setting = setting + "[{0!r}]".format(key)
-            checker = spec[key]
-            if hasattr(checker, "check"):
-                checker = checker.check()
-            elif isinstance(checker, list):
-                checker = check_sequence(checker[0].check())
             checker(value, value_setting)
     return validator
 
@@ -212,12 +220,19 @@ class ValidatedConfig(object):
 
     @classmethod
     def check(cls):
+        # The validator is built once for each class (but not inherited,
+        # since subclasses usually extend the spec)
+        validator = cls.__dict__.get("_cached_validator")
+        if validator is not None:
+            return validator
         mapping_validator = check_mapping(cls._SPEC,
                                           cls._ALLOW_NONE,
                                           cls._ALLOW_EXTRA)
+        post_validate = cls.post_validate
         def validator(value, setting='setting'):
             mapping_validator(value, setting)
-            cls.post_validate(value)
+            post_validate(value)
+        cls._cached_validator = validator
         return validator
 
     @classmethod
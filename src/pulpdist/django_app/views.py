@@ -89,6 +89,11 @@ class RepoView(RepoMixin, DetailView):
             summary = last_sync.get("summary")
             if summary:
                 last_status = summary["result"]
+                log_file = summary.get("log_file")
+                if log_file is not None:
+                    log_url = "{0}/{1}".format(server.server.get_sync_logs_url(),
+                                               log_file)
+                    details["latest_sync_log_url"] = log_url
             else:
                 last_status = "PLUGIN_ERROR"
             details["last_status"] = last_status
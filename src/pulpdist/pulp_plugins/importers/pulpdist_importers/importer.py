@@ -14,6 +14,7 @@
 import sys
 import traceback
 import contextlib
+import gzip
 import shutil
 from cStringIO import StringIO
 
@@ -22,10 +23,13 @@ from cStringIO import StringIO
 # a directory we publish over https
 import os, os.path
 SYNC_LOG_RELPATH = "var/www/pub/pulpdist_sync_logs"
+SYNC_STATS_RELPATH = "var/lib/pulpdist/sync_stats.sqlite"
 
 try:
-    from pulpdist.core import sync_trees, validation, util
+    from pulpdist.core import (sync_trees, validation, util, stats_history,
+                               run_log)
     SYNC_LOG_DIR = "/" + SYNC_LOG_RELPATH
+    SYNC_STATS_DB = "/" + SYNC_STATS_RELPATH
 except ImportError:
     # Hack to allow running from a source checkout
     import os, sys
@@ -34,11 +38,15 @@ except ImportError:
     this_dir = os.path.realpath(os.path.dirname(__file__))
     src_dir = os.path.abspath(this_dir + "/../../../..")
     sys.path.append(src_dir)
-    from pulpdist.core import sync_trees, validation, util
+    from pulpdist.core import (sync_trees, validation, util, stats_history,
+                               run_log)
     # And then another dir up to find where to put the sync logs
     SYNC_LOG_DIR = os.path.abspath(
                          os.path.normpath(
                              os.path.join(src_dir, '..', SYNC_LOG_RELPATH)))
+    SYNC_STATS_DB = os.path.abspath(
+                         os.path.normpath(
+                             os.path.join(src_dir, '..', SYNC_STATS_RELPATH)))
 
 
 from pulp.server.content.plugins.importer import Importer
@@ -68,17 +76,30 @@ class _BaseImporter(Importer):
         return True
 
     @contextlib.contextmanager
-    def _manage_sync_log(self, log_name):
-        log_file = log_name + ".log"
+    def _manage_sync_log(self, log_name, sync_config):
+        config = sync_config.config
+        compress = config["compress_sync_log"]
+        log_file = log_name + (".log.gz" if compress else ".log")
         log_path = os.path.join(SYNC_LOG_DIR, log_file)
+        event_path = None
+        if config["log_sync_events"]:
+            event_path = os.path.join(SYNC_LOG_DIR, log_name + ".events.jsonl")
         # This relies on the use of unique tree names and Pulp serialising
         # sync requests to avoid a race condition...
-        if os.path.exists(log_path):
-            os.rename(log_path, log_path + ".prev")
+        for path in (log_path, event_path):
+            if path is not None and os.path.exists(path):
+                os.rename(path, path + ".prev")
+        if compress or event_path or config["max_log_output_lines"]:
+            log_dest = run_log.RunLog(log_path, compress,
+                                      config["max_log_output_lines"],
+                                      event_path)
+        else:
+            log_dest = log_path
         # Helper class for log file management
         SYNC_COMPLETED = self.SYNC_COMMAND.SYNC_COMPLETED
         class LogHelper(object):
             path = log_path
+            dest = log_dest
 
             def update_backup(self, result):
                 """Update backup log file if the sync updated the tree"""
@@ -88,17 +109,39 @@ class _BaseImporter(Importer):
 
             def reopen(self):
                 """Reopen the log to append addition messages"""
+                if compress:
+                    # Appended gzip members are read back as a single stream
+                    return contextlib.closing(gzip.open(log_path, 'ab'))
                 return open(log_path, 'a')
-        yield LogHelper()
-
+        try:
+            yield LogHelper()
+        finally:
+            if log_dest is not log_path:
+                log_dest.close()
+
+
+    def _record_sync_stats(self, repo, sync_info):
+        """Add the sync run to the local statistics history"""
+        notes = getattr(repo, "notes", None) or {}
+        pulpdist_notes = notes.get("pulpdist", {})
+        history = stats_history.SyncStatsHistory(SYNC_STATS_DB)
+        with history.opened():
+            history.record(repo.id, *sync_info,
+                           server_id=pulpdist_notes.get("server_id"),
+                           site_id=pulpdist_notes.get("site_id"))
 
     def sync_repo(self, repo, sync_conduit, config):
         sync_config = self._build_sync_config(config)
+        set_progress = getattr(sync_conduit, "set_progress", None)
+        progress_callback = None
+        if set_progress is not None:
+            def progress_callback(event):
+                set_progress(event._asdict())
         try:
-            # TODO: Refactor to support progress reporting
             # TODO: Refactor to populate content unit metadata
-            with self._manage_sync_log(repo.id) as sync_log:
-                command = self.SYNC_COMMAND(sync_config.config, sync_log.path)
+            with self._manage_sync_log(repo.id, sync_config) as sync_log:
+                command = self.SYNC_COMMAND(sync_config.config, sync_log.dest,
+                                            progress_callback)
                 sync_info = command.run_sync()
         except:
             with sync_log.reopen() as f:
@@ -107,11 +150,22 @@ class _BaseImporter(Importer):
             raise
         result = sync_info[0]
         sync_log.update_backup(result)
+        try:
+            # Test runs don't reflect the real duration or size of the tree
+            if not command.dry_run_only:
+                self._record_sync_stats(repo, sync_info)
+        except:
+            # The sync itself still succeeded, so just log the failure
+            with sync_log.reopen() as f:
+                f.write("** Failed to record sync statistics **\n")
+                traceback.print_exc(file=f)
         summary = {
             "result": result,
             "start_time": sync_info[1].isoformat(),
             "finish_time": sync_info[2].isoformat(),
             "stats": sync_info[3]._asdict(),
+            "phase_timings": command.phase_timings.as_dict(),
+            "log_file": os.path.basename(sync_log.path),
         }
         details = {
             "plugin_type": self.PULP_ID,
@@ -142,8 +196,10 @@ class SnapshotDeltaImporter(_BaseImporter):
     PULP_ID = "snapshot_delta"
     DISPLAY_NAME = "Snapshot Delta Importer"
     CONTENT_TYPES = ["tree_delta"]
+    SYNC_COMMAND = sync_trees.SyncSnapshotDelta
 
 
 class DeltaTreeImporter(_BaseImporter):
     PULP_ID = "delta_tree"
     DISPLAY_NAME = "Delta Tree Importer"
+    SYNC_COMMAND = sync_trees.SyncFromDelta